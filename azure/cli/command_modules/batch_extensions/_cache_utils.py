@@ -0,0 +1,147 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+
+import six
+
+from azure.cli.core._config import az_config, GLOBAL_CONFIG_DIR
+import azure.cli.core.azlogging as azlogging
+
+logger = azlogging.get_az_logger(__name__)
+
+
+_CACHE_ROOT = os.path.join(GLOBAL_CONFIG_DIR, 'batch-extensions-cache')
+_CACHE_FILE_EXTENSION = '.json'
+_ACCOUNT_CACHE_DEFAULT_TTL = 60 * 60
+_ACCOUNT_CACHE_SIZE = 1024 * 1024
+
+
+def hash_content(*contents):
+    """Create a cache key from the hash of the supplied content.
+    :param contents: The strings or bytes which identify the cached value.
+    :returns: The hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    for content in contents:
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+        digest.update(content)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_account_cache():
+    """Get the cache of Batch and storage account details, which is shared by commands
+    and expires entries after the 'account_cache_ttl' setting.
+    :returns: The cache, and the TTL of its entries in seconds.
+    """
+    ttl = az_config.getint('batch', 'account_cache_ttl', _ACCOUNT_CACHE_DEFAULT_TTL)
+    return FileCache('accounts', _ACCOUNT_CACHE_SIZE if ttl > 0 else 0), ttl
+
+
+def _replace_file(source, destination):
+    """Move a file, replacing any existing file at the destination.
+    :param str source: The path of the file to move.
+    :param str destination: The path to move the file to.
+    """
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+class FileCache(object):
+    """A cache of JSON values stored as one file per key in the CLI config directory.
+    The total size of the cache is bounded, evicting the least recently used values.
+    Failing to read or write the cache never fails the command.
+    :param str name: The name of the cache, used as the folder name.
+    :param int max_size: The maximum size of the cache in bytes. Zero disables the cache.
+    """
+
+    def __init__(self, name, max_size):
+        self.directory = os.path.join(_CACHE_ROOT, name)
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + _CACHE_FILE_EXTENSION)
+
+    def get(self, key):
+        """Get a cached value.
+        :param str key: The key of the value.
+        :returns: The cached value, or None if it is not in the cache.
+        """
+        if self.max_size <= 0:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r') as cache_file:
+                value = json.load(cache_file)
+            # Record the use of the value for eviction
+            os.utime(path, None)
+        except (EnvironmentError, ValueError) as error:
+            if getattr(error, 'errno', None) != errno.ENOENT:
+                logger.debug("Unable to read cache file '%s': %s", path, error)
+            return None
+        return value
+
+    def set(self, key, value):
+        """Add a value to the cache, evicting the least recently used values
+        if the cache is over its maximum size.
+        :param str key: The key of the value.
+        :param value: A JSON serializable value.
+        """
+        if self.max_size <= 0:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            try:
+                with os.fdopen(handle, 'w') as cache_file:
+                    json.dump(value, cache_file)
+                _replace_file(temp_path, self._path(key))
+            except Exception:
+                os.remove(temp_path)
+                raise
+            self._evict()
+        except (EnvironmentError, TypeError, ValueError) as error:
+            logger.debug("Unable to write cache file for '%s': %s", key, error)
+
+    def remove(self, key):
+        """Remove a value from the cache.
+        :param str key: The key of the value.
+        """
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_CACHE_FILE_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
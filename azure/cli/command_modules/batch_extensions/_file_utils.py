@@ -3,27 +3,69 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 # --------------------------------------------------------------------------------------------
 
+import base64
+import bisect
+import math
+import mmap
 import os
 import re
 import hashlib
 import datetime
 import copy
+import fnmatch
+import gzip
+import json
 import pathlib
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, wait, ALL_COMPLETED, FIRST_COMPLETED
 from six.moves.urllib.parse import urlsplit  # pylint: disable=import-error
 from six.moves.urllib.parse import quote  # pylint: disable=import-error
 
 from msrestazure.azure_exceptions import CloudError
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
 from azure.mgmt.storage import StorageManagementClient
 from azure.storage import CloudStorageAccount
-from azure.storage.blob import BlobPermissions, BlockBlobService
+from azure.storage.blob import (
+    Blob, BlobBlock, BlobPermissions, BlockBlobService, BlockListType, ContentSettings, Include)
+from azure.storage.blob.models import BlobPrefix
 from azure.mgmt.batch import BatchManagementClient
 
 from azure.cli.core.commands.client_factory import get_mgmt_service_client
 import azure.cli.core.azlogging as azlogging
 from azure.cli.core._config import az_config
+from azure.cli.command_modules.batch_extensions._cache_utils import (
+    FileCache, get_account_cache, hash_content)
+from azure.cli.command_modules.batch_extensions._transfer_utils import TransferTuner
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None  # Python 2
 
 logger = azlogging.get_az_logger(__name__)
 
+_LISTING_CACHE_VERSION = '4'
+_LISTING_CACHE_DEFAULT_SIZE_MB = 100
+_ACCOUNT_CACHE_VERSION = '1'
+_MANIFEST_CACHE_VERSION = '1'
+_MANIFEST_CACHE_SIZE_MB = 100
+_COMPRESSED_ENCODING = 'gzip'
+_COMPRESSED_FILE_SUFFIX = '.gz'
+_PACK_INDEX_NAME = 'index.json'
+_PACK_INDEX_VERSION = 1
+_MANIFEST_NAME = 'manifest.json'
+_MANIFEST_VERSION = 1
+
+_transfer_tuner = None
+_transfer_tuner_lock = threading.Lock()
+
 
 def construct_sas_url(blob, uri):
     """Make up blob URL with container URL"""
@@ -32,6 +74,35 @@ def construct_sas_url(blob, uri):
     return newuri.geturl()
 
 
+def _get_resource_file(blob, file_path):
+    """Get the ResourceFile of a blob. A compressed blob is downloaded next to its file
+    path, with a suffix by which it's found on the node, and its content encoding is
+    recorded so that it is decompressed on the node."""
+    if blob.get('contentEncoding') == _COMPRESSED_ENCODING:
+        return {
+            'blobSource': blob['url'],
+            'filePath': file_path + FileUtils.COMPRESSED_RESOURCE_SUFFIX,
+            'contentEncoding': _COMPRESSED_ENCODING
+        }
+    return {
+        'blobSource': blob['url'],
+        'filePath': file_path
+    }
+
+
+def _get_pack_resource_file(blob, archive):
+    """Get the ResourceFile of the shard in which a file is packed. The files to extract
+    from the shard on the node are recorded in its archive property.
+    :param dict archive: Either the 'directory' into which the files with a 'prefix' are
+     extracted, or the 'member' extracted to a 'filePath'.
+    """
+    return {
+        'blobSource': blob['url'],
+        'filePath': blob['pack'],
+        'archive': archive
+    }
+
+
 def convert_blobs_to_resource_files(blobs, resource_properties):
     """Convert a list of blobs to a list of ResourceFiles"""
     resource_files = []
@@ -43,10 +114,11 @@ def convert_blobs_to_resource_files(blobs, resource_properties):
     if len(blobs) == 1 and blobs[0]['filePath'] == prefix:
         # Single file reference: filePath should be treated as file path
         file_path = resource_properties.get('filePath', blobs[0]['filePath'])
-        resource_files.append({
-            'blobSource': blobs[0]['url'],
-            'filePath': file_path
-        })
+        if 'pack' in blobs[0]:
+            resource_files.append(_get_pack_resource_file(
+                blobs[0], {'member': prefix, 'filePath': file_path}))
+        else:
+            resource_files.append(_get_resource_file(blobs[0], file_path))
     else:
         # Multiple file reference: filePath should be treated as a directory
         base_file_path = ''
@@ -54,12 +126,17 @@ def convert_blobs_to_resource_files(blobs, resource_properties):
             base_file_path = '{}/'.format(
                 FileUtils.STRIP_PATH.sub('', resource_properties['filePath']))
 
+        shards = OrderedDict()
         for blob in blobs:
+            if 'pack' in blob:
+                # Packed files are extracted from each shard in which they are packed
+                shards.setdefault(blob['pack'], blob)
+                continue
             file_path = '{}{}'.format(base_file_path, blob['filePath'])
-            resource_files.append({
-                'blobSource': blob['url'],
-                'filePath': file_path
-            })
+            resource_files.append(_get_resource_file(blob, file_path))
+        for blob in shards.values():
+            resource_files.append(_get_pack_resource_file(
+                blob, {'directory': base_file_path.rstrip('/') or '.', 'prefix': prefix}))
 
     # Add filemode to every resourceFile
     if 'fileMode' in resource_properties:
@@ -69,10 +146,50 @@ def convert_blobs_to_resource_files(blobs, resource_properties):
     return resource_files
 
 
-def resolve_file_paths(local_path):
-    """Generate list of files to upload and the relative directory"""
+def _scan_directory(directory):
+    """List the entries of a directory as tuples of their path and whether they are
+    a directory, using os.scandir where available to avoid a stat per entry."""
+    if scandir:
+        for entry in scandir(directory):
+            yield entry.path, entry.is_dir()
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            yield path, os.path.isdir(path)
+
+
+def _walk_files(directory, recursive=False, exclude=None):
+    """Lazily enumerate the files in a directory, a directory at a time.
+    :param bool recursive: Whether to include the files in subdirectories.
+    :param list exclude: Patterns of paths relative to the directory to exclude.
+    """
+    pending = [directory]
+    while pending:
+        for path, is_dir in _scan_directory(pending.pop()):
+            if _is_excluded(path, directory, exclude):
+                continue
+            if is_dir:
+                if recursive:
+                    pending.append(path)
+            elif os.path.isfile(path):
+                yield path
+
+
+def _is_excluded(path, directory, exclude):
+    if not exclude:
+        return False
+    relative_path = os.path.relpath(path, directory).replace('\\', '/')
+    return any(fnmatch.fnmatch(relative_path, pattern) for pattern in exclude)
+
+
+def iter_file_paths(local_path, recursive=False, exclude=None):
+    """Lazily generate the files to upload and the relative directory.
+    :param bool recursive: Whether to include the files in subdirectories of a directory.
+    :param list exclude: Patterns of paths relative to the directory to exclude.
+    :returns: The relative directory, and an iterator of the paths of the files.
+    """
     local_path = FileUtils.STRIP_PATH.sub("", local_path)
-    files = []
+    files = iter([])
     if local_path.find('*') > -1:
         # Supplied path is a pattern - relative directory will be the
         # path up to the first wildcard
@@ -82,23 +199,63 @@ def resolve_file_paths(local_path):
             ref_dir_str = os.path.dirname(ref_dir_str)
         ref_dir = pathlib.Path(ref_dir_str)
         pattern = local_path[len(ref_dir_str + os.pathsep):]
-        files = [str(f) for f in ref_dir.glob(pattern) if f.is_file()]
+        files = (str(f) for f in ref_dir.glob(pattern)
+                 if f.is_file() and not _is_excluded(str(f), ref_dir_str, exclude))
         local_path = ref_dir_str
     else:
         if os.path.isdir(local_path):
             # Supplied path is a directory
-            files = [os.path.join(local_path, f) for f in os.listdir(local_path)
-                     if os.path.isfile(os.path.join(local_path, f))]
+            files = _walk_files(local_path, recursive, exclude)
         elif os.path.isfile(local_path):
             # Supplied path is a file
-            files.append(local_path)
+            files = iter([local_path])
             local_path = os.path.dirname(local_path)
     return local_path, files
 
 
+def resolve_file_paths(local_path):
+    """Generate list of files to upload and the relative directory"""
+    local_path, files = iter_file_paths(local_path)
+    return local_path, list(files)
+
+
+class _ContentBlob(Blob):
+    """A deduplicated file of a file group, whose content is stored in the content
+    container under its hash."""
+
+    def __init__(self, name, content_hash, size):
+        super(_ContentBlob, self).__init__(name)
+        self.content_hash = content_hash
+        self.properties.content_length = size
+
+
+class _PackedBlob(Blob):
+    """A packed file of a file group, which is extracted from the shard in which it's packed."""
+
+    def __init__(self, name, shard, size):
+        super(_PackedBlob, self).__init__(name)
+        self.shard = shard
+        self.properties.content_length = size
+
+
 def resolve_remote_paths(blob_service, file_group, remote_path):
-    blobs = blob_service.list_blobs(_get_container_name(file_group), prefix=remote_path)
-    return list(blobs)
+    """List the blobs of a file group with a prefix, including its packed and deduplicated
+    files, but not the shards, indexes and manifests in which they are listed."""
+    container_name = _get_container_name(file_group)
+    blobs = [b for b in blob_service.list_blobs(container_name, prefix=remote_path)
+             if not b.name.startswith(FileUtils.PACK_DIRECTORY)]
+    # Files uploaded separately take precedence over packed and deduplicated files
+    names = set(b.name for b in blobs)
+    index_names = [b.name for b in blob_service.list_blobs(
+        container_name, prefix=FileUtils.PACK_DIRECTORY) if _is_index_name(b.name)]
+    for name, shard, content_hash, size in _read_indexed_files(
+            blob_service, container_name, index_names):
+        if (not remote_path or name.startswith(remote_path)) and name not in names:
+            if shard:
+                blobs.append(_PackedBlob(name, shard, size))
+            else:
+                blobs.append(_ContentBlob(name, content_hash, size))
+    return blobs
 
 def generate_container_name(file_group):
     """Generate valid container name from file group name."""
@@ -132,16 +289,39 @@ def _get_container_name(file_group):
     return '{}{}'.format(FileUtils.GROUP_PREFIX, generate_container_name(file_group))
 
 
-def _generate_blob_sas_token(blob, container, blob_service, permission=BlobPermissions.READ):
+def _get_sas_validity():
+    """Get the start and expiry times for a SAS token."""
+    start = datetime.datetime.utcnow()
+    return start, start + datetime.timedelta(days=FileUtils.SAS_EXPIRY_DAYS)
+
+
+def _generate_blob_sas_token(blob, container, blob_service,  # pylint: disable=too-many-arguments
+                             permission=BlobPermissions.READ, start=None, expiry=None):
     """Generate a blob URL with SAS token."""
+    if not start or not expiry:
+        start, expiry = _get_sas_validity()
     sas_token = blob_service.generate_blob_shared_access_signature(
         container, blob.name,
         permission=permission,
-        start=datetime.datetime.utcnow(),
-        expiry=datetime.datetime.utcnow() + datetime.timedelta(days=FileUtils.SAS_EXPIRY_DAYS))
+        start=start,
+        expiry=expiry)
     return blob_service.make_blob_url(container, quote(blob.name), sas_token=sas_token)
 
 
+def _filter_sorted_references(listing, prefix):
+    """Return the blob references in a sorted listing whose path starts with a prefix.
+    :param tuple listing: The sorted blob paths and their blob references.
+    :param str prefix: The prefix to match, or None for all references.
+    """
+    paths, references = listing
+    if not prefix:
+        return list(references)
+    start = end = bisect.bisect_left(paths, prefix)
+    while end < len(paths) and paths[end].startswith(prefix):
+        end += 1
+    return references[start:end]
+
+
 def _generate_container_sas_token(container, blob_service, permission=BlobPermissions.WRITE):
     """Generate a container URL with SAS token."""
     blob_service.create_container(container)
@@ -157,13 +337,375 @@ def _generate_container_sas_token(container, blob_service, permission=BlobPermis
         sas_token)
     return url
 
-def download_blob(blob, file_group, destination, blob_service):
-    """Download the specified file to the specified container"""
-    blob_service.get_blob_to_path(_get_container_name(file_group), blob, destination)
+
+def touch_container(blob_service, file_group):
+    """Update the metadata of a file group container, changing its ETag so that
+    cached listings of the container are invalidated."""
+    container_name = _get_container_name(file_group)
+    metadata = blob_service.get_container_metadata(container_name)
+    metadata['lastupload'] = str(time.time())
+    blob_service.set_container_metadata(container_name, metadata)
+
+
+def get_transfer_tuner():
+    """Get the tuner of the connections and block sizes used by the blob transfers of
+    this process, which is created on first use."""
+    global _transfer_tuner  # pylint: disable=global-statement
+    with _transfer_tuner_lock:
+        if _transfer_tuner is None:
+            _transfer_tuner = TransferTuner(FileUtils.PARALLEL_OPERATION_THREAD_COUNT,
+                                            FileUtils.MAX_TRANSFER_CONNECTION_COUNT,
+                                            FileUtils.MAX_BLOCK_SIZE)
+        return _transfer_tuner
+
+
+def download_blob(blob, file_group, destination, blob_service,  # pylint: disable=too-many-arguments
+                  size=None, max_connections=None, container_name=None):
+    """Download the specified file to the specified container.
+    :param int size: The size of the blob, if known. Unless the number of connections is
+     supplied, a blob of known size is downloaded in ranges over tuned connections.
+    :param str container_name: The container of the blob, if not that of the file group.
+    """
+    tuner = get_transfer_tuner()
+    tuner.watch(blob_service)
+    if not max_connections:
+        max_connections = 1
+        if size:
+            max_connections = tuner.get_connections(_get_range_connections(size, blob_service))
+    start = time.time()
+    try:
+        with open(destination, 'wb') as stream:
+            if size:
+                # Preallocate the file, as ranges of large blobs are written in any order
+                stream.truncate(size)
+            blob_service.get_blob_to_stream(container_name or _get_container_name(file_group),
+                                            blob, stream, max_connections=max_connections)
+    except Exception:
+        # Don't leave a partial file, which would be skipped by a later download
+        if os.path.isfile(destination):
+            os.remove(destination)
+        raise
+    tuner.record(os.path.getsize(destination), start)
+
+
+def _get_blob_name(file_name, remote_path=None, flatten=None):
+    """Get the name of the blob to which a local file is uploaded."""
+    if flatten:
+        # Flatten local directory structure
+        file_name = os.path.basename(file_name)
+    blob_name = file_name
+    if remote_path:
+        # Add any specified virtual directories
+        blob_prefix = FileUtils.STRIP_PATH.sub('', remote_path)
+        blob_name = '{}/{}'.format(blob_prefix, FileUtils.STRIP_PATH.sub('', file_name))
+    return blob_name.replace('\\', '/')
+
+
+def _get_content_encoding(blob):
+    """Get the content encoding of a listed blob, if it was compressed on upload."""
+    content_encoding = blob.properties.content_settings.content_encoding
+    return content_encoding if content_encoding == _COMPRESSED_ENCODING else None
+
+
+class _Listing(object):
+    """The items of a listing, set once it has completed."""
+
+    def __init__(self):
+        self.listed = threading.Event()
+        self.items = None
+
+
+def _get_listing(listings, lock, key, list_items, max_listings=None):
+    """Get the items of a listing, listing them unless they are already listed. The first
+    thread to need a listing lists the items without holding the lock, while other
+    threads needing the same listing wait for it. A failed listing is retried by the
+    next thread to need it.
+    :param dict listings: The listings, by key.
+    :param lock: The lock guarding the listings.
+    :param func list_items: Lists the items.
+    :param int max_listings: If set, only this many of the most recently used listings
+     are kept, in the order of an OrderedDict.
+    """
+    while True:
+        with lock:
+            listing = listings.pop(key, None)
+            should_list = listing is None
+            if should_list:
+                listing = _Listing()
+                while max_listings and len(listings) >= max_listings:
+                    listings.popitem(last=False)
+            listings[key] = listing
+        if should_list:
+            try:
+                listing.items = list_items()
+            finally:
+                if listing.items is None:
+                    with lock:
+                        if listings.get(key) is listing:
+                            del listings[key]
+                listing.listed.set()
+        else:
+            listing.listed.wait()
+        if listing.items is not None:
+            return listing.items
+
+
+class _UploadedMetadata(object):
+    """The metadata of the blobs already uploaded to a container, listed one virtual
+    directory at a time as files are uploaded. Local files are enumerated a directory
+    at a time, so only the listings of the most recently used directories are kept.
+    :param str container_name: The name of the container.
+    """
+
+    def __init__(self, container_name, blob_service):
+        self.container_name = container_name
+        self.blob_service = blob_service
+        self.directories = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _list(self, directory):
+        blobs = self.blob_service.list_blobs(
+            self.container_name, prefix=directory + '/' if directory else None,
+            delimiter='/', include=Include.METADATA)
+        return {b.name: b.metadata or {} for b in blobs if not isinstance(b, BlobPrefix)}
+
+    def get(self, blob_name):
+        """Get the metadata of a blob, or None if it has not been uploaded."""
+        directory = blob_name.rpartition('/')[0]
+        metadata = _get_listing(self.directories, self.lock, directory,
+                                lambda: self._list(directory),
+                                max_listings=FileUtils.MAX_LISTED_DIRECTORIES)
+        return metadata.get(blob_name)
+
+
+def hash_file(path):
+    """Get the SHA-256 hash of the content of a file.
+    :returns: The hex digest of the content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as local_file:
+        for chunk in iter(lambda: local_file.read(FileUtils.HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SyncManifest(object):
+    """The size, modification time and content hash of the local files synced from a
+    directory, cached so that unchanged files are not hashed again.
+    :param str local_root: The local directory from which files are synced.
+    """
+
+    def __init__(self, local_root):
+        self.cache = FileCache('manifests', _MANIFEST_CACHE_SIZE_MB * 1024 * 1024)
+        self.key = hash_content(_MANIFEST_CACHE_VERSION, os.path.abspath(local_root))
+        self.entries = self.cache.get(self.key) or {}
+
+    def get_content_hash(self, path):
+        """Get the content hash of a local file, hashing it only if it has changed."""
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime:
+            return entry[2]
+        content_hash = hash_file(path)
+        # A file modified within the resolution of its timestamp may change again
+        # without its size or modification time changing, so isn't recorded.
+        if time.time() - stat.st_mtime > FileUtils.MTIME_RESOLUTION:
+            self.entries[path] = [stat.st_size, stat.st_mtime, content_hash]
+        return content_hash
+
+    def save(self):
+        """Save the manifest to the cache."""
+        self.cache.set(self.key, self.entries)
+
+
+def _compress_file(source):
+    """Compress a file with gzip to a temporary file, which the caller must remove.
+    :returns: The path of the compressed file.
+    """
+    handle, path = tempfile.mkstemp(suffix=_COMPRESSED_FILE_SUFFIX)
+    try:
+        with os.fdopen(handle, 'wb') as compressed_file, open(source, 'rb') as local_file:
+            # A fixed timestamp makes the output depend only on the content, so that an
+            # interrupted upload of the compressed blocks can be resumed.
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=FileUtils.COMPRESSION_LEVEL,
+                               fileobj=compressed_file, mtime=0) as gzip_file:
+                shutil.copyfileobj(local_file, gzip_file, FileUtils.HASH_CHUNK_SIZE)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path
+
+
+class _MappedBlock(object):
+    """A block of a memory-mapped file, read as the body of a Put Block request without
+    copying it. The MD5 hash of the block is computed ahead of the request, and set as its
+    Content-MD5 header by the request callback set by _watch_block_requests.
+    :param view: A memoryview of the mapped file, or on Python 2 the mapping itself, whose
+     slices are copies.
+    :param int offset: The offset of the block in the file.
+    :param int length: The length of the block.
+    """
+
+    def __init__(self, view, offset, length):
+        self.view = view[offset:offset + length]
+        self.position = 0
+        self.content_md5 = None  # A future of the base64-encoded MD5 hash of the block
+
+    def __len__(self):
+        return len(self.view)
+
+    def get_content_md5(self):
+        """Hash the block. Hashing a memoryview doesn't copy it, and releases the GIL."""
+        return base64.b64encode(hashlib.md5(self.view).digest()).decode('utf-8')
+
+    def read(self, size=-1):
+        end = len(self.view)
+        if size is not None and size >= 0:
+            end = min(end, self.position + size)
+        data = self.view[self.position:end]
+        self.position = end
+        return data
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.position = max(0, min(offset, len(self.view)))
+        return self.position
+
+    def close(self):
+        if isinstance(self.view, memoryview):
+            self.view.release()
+
+
+def _watch_block_requests(blob_service):
+    """Set the Content-MD5 header of each request whose body is a mapped block, chaining
+    any request callback already set on the storage client. The callback is called before
+    each attempt of a request, so the block is also rewound for any retry."""
+    previous = getattr(blob_service, 'request_callback', None)
+    if getattr(previous, 'mapped_blocks', None) is True:
+        return
+
+    def callback(request):
+        if isinstance(request.body, _MappedBlock):
+            request.body.seek(0)
+            request.headers['Content-MD5'] = request.body.content_md5.result()
+        if previous:
+            previous(request)
+
+    callback.mapped_blocks = True
+    blob_service.request_callback = callback
+
+
+def _map_file(path):
+    """Memory-map a file for reading.
+    :returns: The mapping, and a memoryview of it where supported.
+    """
+    with open(path, 'rb') as stream:
+        mapping = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return mapping, memoryview(mapping)
+    except TypeError:  # Python 2 mappings don't support memoryview
+        return mapping, mapping
+
+
+def _upload_blob_blocks(blob_service, container_name, blob_name,  # pylint: disable=too-many-arguments
+                        source, metadata, max_connections, content_settings=None):
+    """Upload a large file as blocks whose IDs are derived from the file. Blocks left
+    uncommitted by an interrupted upload of the same file are not uploaded again.
+    :param dict metadata: The metadata of the blob, including the lastmodified time of the file.
+    """
+    size = os.path.getsize(source)
+    tuner = get_transfer_tuner()
+
+    def get_blocks(block_size):
+        fingerprint = hash_content(str(size), str(block_size), metadata['lastmodified'],
+                                   metadata.get('sha256', ''))[:32]
+        return [('{:05d}-{}'.format(index, fingerprint), offset, min(block_size, size - offset))
+                for index, offset in enumerate(range(0, size, block_size))]
+
+    try:
+        uploaded = blob_service.get_block_list(
+            container_name, blob_name, block_list_type=BlockListType.Uncommitted)
+        uploaded = set((b.id, b.size) for b in uploaded.uncommitted_blocks)
+    except AzureMissingResourceHttpError:
+        uploaded = set()
+    blocks = get_blocks(tuner.get_block_size(size, blob_service.MAX_BLOCK_SIZE, max_connections))
+    if uploaded and not uploaded.intersection((b[0], b[2]) for b in blocks):
+        # An interrupted upload is resumed with its own block size, the largest it uploaded
+        previous = get_blocks(max(b[1] for b in uploaded))
+        if uploaded.intersection((b[0], b[2]) for b in previous):
+            blocks = previous
+    missing = [b for b in blocks if (b[0], b[2]) not in uploaded]
+    if len(missing) < len(blocks):
+        logger.warning('Resuming upload of %s: %d of %d blocks already uploaded',
+                       source, len(blocks) - len(missing), len(blocks))
+
+    if missing:
+        _put_mapped_blocks(blob_service, container_name, blob_name, source, missing,
+                           max_connections)
+    blob_service.put_block_list(container_name, blob_name, [BlobBlock(id=b[0]) for b in blocks],
+                                content_settings=content_settings, metadata=metadata)
+
+
+def _put_mapped_blocks(blob_service, container_name, blob_name,  # pylint: disable=too-many-arguments
+                       source, blocks, max_connections):
+    """Upload blocks of a file from a memory mapping of it. The blocks are hashed in order
+    on a separate pool of threads, ahead of their upload.
+    :param list blocks: Tuples of the ID, offset and length of each block.
+    """
+    tuner = get_transfer_tuner()
+    _watch_block_requests(blob_service)
+    mapping, view = _map_file(source)
+    mapped_blocks = [(block_id, _MappedBlock(view, offset, length))
+                     for block_id, offset, length in blocks]
+
+    def put_block(mapped_block):
+        block_id, block = mapped_block
+        start = time.time()
+        blob_service.put_block(container_name, blob_name, block, block_id)
+        tuner.record(len(block), start)
+
+    try:
+        with ThreadPoolExecutor(max_workers=FileUtils.BLOCK_HASH_THREAD_COUNT) as hasher:
+            for _, block in mapped_blocks:
+                block.content_md5 = hasher.submit(block.get_content_md5)
+            try:
+                with ThreadPoolExecutor(max_workers=max_connections) as executor:
+                    list(executor.map(put_block, mapped_blocks))
+            except BaseException:
+                for _, block in mapped_blocks:
+                    block.content_md5.cancel()
+                raise
+    finally:
+        for _, block in mapped_blocks:
+            block.close()
+        try:
+            if view is not mapping:
+                view.release()
+            mapping.close()
+        except BufferError:
+            # A slice of a block is still referenced, e.g. by a failed request, so the
+            # mapping is closed once it's garbage collected.
+            pass
+
 
 def upload_blob(source, destination, file_name,  # pylint: disable=too-many-arguments
-                blob_service, remote_path=None, flatten=None):
-    """Upload the specified file to the specified container"""
+                blob_service, remote_path=None, flatten=None, max_connections=None,
+                uploaded_metadata=None, manifest=None, compress=False):
+    """Upload the specified file to the specified container.
+    :param dict uploaded_metadata: The metadata of the blobs in the container, by blob name.
+     If not supplied, the container is created and the metadata of the blob is fetched.
+    :param SyncManifest manifest: If supplied, the file is only uploaded if its content
+     differs from the blob, rather than its modification time.
+    :param bool compress: Whether to upload the file compressed with gzip. The blob's
+     Content-Encoding is set, and its original size stored in its metadata.
+    """
     if not os.path.isfile(source):
         raise ValueError('Failed to locate file {}'.format(source))
 
@@ -171,49 +713,576 @@ def upload_blob(source, destination, file_name,  # pylint: disable=too-many-argu
     if statinfo.st_size > 50000 * 4 * 1024 * 1024:
         raise ValueError('The local file size {} exceeds the Azure blob size limit'.
                          format(statinfo.st_size))
-    if flatten:
-        # Flatten local directory structure
-        file_name = os.path.basename(file_name)
 
-    # Create upload container with sanitized file group name
     container_name = _get_container_name(destination)
-    blob_service.create_container(container_name)
-
-    blob_name = file_name
-    if remote_path:
-        # Add any specified virtual directories
-        blob_prefix = FileUtils.STRIP_PATH.sub('', remote_path)
-        blob_name = '{}/{}'.format(blob_prefix, FileUtils.STRIP_PATH.sub('', file_name))
-    blob_name = blob_name.replace('\\', '/')
+    blob_name = _get_blob_name(file_name, remote_path, flatten)
 
     # We store the lastmodified timestamp in order to prevent overwriting with
     # out-dated or duplicate data. TODO: Investigate cleaner options for handling this.
     file_time = str(os.path.getmtime(source))
-    metadata = None
-    try:
-        metadata = blob_service.get_blob_metadata(container_name, blob_name)
-    except Exception:  # pylint: disable=broad-except
-        # check notfound
-        pass
+    if uploaded_metadata is None:
+        # Create upload container with sanitized file group name
+        blob_service.create_container(container_name)
+        try:
+            metadata = blob_service.get_blob_metadata(container_name, blob_name)
+        except Exception:  # pylint: disable=broad-except
+            # check notfound
+            metadata = None
     else:
-        if metadata and metadata['lastmodified']:
-            if metadata['lastmodified'] == file_time:
-                logger.warning('File \'%s\' already exists and up-to-date - skipping', blob_name)
-                return
+        metadata = uploaded_metadata.get(blob_name)
+    metadata = metadata or {}
+    new_metadata = {'lastmodified': file_time}
+    if compress:
+        new_metadata['originalsize'] = str(statinfo.st_size)
+    if manifest:
+        new_metadata['sha256'] = manifest.get_content_hash(source)
+        up_to_date = metadata.get('sha256') == new_metadata['sha256']
+    else:
+        up_to_date = bool(metadata.get('lastmodified')) and metadata['lastmodified'] == file_time
+    # A file uploaded without compression is uploaded again if compression is requested
+    up_to_date = up_to_date and ('originalsize' in metadata) == bool(compress)
+    if up_to_date:
+        logger.warning('File \'%s\' already exists and up-to-date - skipping', blob_name)
+        return
 
     logger.warning('Uploading %s to blob %s in container %s', source, blob_name, container_name)
+    content_settings = None
+    if compress:
+        source = _compress_file(source)
+        content_settings = ContentSettings(content_encoding=_COMPRESSED_ENCODING)
+    try:
+        _put_blob(source, container_name, blob_name, blob_service, new_metadata,
+                  max_connections, content_settings=content_settings)
+    finally:
+        if compress:
+            os.remove(source)
+
+
+def _put_blob(source, container_name, blob_name,  # pylint: disable=too-many-arguments
+              blob_service, metadata, max_connections=None, content_settings=None):
+    """Upload a file to a blob, over tuned connections unless their number is supplied.
+    :param dict metadata: The metadata of the blob, including the lastmodified time of the file.
+    """
+    tuner = get_transfer_tuner()
+    tuner.watch(blob_service)
+    max_connections = max_connections or tuner.get_connections()
+    size = os.path.getsize(source)
+    if size >= blob_service.MAX_SINGLE_PUT_SIZE:
+        # Upload large files in blocks which can be resumed if the upload is interrupted
+        _upload_blob_blocks(blob_service, container_name, blob_name, source,
+                            metadata, max_connections,
+                            content_settings=content_settings)
+        return
     # Upload block blob
-    # TODO: Investigate compression + chunking performance enhancement proposal.
+    start = time.time()
     blob_service.create_blob_from_path(
         container_name=container_name,
         blob_name=blob_name,
         file_path=source,
+        content_settings=content_settings,
         progress_callback=lambda c, t: None,
-        metadata={'lastmodified': file_time},
+        metadata=metadata,
         # We want to validate the file as we upload, and only complete the operation
         # if all the data transfers successfully
         validate_content=True,
-        max_connections=FileUtils.PARALLEL_OPERATION_THREAD_COUNT)
+        max_connections=max_connections)
+    tuner.record(size, start)
+
+
+def _get_block_connections(size, blob_service):
+    """Get the number of connections worth using to upload a file of the given size."""
+    if size < blob_service.MAX_SINGLE_PUT_SIZE:
+        return 1
+    return int(math.ceil(float(size) / blob_service.MAX_BLOCK_SIZE))
+
+
+def _get_range_connections(size, blob_service):
+    """Get the number of connections worth using to download a blob of the given size."""
+    if size <= blob_service.MAX_SINGLE_GET_SIZE:
+        return 1
+    ranges = math.ceil(float(size - blob_service.MAX_SINGLE_GET_SIZE) /
+                       blob_service.MAX_CHUNK_GET_SIZE)
+    return 1 + int(ranges)
+
+
+def _run_transfers(transfer, transfers, get_connections, max_connections):
+    """Run transfers concurrently. A budget of connections is shared between the
+    transfers in progress and the ranges or blocks of large files. The budget is tuned
+    from the throughput of the transfers, up to the maximum.
+    :param func transfer: Runs a transfer, given its arguments and the number of connections.
+    :param transfers: An iterable of the arguments of each transfer.
+    :param func get_connections: Gets the number of connections a transfer can make use of.
+    :param int max_connections: The maximum number of concurrent connections.
+    """
+    if max_connections is None:
+        max_connections = FileUtils.MAX_TRANSFER_CONNECTION_COUNT
+    if max_connections < 1:
+        raise ValueError('The maximum number of connections must be at least 1.')
+    tuner = get_transfer_tuner()
+    available = threading.Condition()
+    in_use = [0]
+
+    def run(args):
+        wanted = get_connections(*args)
+        with available:
+            while in_use[0] >= tuner.get_connections(max_connections=max_connections):
+                available.wait()
+            # Large files also use any connections left idle by the other transfers
+            budget = tuner.get_connections(max_connections=max_connections)
+            held = max(1, min(wanted, budget - in_use[0]))
+            in_use[0] += held
+        try:
+            transfer(*args, max_connections=held)
+        finally:
+            with available:
+                in_use[0] -= held
+                available.notify_all()
+
+    pending = set()
+
+    def wait_for_transfers(return_when):
+        done, remaining = wait(pending, return_when=return_when)
+        pending.intersection_update(remaining)
+        for future in done:
+            future.result()
+
+    with ThreadPoolExecutor(max_workers=max_connections) as executor:
+        try:
+            for args in transfers:
+                if len(pending) >= 2 * max_connections:
+                    wait_for_transfers(FIRST_COMPLETED)
+                pending.add(executor.submit(run, args))
+            wait_for_transfers(ALL_COMPLETED)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+
+def _get_pack_directory(remote_path):
+    """Get the virtual directory of the pack and the manifest of the files uploaded to a
+    remote path."""
+    remote_path = FileUtils.STRIP_PATH.sub('', remote_path or '')
+    return '{}{}/'.format(FileUtils.PACK_DIRECTORY, hash_content(remote_path)[:16])
+
+
+def _read_pack_index(blob_service, container_name, index_name):
+    """Read the index of the packs uploaded to a remote path, which lists the files packed
+    in each shard.
+    :returns: The index, empty if there is none, and its ETag or None.
+    """
+    try:
+        blob = blob_service.get_blob_to_text(container_name, index_name)
+    except AzureMissingResourceHttpError:
+        return {'version': _PACK_INDEX_VERSION, 'shards': []}, None
+    index = json.loads(blob.content)
+    if index.get('version') != _PACK_INDEX_VERSION:
+        raise ValueError('Unsupported version of pack index {}'.format(index_name))
+    return index, blob.properties.etag
+
+
+def _is_index_name(blob_name):
+    """Whether a blob is the pack index or the manifest of the files of a remote path."""
+    return blob_name.endswith('/' + _PACK_INDEX_NAME) or blob_name.endswith('/' + _MANIFEST_NAME)
+
+
+def _read_manifest(blob_service, container_name, manifest_name):
+    """Read the manifest of the deduplicated files uploaded to a remote path, which lists
+    the name, content hash and size of each file.
+    :returns: The manifest, empty if there is none, and its ETag or None.
+    """
+    try:
+        blob = blob_service.get_blob_to_text(container_name, manifest_name)
+    except AzureMissingResourceHttpError:
+        return {'version': _MANIFEST_VERSION, 'files': []}, None
+    manifest = json.loads(blob.content)
+    if manifest.get('version') != _MANIFEST_VERSION:
+        raise ValueError('Unsupported version of manifest {}'.format(manifest_name))
+    return manifest, blob.properties.etag
+
+
+def _read_indexed_files(blob_service, container_name, index_names):
+    """Read the files listed by the pack indexes and manifests of a container.
+    :returns: A list of tuples of the name of each file, the name of the shard in which it
+     is packed or None, the hash of its content in the content container or None, and its size.
+    """
+    files = []
+    for index_name in index_names:
+        if index_name.endswith('/' + _MANIFEST_NAME):
+            manifest, _ = _read_manifest(blob_service, container_name, index_name)
+            files.extend((f[0], None, f[1], f[2]) for f in manifest['files'])
+        else:
+            index, _ = _read_pack_index(blob_service, container_name, index_name)
+            for shard in index['shards']:
+                files.extend((f[0], shard['name'], None, f[1]) for f in shard['files'])
+    return files
+
+
+def _upload_content(source, content_hash, blob_service, max_connections=None):
+    """Upload a file to the content container, named by the hash of its content, unless
+    the same content is already stored.
+    :returns: Whether the file was uploaded.
+    """
+    if blob_service.exists(FileUtils.CONTENT_CONTAINER, content_hash):
+        return False
+    logger.warning('Uploading %s to blob %s in container %s',
+                   source, content_hash, FileUtils.CONTENT_CONTAINER)
+    metadata = {'lastmodified': str(os.path.getmtime(source)), 'sha256': content_hash}
+    _put_blob(source, FileUtils.CONTENT_CONTAINER, content_hash, blob_service, metadata,
+              max_connections)
+    return True
+
+
+def _update_manifest(files, container_name, blob_service, remote_path=None):
+    """Add deduplicated files to the manifest of a remote path, replacing the entries of
+    files of the same name. The manifest is only replaced if it's unchanged since it was
+    read, and is otherwise merged again with the concurrently updated manifest.
+    :param list files: Lists of the blob name, content hash and size of each file.
+    """
+    manifest_name = _get_pack_directory(remote_path) + _MANIFEST_NAME
+    for _ in range(FileUtils.MANIFEST_UPDATE_ATTEMPTS):
+        manifest, etag = _read_manifest(blob_service, container_name, manifest_name)
+        entries = OrderedDict((f[0], f) for f in manifest['files'])
+        entries.update((f[0], list(f)) for f in files)
+        condition = {'if_match': etag} if etag else {'if_none_match': '*'}
+        try:
+            blob_service.create_blob_from_text(
+                container_name, manifest_name,
+                json.dumps({'version': _MANIFEST_VERSION, 'files': sorted(entries.values())}),
+                **condition)
+            return
+        except AzureHttpError as error:
+            # Precondition failed, or the manifest was created since it was read
+            if error.status_code not in (409, 412):
+                raise
+    raise ValueError('Failed to update manifest {}, which is being updated concurrently'.format(
+        manifest_name))
+
+
+def _pack_files(files, pack_directory, shards):
+    """Pack files into tar shards of a bounded size, in temporary files.
+    :param list files: Tuples of the path of each local file and its blob name.
+    :param list shards: The list to which the blob name of each shard and the
+     files packed in it are added, as each shard is completed.
+    :returns: A generator of tuples of the path of each shard and its blob name.
+    """
+    shard = shard_file = path = None
+    packed = []
+
+    def complete_shard():
+        shard.close()
+        shard_file.close()
+        shards.append({'name': '{}{:05d}.tar'.format(pack_directory, len(shards)),
+                       'files': packed})
+        return path, shards[-1]['name']
+
+    try:
+        for source, blob_name in files:
+            if shard is None:
+                handle, path = tempfile.mkstemp(suffix='.tar')
+                shard_file = os.fdopen(handle, 'wb')
+                shard = tarfile.open(fileobj=shard_file, mode='w')
+                packed = []
+            stat = os.stat(source)
+            shard.add(source, arcname=blob_name)
+            packed.append([blob_name, stat.st_size, stat.st_mtime])
+            if shard_file.tell() >= FileUtils.PACK_SHARD_SIZE:
+                completed = complete_shard()
+                shard = None
+                yield completed
+        if shard is not None:
+            completed = complete_shard()
+            shard = None
+            yield completed
+    except BaseException:
+        # Remove the incomplete shard, e.g. if a file can't be read
+        if shard is not None:
+            shard_file.close()
+            os.remove(path)
+        raise
+
+
+def _merge_pack_index(previous, shards):
+    """Merge newly uploaded shards into the index of the packs previously uploaded to
+    the same remote path. The entries of files packed again are replaced.
+    :param dict previous: The previous index.
+    :param list shards: The new shards and the files packed in them.
+    :returns: The shards of the merged index, and the names of the previous shards
+     which no longer contain any indexed files.
+    """
+    names = set(f[0] for shard in shards for f in shard['files'])
+    merged = []
+    superseded = []
+    for shard in previous['shards']:
+        remaining = [f for f in shard['files'] if f[0] not in names]
+        if remaining:
+            merged.append({'name': shard['name'], 'files': remaining})
+        else:
+            superseded.append(shard['name'])
+    return merged + shards, superseded
+
+
+def _upload_pack(files, container_name, blob_service,  # pylint: disable=too-many-locals
+                 remote_path=None, max_connections=None):
+    """Upload small files packed into tar shards, followed by an index of the files in
+    each shard. The files are added to the index of the packs previously uploaded to the
+    same remote path, replacing the entries of files of the same name, and aren't uploaded
+    again if they are unchanged. The previous shards left with no indexed files are deleted
+    once the new index is uploaded.
+    :param list files: Tuples of the path of each local file and its blob name.
+    """
+    pack_directory = _get_pack_directory(remote_path)
+    index_name = pack_directory + _PACK_INDEX_NAME
+    previous, etag = _read_pack_index(blob_service, container_name, index_name)
+    indexed = set(tuple(f) for shard in previous['shards'] for f in shard['files'])
+    if all((b, os.path.getsize(s), os.path.getmtime(s)) in indexed for s, b in files):
+        logger.warning('%d packed files already exist and up-to-date - skipping', len(files))
+        return
+
+    logger.warning('Packing %d files into container %s', len(files), container_name)
+    # The shards of each pack are uploaded to a directory of their own, so that the shards
+    # referenced by the previous index, which running tasks may be reading, are unchanged
+    # until they are deleted after the new index replaces it.
+    shard_directory = '{}{}/'.format(pack_directory, uuid.uuid4().hex)
+    shards = []
+    shard_paths = []
+    uploaded = []
+
+    def upload(path, shard_name, max_connections):
+        blob_service.create_blob_from_path(
+            container_name=container_name,
+            blob_name=shard_name,
+            file_path=path,
+            validate_content=True,
+            max_connections=max_connections)
+        uploaded.append(shard_name)
+        os.remove(path)
+
+    def get_connections(path, _):
+        return _get_block_connections(os.path.getsize(path), blob_service)
+
+    def pack_files():
+        for path, shard_name in _pack_files(files, shard_directory, shards):
+            shard_paths.append(path)
+            yield path, shard_name
+
+    try:
+        _run_transfers(upload, pack_files(), get_connections, max_connections)
+        # The index is uploaded last, so that only complete packs are referenced. It's only
+        # replaced if it's unchanged since it was read, and is otherwise merged again with
+        # the concurrently updated index.
+        for _ in range(FileUtils.MANIFEST_UPDATE_ATTEMPTS):
+            merged, superseded = _merge_pack_index(previous, shards)
+            condition = {'if_match': etag} if etag else {'if_none_match': '*'}
+            try:
+                blob_service.create_blob_from_text(
+                    container_name, index_name,
+                    json.dumps({'version': _PACK_INDEX_VERSION, 'shards': merged}),
+                    **condition)
+                break
+            except AzureHttpError as error:
+                # Precondition failed, or the index was created since it was read
+                if error.status_code not in (409, 412):
+                    raise
+            previous, etag = _read_pack_index(blob_service, container_name, index_name)
+        else:
+            raise ValueError('Failed to update pack index {}, which is being updated '
+                             'concurrently'.format(index_name))
+    except Exception:
+        # Remove the shards of the incomplete pack, which no index references
+        for shard_name in uploaded:
+            try:
+                blob_service.delete_blob(container_name, shard_name)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.debug('Unable to delete shard %s: %s', shard_name, error)
+        raise
+    finally:
+        for path in shard_paths:
+            if os.path.isfile(path):
+                os.remove(path)
+    for shard_name in superseded:
+        try:
+            blob_service.delete_blob(container_name, shard_name)
+        except AzureMissingResourceHttpError:
+            pass  # Deleted by a concurrent upload of another pack
+
+
+def upload_blobs(files, destination, blob_service,  # pylint: disable=too-many-arguments,too-many-locals
+                 remote_path=None, flatten=None, max_connections=None, manifest=None,
+                 compress=False, pack=False, dedup=False):
+    """Upload files to the specified container concurrently.
+    :param files: An iterable of tuples of the path of each local file and its name in the
+     file group, which is consumed as the files are uploaded.
+    :param str destination: The name of the file group.
+    :param int max_connections: The maximum number of concurrent connections.
+    :param SyncManifest manifest: If supplied, only files whose content differs are uploaded.
+    :param bool compress: Whether to upload the files compressed with gzip.
+    :param bool pack: Whether to pack small files into tar shards, uploaded after the
+     other files.
+    :param bool dedup: Whether to store the content of the files once in the content
+     container shared by file groups, listing them in a manifest of the remote path.
+    """
+    if dedup and compress:
+        raise ValueError('Deduplicated files can\'t be compressed.')
+    # Create the container once, and find the files already uploaded from listings of
+    # each directory rather than per file
+    container_name = _get_container_name(destination)
+    uploaded_metadata = {}
+    if not blob_service.create_container(container_name):
+        uploaded_metadata = _UploadedMetadata(container_name, blob_service)
+
+    deduplicated = []
+    listed = {}
+    if dedup:
+        blob_service.create_container(FileUtils.CONTENT_CONTAINER)
+        listed, _ = _read_manifest(blob_service, container_name,
+                                   _get_pack_directory(remote_path) + _MANIFEST_NAME)
+        listed = dict((f[0], f[1]) for f in listed['files'])
+
+    # The content being uploaded, so that identical files uploaded concurrently are only
+    # stored once
+    storing = {}
+    storing_lock = threading.Lock()
+
+    def upload_deduplicated(source, blob_name, max_connections):
+        content_hash = manifest.get_content_hash(source) if manifest else hash_file(source)
+        # A file uploaded separately takes precedence over a deduplicated file
+        separate = uploaded_metadata.get(blob_name) is not None
+        if listed.get(blob_name) == content_hash and not separate:
+            logger.warning('File \'%s\' already exists and up-to-date - skipping', blob_name)
+            return
+        with storing_lock:
+            stored = storing.get(content_hash)
+            if stored is None:
+                storing[content_hash] = threading.Event()
+        if stored is not None:
+            # If the other upload fails, the manifest isn't updated
+            stored.wait()
+            logger.warning('Content of %s already exists - adding it to the manifest', source)
+        else:
+            try:
+                if not _upload_content(source, content_hash, blob_service, max_connections):
+                    logger.warning('Content of %s already exists - adding it to the manifest',
+                                   source)
+            finally:
+                storing[content_hash].set()
+        deduplicated.append(([blob_name, content_hash, os.path.getsize(source)], separate))
+
+    def upload(source, file_name, max_connections):
+        if dedup:
+            upload_deduplicated(source, _get_blob_name(file_name, remote_path, flatten),
+                                max_connections)
+            return
+        upload_blob(source, destination, file_name, blob_service,
+                    remote_path=remote_path, flatten=flatten, max_connections=max_connections,
+                    uploaded_metadata=uploaded_metadata, manifest=manifest, compress=compress)
+
+    def get_connections(source, _):
+        size = os.path.getsize(source) if os.path.isfile(source) else 0
+        return _get_block_connections(size, blob_service)
+
+    packed = []
+    superseded = []
+
+    def unpacked_files():
+        for source, file_name in files:
+            if os.path.isfile(source) and \
+                    os.path.getsize(source) < FileUtils.MAX_PACKED_FILE_SIZE:
+                blob_name = _get_blob_name(file_name, remote_path, flatten)
+                packed.append((source, blob_name))
+                # A file uploaded separately takes precedence over a packed file
+                if uploaded_metadata.get(blob_name) is not None:
+                    superseded.append(blob_name)
+            else:
+                yield source, file_name
+
+    _run_transfers(upload, unpacked_files() if pack else files, get_connections,
+                   max_connections)
+    if deduplicated:
+        _update_manifest([f for f, _ in deduplicated], container_name, blob_service,
+                         remote_path=remote_path)
+        # Remove the blobs uploaded separately which the deduplicated files replace
+        for entry, separate in deduplicated:
+            if separate:
+                blob_service.delete_blob(container_name, entry[0])
+    if packed:
+        _upload_pack(packed, container_name, blob_service, remote_path=remote_path,
+                     max_connections=max_connections)
+        # Remove the blobs uploaded separately which the packed files replace
+        for blob_name in superseded:
+            blob_service.delete_blob(container_name, blob_name)
+
+
+def _download_packed_files(shard, files, file_group, blob_service, max_connections=None):
+    """Download the shard of a pack to a temporary file, and extract packed files from it.
+    :param list files: Tuples of the name of each packed file and its local path.
+    """
+    handle, path = tempfile.mkstemp(suffix='.tar')
+    os.close(handle)
+    try:
+        download_blob(shard, file_group, path, blob_service, max_connections=max_connections)
+        with tarfile.open(path) as archive:
+            for name, destination in files:
+                try:
+                    packed_file = archive.extractfile(name)
+                except KeyError:
+                    raise ValueError('Packed file {} not found in shard {}'.format(name, shard))
+                try:
+                    with open(destination, 'wb') as local_file:
+                        shutil.copyfileobj(packed_file, local_file)
+                except Exception:
+                    if os.path.isfile(destination):
+                        os.remove(destination)
+                    raise
+    finally:
+        os.remove(path)
+
+
+def download_blobs(blobs, file_group, blob_service, max_connections=None):
+    """Download blobs from the specified container concurrently. The files packed in the
+    same shard are extracted from a single download of the shard.
+    :param list blobs: Tuples of each blob, as listed from the container, and its local path.
+    :param str file_group: The name of the file group.
+    :param int max_connections: The maximum number of concurrent connections.
+    """
+    transfers = []
+    packed = {}
+    for blob, destination in blobs:
+        if isinstance(blob, _PackedBlob):
+            if blob.shard not in packed:
+                packed[blob.shard] = []
+                transfers.append((blob, packed[blob.shard]))
+            packed[blob.shard].append((blob.name, destination))
+        else:
+            transfers.append((blob, destination))
+
+    def download(blob, destination, max_connections):
+        if isinstance(blob, _PackedBlob):
+            _download_packed_files(blob.shard, destination, file_group, blob_service,
+                                   max_connections=max_connections)
+        elif isinstance(blob, _ContentBlob):
+            download_blob(blob.content_hash, file_group, destination, blob_service,
+                          size=blob.properties.content_length, max_connections=max_connections,
+                          container_name=FileUtils.CONTENT_CONTAINER)
+        elif _get_content_encoding(blob):
+            # The HTTP client decompresses the content of a blob with a gzip Content-Encoding,
+            # which can't be done for separate ranges, so it's downloaded in a single request
+            # by a client whose first request isn't limited to a range of the blob.
+            single_get_service = copy.copy(blob_service)
+            single_get_service.MAX_SINGLE_GET_SIZE = max(
+                blob_service.MAX_SINGLE_GET_SIZE, (blob.properties.content_length or 0) + 1)
+            download_blob(blob.name, file_group, destination, single_get_service,
+                          max_connections=1)
+        else:
+            download_blob(blob.name, file_group, destination, blob_service,
+                          size=blob.properties.content_length, max_connections=max_connections)
+
+    def get_connections(blob, _):
+        if isinstance(blob, _PackedBlob) or _get_content_encoding(blob):
+            return 1
+        return _get_range_connections(blob.properties.content_length or 0, blob_service)
+
+    _run_transfers(download, transfers, get_connections, max_connections)
 
 
 class FileUtils(object):
@@ -222,13 +1291,52 @@ class FileUtils(object):
     GROUP_PREFIX = 'fgrp-'
     MAX_GROUP_LENGTH = 63 - len(GROUP_PREFIX)
     MAX_FILE_SIZE = 50000 * 4 * 1024 * 1024
-    PARALLEL_OPERATION_THREAD_COUNT = 5
+    PARALLEL_OPERATION_THREAD_COUNT = 5  # Initial connections, then tuned from the throughput
+    MAX_TRANSFER_CONNECTION_COUNT = 64
+    MAX_BLOCK_SIZE = 32 * 1024 * 1024  # Bounds the memory used by the blocks being uploaded
+    HASH_CHUNK_SIZE = 4 * 1024 * 1024
+    BLOCK_HASH_THREAD_COUNT = 2  # Threads hashing the blocks of a file ahead of their upload
+    COMPRESSION_LEVEL = 6  # The gzip command's default, much faster than the maximum of 9
+    MTIME_RESOLUTION = 2  # Seconds, the coarsest common file system timestamp resolution
+    MAX_LISTED_DIRECTORIES = 16  # Directory listings kept to find blobs already uploaded
     SAS_EXPIRY_DAYS = 7  # 7 days
     ROUND_DATE = 2 * 60 * 1000  # Round to nearest 2 minutes
+    MAX_PREFIX_LISTINGS = 10  # Prefix listings of a container before listing all of it
+    PARALLEL_LISTING_THREAD_COUNT = 10
+    # Suffix of compressed resource files, which are found by it to be decompressed on the node
+    COMPRESSED_RESOURCE_SUFFIX = '.fgrp.gz'
+    PACK_DIRECTORY = '.packs/'  # Virtual directory of packed files and of manifests
+    MAX_PACKED_FILE_SIZE = 1024 * 1024  # Smaller files are packed by upload --pack
+    PACK_SHARD_SIZE = 32 * 1024 * 1024
+    # Stores the content of deduplicated files, which isn't a valid file group container name
+    CONTENT_CONTAINER = 'fgrpcontent'
+    MANIFEST_UPDATE_ATTEMPTS = 5
 
     def __init__(self, client, account_name, resource_group_name, account_endpoint):
         self.resource_file_cache = {}
+        self.resource_file_prefix_cache = {}
+        self.container_sas_cache = {}
+        # Guards the caches above, which are shared by concurrent listings
+        self.cache_lock = threading.Lock()
+        # The packed and deduplicated files of each container, listed once for any prefix.
+        # The lock only guards the cache, not the listings.
+        self.pack_cache = {}
+        self.pack_lock = threading.Lock()
         self.resolved_storage_client = None
+        self.storage_key_cached = False
+        # The auto-storage account is cached across invocations for this many seconds
+        self.account_cache, self.account_cache_ttl = get_account_cache()
+        # The key of the auto-storage account is only cached, in plain text, if enabled
+        self.storage_key_cache_ttl = az_config.getint('batch', 'storage_key_cache_ttl', 0)
+        # Whether blobs in a file group are referenced with a single read SAS for the container
+        self.use_container_sas = az_config.getboolean('batch', 'container_sas', False)
+        # Container listings are cached across invocations for this many seconds, if enabled
+        self.listing_cache_ttl = az_config.getint('batch', 'listing_cache_ttl', 0)
+        listing_cache_size = 0
+        if self.listing_cache_ttl > 0:
+            listing_cache_size = az_config.getint(
+                'batch', 'listing_cache_size', _LISTING_CACHE_DEFAULT_SIZE_MB) * 1024 * 1024
+        self.listing_cache = FileCache('listings', listing_cache_size)
         self.batch_mgmt_client = client
         self.batch_account_name = account_name
         if not self.batch_account_name:
@@ -240,36 +1348,214 @@ class FileUtils(object):
 
     def filter_resource_cache(self, container, prefix):
         """Return all blob refeferences in a container cache that meet a prefix requirement."""
-        filtered = []
-        for blob in self.resource_file_cache[container]:
-            if not prefix:
-                filtered.append(blob)
-            elif blob['filePath'].startswith(prefix):
-                filtered.append(blob)
-        return filtered
+        return _filter_sorted_references(self.resource_file_cache[container], prefix)
+
+    def get_container_read_sas(self, container, blob_service):
+        """Get a read-only SAS token for a container, generated once per invocation."""
+        with self.cache_lock:
+            try:
+                return self.container_sas_cache[container]
+            except KeyError:
+                start, expiry = _get_sas_validity()
+                sas_token = blob_service.generate_container_shared_access_signature(
+                    container,
+                    permission=BlobPermissions.READ,
+                    start=start,
+                    expiry=expiry)
+                self.container_sas_cache[container] = sas_token
+                return sas_token
+
+    def _list_blobs(self, container, blob_service, prefix=None):
+        """List the names and content encodings of the blobs in a container, the files
+        packed in shards with the name of their shard, and the deduplicated files with the
+        hash of their content, using the listing cache if the cached listing is within its
+        TTL and the container ETag is unchanged."""
+        def list_blobs():
+            blobs = []
+            index_names = []
+            for blob in blob_service.list_blobs(container, prefix=prefix):
+                if not blob.name.startswith(self.PACK_DIRECTORY):
+                    blobs.append([blob.name, _get_content_encoding(blob), None, None])
+                elif _is_index_name(blob.name):
+                    index_names.append(blob.name)
+            if prefix and not self.PACK_DIRECTORY.startswith(prefix):
+                # The pack directory isn't within the prefix, but its files may be
+                index_names = None
+            # Files uploaded separately take precedence over packed and deduplicated files
+            names = set(b[0] for b in blobs)
+            blobs.extend([name, None, shard, content_hash] for name, shard, content_hash, _ in
+                         self._list_indexed_files(container, blob_service, index_names)
+                         if (not prefix or name.startswith(prefix)) and name not in names)
+            return blobs
+
+        if self.listing_cache_ttl <= 0:
+            return list_blobs()
+        key = hash_content(_LISTING_CACHE_VERSION, blob_service.account_name,
+                           container, prefix or '')
+        try:
+            etag = blob_service.get_container_properties(container).properties.etag
+        except Exception as error:  # pylint: disable=broad-except
+            # E.g. a container SAS does not grant access to the container properties
+            logger.debug("Unable to get properties of container '%s': %s", container, error)
+            etag = None
+        if etag:
+            cached = self.listing_cache.get(key)
+            if cached and cached.get('etag') == etag and \
+                    0 <= time.time() - cached.get('time', 0) < self.listing_cache_ttl:
+                return cached['blobs']
+        blobs = list_blobs()
+        if etag:
+            self.listing_cache.set(key, {'etag': etag, 'time': time.time(), 'blobs': blobs})
+        return blobs
+
+    def _list_indexed_files(self, container, blob_service, index_names=None):
+        """List the packed and deduplicated files of a container, once per container.
+        :param list index_names: The names of the pack indexes and manifests in the
+         container, if known.
+        :returns: A list of tuples as returned by _read_indexed_files.
+        """
+        def list_indexed_files():
+            names = index_names
+            if names is None:
+                names = [b.name for b in blob_service.list_blobs(
+                    container, prefix=self.PACK_DIRECTORY) if _is_index_name(b.name)]
+            return _read_indexed_files(blob_service, container, names)
+
+        return _get_listing(self.pack_cache, self.pack_lock, container, list_indexed_files)
+
+    def _list_blob_references(self, source, container, blob_service, prefix=None):
+        """List blob references in container, sorted by blob path."""
+        blobs = self._list_blobs(container, blob_service, prefix)
+        container_sas = None
+        if 'fileGroup' in source and self.use_container_sas:
+            container_sas = self.get_container_read_sas(container, blob_service)
+        start, expiry = _get_sas_validity()
+        references = []
+        shard_urls = {}
+        content_urls = {}
+        for name, content_encoding, shard, content_hash in blobs:
+            # A packed file is referenced by the URL of its shard
+            blob = Blob(shard or name)
+            if shard in shard_urls:
+                blob_sas = shard_urls[shard]
+            elif content_hash:
+                # A deduplicated file is referenced by the URL of its content, with a SAS
+                # for the blob, as the content container is shared with other file groups
+                if 'fileGroup' not in source:
+                    raise ValueError('Deduplicated file {} can only be referenced from its '
+                                     'file group.'.format(name))
+                if content_hash not in content_urls:
+                    content_urls[content_hash] = _generate_blob_sas_token(
+                        Blob(content_hash), self.CONTENT_CONTAINER, blob_service,
+                        start=start, expiry=expiry)
+                blob_sas = content_urls[content_hash]
+            elif container_sas:
+                blob_sas = blob_service.make_blob_url(
+                    container, quote(blob.name), sas_token=container_sas)
+            elif 'fileGroup' in source:
+                blob_sas = _generate_blob_sas_token(
+                    blob, container, blob_service, start=start, expiry=expiry)
+            else:
+                blob_sas = construct_sas_url(blob, urlsplit(source['containerUrl']))
+            file_name = os.path.basename(name)
+            file_name_only = os.path.splitext(file_name)[0]
+            reference = {'url': blob_sas,
+                         'filePath': name,
+                         'fileName': file_name,
+                         'fileNameWithoutExtension': file_name_only}
+            if content_encoding:
+                reference['contentEncoding'] = content_encoding
+            if shard:
+                shard_urls[shard] = blob_sas
+                reference['pack'] = shard
+            references.append(reference)
+        references.sort(key=itemgetter('filePath'))
+        return [r['filePath'] for r in references], references
+
+    def _find_listing(self, container, prefix):
+        """Find a cached listing containing the blobs with a prefix. If there is none,
+        return the prefix that should be listed, or None to list the whole container.
+        Must be called holding the cache lock.
+        """
+        if container in self.resource_file_cache:
+            return self.resource_file_cache[container], None
+        prefix_listings = self.resource_file_prefix_cache.get(container, {})
+        if prefix:
+            # A listing of a shorter prefix already contains every blob with this prefix
+            for listed_prefix, listing in prefix_listings.items():
+                if prefix.startswith(listed_prefix):
+                    return listing, None
+            if len(prefix_listings) < self.MAX_PREFIX_LISTINGS:
+                return None, prefix
+        # Either all blobs are referenced or enough prefixes have been listed separately
+        # that a single listing of the whole container is cheaper.
+        return None, None
 
     def list_container_contents(self, source, container, blob_service):
         """List blob references in container."""
-        if container not in self.resource_file_cache:
-            self.resource_file_cache[container] = []
-            blobs = blob_service.list_blobs(container)
-            for blob in blobs:
-                blob_sas = _generate_blob_sas_token(blob, container, blob_service) \
-                    if 'fileGroup' in source else \
-                    construct_sas_url(blob, urlsplit(source['containerUrl']))
-                file_name = os.path.basename(blob.name)
-                file_name_only = os.path.splitext(file_name)[0]
-                self.resource_file_cache[container].append(
-                    {'url': blob_sas,
-                     'filePath': blob.name,
-                     'fileName': file_name,
-                     'fileNameWithoutExtension': file_name_only})
-        return self.filter_resource_cache(container, source.get('prefix'))
+        prefix = source.get('prefix')
+        with self.cache_lock:
+            listing, list_prefix = self._find_listing(container, prefix)
+        if listing is None:
+            listing = self._list_blob_references(source, container, blob_service, list_prefix)
+            with self.cache_lock:
+                if list_prefix:
+                    self.resource_file_prefix_cache.setdefault(container, {})[list_prefix] = \
+                        listing
+                else:
+                    self.resource_file_cache[container] = listing
+                    self.resource_file_prefix_cache.pop(container, None)
+        return _filter_sorted_references(listing, prefix)
+
+    def prefetch_container_lists(self, sources):
+        """List the containers referenced by a collection of sources concurrently,
+        so that later references are resolved from the cache. Listings that fail are
+        skipped, leaving the error to be reported when the source is resolved.
+        :param list sources: The fileGroup or containerUrl sources of resource files.
+        """
+        prefixes = {}
+        for source in sources:
+            try:
+                if 'fileGroup' in source:
+                    key = ('fileGroup', source['fileGroup'])
+                else:
+                    key = ('containerUrl', source['containerUrl'])
+            except (KeyError, TypeError):
+                continue
+            prefixes.setdefault(key, set()).add(source.get('prefix') or None)
+        listings = []
+        for (source_type, name), container_prefixes in prefixes.items():
+            if None in container_prefixes or len(container_prefixes) > self.MAX_PREFIX_LISTINGS:
+                listings.append({source_type: name})
+                continue
+            listed = []
+            for prefix in sorted(container_prefixes):
+                # Skip prefixes contained in the listing of a shorter prefix
+                if not any(prefix.startswith(p) for p in listed):
+                    listed.append(prefix)
+                    listings.append({source_type: name, 'prefix': prefix})
+        if not listings:
+            return
+
+        def list_source(source):
+            try:
+                self.get_container_list(source)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.debug("Unable to list contents of %s: %s", source, error)
+
+        if any('fileGroup' in s for s in listings):
+            try:
+                self.resolve_storage_account()
+            except (ValueError, CloudError) as error:
+                logger.debug("Unable to resolve storage account: %s", error)
+                return
+        with ThreadPoolExecutor(max_workers=self.PARALLEL_LISTING_THREAD_COUNT) as executor:
+            list(executor.map(list_source, listings))
 
     def get_container_sas(self, file_group_name):
-        storage_client = self.resolve_storage_account()
         container = _get_container_name(file_group_name)
-        return _generate_container_sas_token(container, storage_client)
+        return self.storage_operation(
+            lambda client: _generate_container_sas_token(container, client))
 
     def get_container_list(self, source):
         """List blob references in container."""
@@ -278,8 +1564,9 @@ class FileUtils(object):
 
         if 'fileGroup' in source:
             # Input data stored in auto-storage
-            storage_client = self.resolve_storage_account()
             container = _get_container_name(source['fileGroup'])
+            return self.storage_operation(
+                lambda client: self.list_container_contents(source, container, client))
         elif 'containerUrl' in source:
             uri = urlsplit(source['containerUrl'])
             if not uri.query:
@@ -314,7 +1601,8 @@ class FileUtils(object):
         if 'fileGroup' in resource_file['source']:
             # Input data stored in auto-storage
             container = _get_container_name(resource_file['source']['fileGroup'])
-            blobs = self.list_container_contents(resource_file['source'], container, storage_client)
+            blobs = self.storage_operation(lambda client: self.list_container_contents(
+                resource_file['source'], container, client))
             return convert_blobs_to_resource_files(blobs, resource_file)
         elif 'containerUrl' in resource_file['source']:
             # Input data storage in arbitrary container
@@ -328,21 +1616,21 @@ class FileUtils(object):
         else:
             raise ValueError('Malformed ResourceFile')
 
-    def resolve_storage_account(self):
-        """Resolve Auto-Storage account from supplied Batch Account"""
-        if self.resolved_storage_client:
-            return self.resolved_storage_client
-
-        if not self.batch_account_name:
-            raise ValueError('No Batch account name specified')
-
-        client = self.batch_mgmt_client if self.batch_mgmt_client else \
+    def _get_batch_account_client(self):
+        return self.batch_mgmt_client if self.batch_mgmt_client else \
             get_mgmt_service_client(BatchManagementClient).batch_account
 
+    def _account_cache_key(self, client):
+        return hash_content(_ACCOUNT_CACHE_VERSION, client.config.subscription_id,
+                            self.batch_account_name, self.batch_resource_group or '',
+                            self.batch_account_endpoint or '')
+
+    def _get_batch_account(self, client, resource_group):
+        """Get the Batch account, by resource group if known, otherwise by region."""
         if self.batch_resource_group:
             # If a resource group was supplied, we can use that to query the Batch Account
             try:
-                account = client.get(self.batch_resource_group, self.batch_account_name)
+                return client.get(self.batch_resource_group, self.batch_account_name)
             except CloudError:
                 raise ValueError('Couldn\'t find the account named {} in subscription {} '
                                  'with resource group {}'.format(
@@ -350,6 +1638,13 @@ class FileUtils(object):
                                      client.config.subscription_id,
                                      self.batch_resource_group))
         elif self.batch_account_endpoint:
+            if resource_group:
+                # The resource group of the account was cached by an earlier lookup
+                try:
+                    return client.get(resource_group, self.batch_account_name)
+                except CloudError as error:
+                    logger.debug("Cached resource group of account '%s' is out of date: %s",
+                                 self.batch_account_name, error)
             # Otherwise, we need to parse the URL for a region in order to identify
             # the Batch account in the subscription
             # Example URL: https://batchaccount.westus.batch.azure.com
@@ -357,7 +1652,7 @@ class FileUtils(object):
             accounts = [x for x in client.list()
                         if x.name == self.batch_account_name and x.location == region]
             try:
-                account = accounts[0]
+                return accounts[0]
             except IndexError:
                 raise ValueError('Couldn\'t find the account named {} in subscription {} '
                                  'in region {}'.format(
@@ -367,18 +1662,81 @@ class FileUtils(object):
             raise ValueError("Insufficient account information. Please supply the account "
                              "name and resource group, or log in to the account with the "
                              "'az batch account login' command.")
-        if not account.auto_storage:  # pylint: disable=no-member
-            raise ValueError('No linked auto-storage for account {}'
-                             .format(self.batch_account_name))  # pylint: disable=no-member
 
-        storage_account_info = account.auto_storage.storage_account_id.split('/')  # pylint: disable=no-member
-        storage_resource_group = storage_account_info[4]
-        storage_account = storage_account_info[8]
+    def resolve_storage_account(self):
+        """Resolve Auto-Storage account from supplied Batch Account"""
+        if self.resolved_storage_client:
+            return self.resolved_storage_client
+
+        if not self.batch_account_name:
+            raise ValueError('No Batch account name specified')
 
-        storage_client = get_mgmt_service_client(StorageManagementClient)
-        keys = storage_client.storage_accounts.list_keys(storage_resource_group, storage_account)
-        storage_key = keys.keys[0].value  # pylint: disable=no-member
+        client = self._get_batch_account_client()
+        cache_key = self._account_cache_key(client)
+        cached = self.account_cache.get(cache_key) or {}
+        now = time.time()
+        if cached.get('storageKey') and \
+                0 <= now - cached.get('keyTime', 0) < self.storage_key_cache_ttl:
+            storage_account_id = cached['storageAccountId']
+            storage_key = cached['storageKey']
+            self.storage_key_cached = True
+        else:
+            if cached.get('storageAccountId') and \
+                    0 <= now - cached.get('time', 0) < self.account_cache_ttl:
+                storage_account_id = cached['storageAccountId']
+            else:
+                account = self._get_batch_account(client, cached.get('resourceGroup'))
+                if not account.auto_storage:  # pylint: disable=no-member
+                    raise ValueError('No linked auto-storage for account {}'
+                                     .format(self.batch_account_name))  # pylint: disable=no-member
+                storage_account_id = account.auto_storage.storage_account_id  # pylint: disable=no-member
+                cached = {'resourceGroup': account.id.split('/')[4],
+                          'storageAccountId': storage_account_id,
+                          'time': now}
+            storage_account_info = storage_account_id.split('/')
+            storage_client = get_mgmt_service_client(StorageManagementClient)
+            keys = storage_client.storage_accounts.list_keys(storage_account_info[4],
+                                                             storage_account_info[8])
+            storage_key = keys.keys[0].value  # pylint: disable=no-member
+            if self.storage_key_cache_ttl > 0:
+                cached.update({'storageKey': storage_key, 'keyTime': now})
+            else:
+                # Also removes any key cached while key caching was enabled
+                cached.pop('storageKey', None)
+                cached.pop('keyTime', None)
+            self.account_cache.set(cache_key, cached)
+            self.storage_key_cached = False
 
+        storage_account = storage_account_id.split('/')[8]
         self.resolved_storage_client = CloudStorageAccount(storage_account, storage_key)\
             .create_block_blob_service()
         return self.resolved_storage_client
+
+    def invalidate_storage_account(self):
+        """Discard the resolved storage account, including any cached key."""
+        self.resolved_storage_client = None
+        self.storage_key_cached = False
+        if self.batch_account_name:
+            # Keep the resource group of the account, which is not affected, but look up
+            # its auto-storage account again in case it has changed
+            cache_key = self._account_cache_key(self._get_batch_account_client())
+            cached = self.account_cache.get(cache_key)
+            if cached:
+                for key in ['storageAccountId', 'storageKey', 'keyTime']:
+                    cached.pop(key, None)
+                self.account_cache.set(cache_key, cached)
+
+    def storage_operation(self, operation):
+        """Run an operation against the auto-storage account. If the operation is
+        rejected using a cached key, the key may have been regenerated, so the
+        storage account is resolved again and the operation retried.
+        :param func operation: A function taking the storage client.
+        """
+        try:
+            return operation(self.resolve_storage_account())
+        except AzureHttpError as error:
+            if error.status_code != 403 or not self.storage_key_cached:
+                raise
+            logger.debug('Cached storage account key was rejected: %s', error)
+            self.invalidate_storage_account()
+            return operation(self.resolve_storage_account())
@@ -42,6 +42,11 @@ helps['batch file upload'] = """
     short-summary: Upload a specified file or directory of files to the specified storage path.
 """
 
+helps['batch file sync'] = """
+    type: command
+    short-summary: Upload the files in a specified file or directory whose content differs from the files in the specified storage path.
+"""
+
 helps['batch file download'] = """
     type: command
     short-summary: Download a specified file or directory of files to the specified storage path.
@@ -3,41 +3,225 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 # --------------------------------------------------------------------------------------------
 
+import json
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from msrest.exceptions import ValidationError, ClientRequestError
-from azure.batch.models import BatchErrorException
+from azure.batch.models import BatchErrorException, TaskAddStatus
 from azure.cli.core._util import CLIError
 
 # pylint: disable=too-few-public-methods
 
+MAX_TASKS_COUNT_IN_BATCH = 100
+MAX_TASKS_SIZE_IN_BATCH = 1024 * 1024  # The service limit on the request body in bytes
+TASK_COLLECTION_OVERHEAD = 1024  # Allowance for the request body wrapping the tasks
+PARALLEL_TASK_SUBMISSION_COUNT = 5
+MAX_TASK_ADD_RETRIES = 5
+RETRY_BASE_DELAY = 1  # seconds
+RETRY_MAX_DELAY = 30  # seconds
+# Error codes for which an add task request may succeed if resubmitted.
+RETRYABLE_ERROR_CODES = {
+    'ServerBusy',
+    'OperationTimedOut',
+    'InternalError'}
+
+
+def _format_batch_error(error):
+    message = error.message.value
+    if error.values:
+        for detail in error.values:
+            message += "\n{}: {}".format(detail.key, detail.value)
+    return message
+
 
 def _handle_batch_exception(action):
     try:
         return action()
     except BatchErrorException as ex:
         try:
-            message = ex.error.message.value
-            if ex.error.values:
-                for detail in ex.error.values:
-                    message += "\n{}: {}".format(detail.key, detail.value)
-            raise CLIError(message)
+            raise CLIError(_format_batch_error(ex.error))
         except AttributeError:
             raise CLIError(ex)
     except (ValidationError, ClientRequestError) as ex:
         raise CLIError(ex)
 
 
-def deploy_tasks(client, job_id, tasks):
-    MAX_TASKS_COUNT_IN_BATCH = 100
+def _retry_delay(attempt):
+    """Exponential backoff with full jitter.
+    :param int attempt: The number of the retry about to be made, starting at 1.
+    :returns: The number of seconds to wait.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def _is_retryable_request_error(error):
+    try:
+        return error.error.code in RETRYABLE_ERROR_CODES
+    except AttributeError:
+        return False
+
+
+def _add_task_collection(client, job_id, tasks):
+    """Add a chunk of tasks, resubmitting only the tasks that failed with a
+    transient error, or the whole chunk if the request failed to complete. Tasks
+    reported as already existing are treated as added, as they may have been
+    created by an earlier attempt.
+    :param client: The Batch service client.
+    :param str job_id: The ID of the job to which the tasks will be added.
+    :param list tasks: A list of TaskAddParameter objects.
+    """
+    attempt = 0
+    while tasks:
+        try:
+            result = client.task.add_collection(job_id, tasks)
+        except BatchErrorException as error:
+            if getattr(error.error, 'code', None) == 'RequestBodyTooLarge' and len(tasks) > 1:
+                # Our size estimate was too low - split the request and try again.
+                middle = len(tasks) // 2
+                _add_task_collection(client, job_id, tasks[:middle])
+                _add_task_collection(client, job_id, tasks[middle:])
+                return
+            if attempt >= MAX_TASK_ADD_RETRIES or not _is_retryable_request_error(error):
+                raise
+            retry = tasks
+        except ClientRequestError:
+            # E.g. the connection was reset or timed out. Any tasks added by the failed
+            # request are reported as already existing when resubmitted.
+            if attempt >= MAX_TASK_ADD_RETRIES:
+                raise
+            retry = tasks
+        else:
+            pending = {t.id: t for t in tasks}
+            retry = []
+            failures = []
+            for task_result in result.value:
+                error = task_result.error
+                code = error.code if error else None
+                if task_result.status == TaskAddStatus.success or code == 'TaskExists':
+                    pass
+                elif task_result.status == TaskAddStatus.server_error \
+                        or code in RETRYABLE_ERROR_CODES:
+                    retry.append(pending[task_result.task_id])
+                else:
+                    failures.append("Task '{}': {}".format(
+                        task_result.task_id, _format_batch_error(error) if error else code))
+            if failures:
+                raise CLIError('\n'.join(failures))
+            if retry and attempt >= MAX_TASK_ADD_RETRIES:
+                raise CLIError("Failed to add task(s) '{}' after {} retries.".format(
+                    ', '.join(t.id for t in retry), MAX_TASK_ADD_RETRIES))
+        tasks = retry
+        if tasks:
+            attempt += 1
+            time.sleep(_retry_delay(attempt))
+
+
+def _get_task_size(task):
+    """Get the serialized size of a task in an add_collection request.
+    :raises ValueError: If the task is too large to be submitted.
+    """
+    # Include the separator between tasks in the array.
+    task_size = len(json.dumps(task)) + 1
+    if task_size > MAX_TASKS_SIZE_IN_BATCH - TASK_COLLECTION_OVERHEAD:
+        raise ValueError("Task '{}' is too large to be submitted ({} bytes).".format(
+            task.get('id'), task_size))
+    return task_size
+
+
+def _get_submission_threads(threads):
+    """Get the number of concurrent add_collection requests, which defaults to
+    PARALLEL_TASK_SUBMISSION_COUNT."""
+    if threads is None:
+        return PARALLEL_TASK_SUBMISSION_COUNT
+    if threads < 1:
+        raise ValueError('The number of task submission threads must be at least 1.')
+    return threads
+
+
+def validate_task_submission(tasks, threads=None):
+    """Validate the submission of tasks before their job is added, so that invalid
+    options or tasks don't leave a job without some of its tasks.
+    :param list tasks: The tasks known before the job is added. Tasks generated as they
+     are submitted are validated as they are generated.
+    :param int threads: The maximum number of concurrent add_collection requests.
+    """
+    _get_submission_threads(threads)
+    for task in tasks:
+        _get_task_size(task)
+
+
+def _chunk_tasks(tasks):
+    """Split a collection of tasks into consecutive add_collection requests,
+    limited by both the number of tasks and their serialized size.
+    :param tasks: An iterable of task specifications.
+    :returns: A generator of task lists.
+    """
+    max_size = MAX_TASKS_SIZE_IN_BATCH - TASK_COLLECTION_OVERHEAD
+    chunk = []
+    chunk_size = 0
+    for task in tasks:
+        task_size = _get_task_size(task)
+        if chunk and chunk_size + task_size > max_size:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(task)
+        chunk_size += task_size
+        if len(chunk) == MAX_TASKS_COUNT_IN_BATCH:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+    if chunk:
+        yield chunk
+
+
+def deploy_tasks(client, job_id, tasks, threads=None):
+    """Submit a collection of tasks to a job, keeping up to the specified number
+    of add_collection requests in flight at once.
+    Chunks are submitted in order, and a chunk containing tasks with dependencies
+    is only submitted once every preceding chunk has been added.
+    Tasks generated lazily are validated as they are submitted, so a task found to be
+    too large leaves the job with the tasks submitted before it. Use
+    `validate_task_submission` to validate the tasks known before the job is added.
+    :param client: The Batch service client.
+    :param str job_id: The ID of the job to which the tasks will be added.
+    :param tasks: An iterable of task specifications.
+    :param int threads: The maximum number of concurrent add_collection requests.
+    """
+    threads = _get_submission_threads(threads)
+
+    def add_task(task_params):
+        _add_task_collection(client, job_id, task_params)
+
+    errors = []
+    pending = deque()
+
+    def wait_for_oldest():
+        try:
+            pending.popleft().result()
+        except CLIError as error:
+            errors.append(str(error))
 
-    def add_task():
-        start = 0
-        while start < len(tasks):
-            end = min(start + MAX_TASKS_COUNT_IN_BATCH, len(tasks))
-            ts = client._deserialize('[TaskAddParameter]', tasks[start:end])  # pylint: disable=protected-access
-            client.task.add_collection(job_id, ts)
-            start = end
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for chunk in _chunk_tasks(tasks):
+            if any(t.get('dependsOn') for t in chunk):
+                # Tasks referenced as dependencies must be added before their dependents.
+                while pending:
+                    wait_for_oldest()
+            elif len(pending) >= threads:
+                wait_for_oldest()
+            if errors:
+                break
+            ts = client._deserialize('[TaskAddParameter]', chunk)  # pylint: disable=protected-access
+            pending.append(executor.submit(_handle_batch_exception, lambda t=ts: add_task(t)))
+        while pending:
+            wait_for_oldest()
 
-    _handle_batch_exception(add_task)
+    if errors:
+        raise CLIError('\n'.join(errors))
 
 
 def get_task_counts(client, job_id):
@@ -45,6 +45,7 @@ register_extra_cli_argument('batch job create', 'account_key', arg_group='Batch
                             help='The Batch account key. Alternatively, set by environment variable: AZURE_BATCH_ACCESS_KEY')
 register_cli_argument('batch job create', 'account_endpoint', arg_group='Batch Account',
                       help='Batch service endpoint. Alternatively, set by environment variable: AZURE_BATCH_ENDPOINT')
+register_cli_argument('batch job create', 'task_submission_threads', type=int, help='The maximum number of concurrent requests used to add the tasks of the job. Defaults to 5.')
 
 register_cli_argument('batch file upload', 'resource_group', resource_group_name_type, completer=None, required=False)
 register_cli_argument('batch file upload', 'account_name', batch_name_type, options_list=('--name', '-n'), required=False)
@@ -52,6 +53,24 @@ register_cli_argument('batch file upload', 'local_path', type=file_type, help='P
 register_cli_argument('batch file upload', 'file_group', help='Name of a file group under which the files will be stored.')
 register_cli_argument('batch file upload', 'remote_path', help='Group subdirectory under which files will be uploaded.')
 register_cli_argument('batch file upload', 'flatten', action='store_true', help='If set, will not retain local directory structure in storage.')
+register_cli_argument('batch file upload', 'max_connections', type=int, help='The maximum number of concurrent connections used to upload files, shared between files and the blocks of large files. By default the number of connections is tuned from the measured throughput, up to 64.')
+register_cli_argument('batch file upload', 'recursive', action='store_true', help='If set, the files in subdirectories of a local directory will also be uploaded.')
+register_cli_argument('batch file upload', 'exclude', nargs='+', help='Space-separated wildcard patterns of local paths to exclude, relative to the local directory.')
+register_cli_argument('batch file upload', 'compress', action='store_true', help='If set, files will be compressed with gzip as they are uploaded, and decompressed on the compute node when referenced as resource files.')
+register_cli_argument('batch file upload', 'pack', action='store_true', help='If set, files smaller than 1 MB will be packed into tar archives, which are extracted on the compute node when the files are referenced as resource files. Replaces the files packed by a previous upload to the same remote path.')
+register_cli_argument('batch file upload', 'dedup', action='store_true', help='If set, the content of each file will be stored once in a container shared by file groups, and the file group will list the file in a manifest. Uploading a file whose content is already stored only updates the manifest.')
+
+register_cli_argument('batch file sync', 'resource_group', resource_group_name_type, completer=None, required=False)
+register_cli_argument('batch file sync', 'account_name', batch_name_type, options_list=('--name', '-n'), required=False)
+register_cli_argument('batch file sync', 'local_path', type=file_type, help='Path to a local file or directory to be synced - can include wildcard patterns.')
+register_cli_argument('batch file sync', 'file_group', help='Name of a file group under which the files will be stored.')
+register_cli_argument('batch file sync', 'remote_path', help='Group subdirectory under which files will be uploaded.')
+register_cli_argument('batch file sync', 'flatten', action='store_true', help='If set, will not retain local directory structure in storage.')
+register_cli_argument('batch file sync', 'max_connections', type=int, help='The maximum number of concurrent connections used to upload files, shared between files and the blocks of large files. By default the number of connections is tuned from the measured throughput, up to 64.')
+register_cli_argument('batch file sync', 'recursive', action='store_true', help='If set, the files in subdirectories of a local directory will also be uploaded.')
+register_cli_argument('batch file sync', 'exclude', nargs='+', help='Space-separated wildcard patterns of local paths to exclude, relative to the local directory.')
+register_cli_argument('batch file sync', 'compress', action='store_true', help='If set, files will be compressed with gzip as they are uploaded, and decompressed on the compute node when referenced as resource files.')
+register_cli_argument('batch file sync', 'dedup', action='store_true', help='If set, the content of each file will be stored once in a container shared by file groups, and the file group will list the file in a manifest. Uploading a file whose content is already stored only updates the manifest.')
 
 register_cli_argument('batch file download', 'resource_group', resource_group_name_type, completer=None, required=False)
 register_cli_argument('batch file download', 'account_name', batch_name_type, options_list=('--name', '-n'), required=False)
@@ -59,3 +78,4 @@ register_cli_argument('batch file download', 'local_path', type=file_type, help=
 register_cli_argument('batch file download', 'file_group', help='Name of a file group under which the files will be download.')
 register_cli_argument('batch file download', 'remote_path', help='The subdirectory under which files exist remotely.')
 register_cli_argument('batch file download', 'overwrite', action='store_true', help='If set, an existing file in the local path will be overwritten.')
+register_cli_argument('batch file download', 'max_connections', type=int, help='The maximum number of concurrent connections used to download files, shared between files and the byte ranges of large files. By default the number of connections is tuned from the measured throughput, up to 64.')
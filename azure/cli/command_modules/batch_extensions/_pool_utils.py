@@ -7,6 +7,10 @@ from enum import Enum
 
 # pylint: disable=too-few-public-methods
 
+# Windows versions without tar, which is included from Windows Server 2019
+_CLOUD_SERVICE_OS_FAMILIES_WITHOUT_TAR = ('2', '3', '4', '5')
+_WINDOWS_SERVER_SKUS_WITHOUT_TAR = ('2008', '2012', '2016')
+
 
 class PoolOperatingSystemFlavor(Enum):
     WINDOWS = 'windows'
@@ -23,3 +27,20 @@ def get_pool_target_os_type(pool):
         if not image_publisher \
         or (image_publisher and image_publisher.find('MicrosoftWindowsServer') >= 0) \
         else PoolOperatingSystemFlavor.LINUX
+
+
+def pool_includes_tar(pool):
+    """Whether the operating system of a pool includes tar. An image that can't be
+    identified, such as a custom image, is assumed to include it.
+    :param dict pool: A pool specification.
+    """
+    if get_pool_target_os_type(pool) == PoolOperatingSystemFlavor.LINUX:
+        return True
+    os_family = (pool.get('cloudServiceConfiguration') or {}).get('osFamily')
+    if os_family:
+        return str(os_family) not in _CLOUD_SERVICE_OS_FAMILIES_WITHOUT_TAR
+    try:
+        sku = pool['virtualMachineConfiguration']['imageReference']['sku']
+    except (KeyError, TypeError):
+        return True
+    return not (sku or '').lower().startswith(_WINDOWS_SERVER_SKUS_WITHOUT_TAR)
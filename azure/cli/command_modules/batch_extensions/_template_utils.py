@@ -7,17 +7,24 @@
 import copy
 import itertools
 import json
+import operator
 import os
 import re
+from functools import reduce
 try:
     from shlex import quote as shell_escape
 except ImportError:
     from pipes import quote as shell_escape
+import six
+from six.moves import range  # pylint: disable=redefined-builtin
 from six.moves.urllib.parse import urljoin  # pylint: disable=import-error
 
 from azure.cli.core.prompting import prompt
+from azure.cli.core._config import az_config
 import azure.cli.core.azlogging as azlogging
+import azure.cli.command_modules.batch_extensions._cache_utils as cache_utils
 import azure.cli.command_modules.batch_extensions._pool_utils as pool_utils
+from azure.cli.command_modules.batch_extensions._file_utils import FileUtils
 
 logger = azlogging.get_az_logger(__name__)
 
@@ -73,6 +80,15 @@ _PROPS_ON_REPEAT_TASK = {
 _PROPS_ON_COLLECTION_TASK = _PROPS_ON_REPEAT_TASK.union({
     'multiInstanceSettings',
     'dependsOn'})
+# Update when the format of the parsed template strings changes, to invalidate cached templates.
+_TEMPLATE_CACHE_VERSION = '1'
+_TEMPLATE_CACHE_DEFAULT_SIZE_MB = 10
+# Placeholders in repeatTask strings for each task factory type.
+_SWEEP_PLACEHOLDER = re.compile(r'\{(\d+)(:(\d+))?\}')
+_FILE_PLACEHOLDER = re.compile(r'\{(url|filePath|fileName|fileNameWithoutExtension)\}')
+# Characters substituted for escaped brackets while placeholders are parsed.
+_LEFT_BRACKET_REPLACE_CHAR = u'\uE800'  # pylint: disable=anomalous-unicode-escape-in-string
+_RIGHT_BRACKET_REPLACE_CHAR = u'\uE801'  # pylint: disable=anomalous-unicode-escape-in-string
 
 
 def _validate_int(value, content):
@@ -139,17 +155,6 @@ def _validate_bool(value):
         raise TypeError()
 
 
-def _is_substitution(content, start, end):
-    """This is to support non-ARM-style direct parameter string substitution as a
-    simplification of the concat function. We may wish to remove this
-    if we want to adhere more strictly to ARM.
-    :param str content: The contents of an expression from the template.
-    :param int start: The start index of the expression.
-    :param int end: The end index of the expression.
-    """
-    return not (content[start - 1] == '"' and content[end + 1] == '"')
-
-
 def _find(delimiter, content, start_index):
     """Given that a string starts at the index specified, scan for the end of that string.
     :param str delimiter: Delimiter for which to search.
@@ -478,220 +483,466 @@ def _get_template_params(template, param_values):
     return param_keys
 
 
-def _parse_arm_parameter(name, template_obj, parameters):
-    """Render the content of an ARM property
-    :param str name: The name of the property to render.
-    :param dict template_obj: The loaded contents of the JSON template.
-    :param dict parameters: The loaded contents of the JSON parameters.
-    """
-    if 'parameters' not in template_obj:
-        raise ValueError("Template defines no parameters but tried to use '{}'".format(name))
-    try:
-        param_def = template_obj['parameters'][name]
-    except KeyError:
-        raise ValueError("Template does not define parameter '{}'".format(name))
-    user_value = param_def.get('defaultValue')
-    if parameters and name in parameters:
-        # Support both ARM and dictionary syntax
-        # ARM: '<PropertyName>' : { 'value' : '<PropertyValue>' }
-        # Dictionary: '<PropertyName>' : <PropertyValue>'
-        user_value = parameters[name]
-        try:
-            user_value = user_value['value']
-        except TypeError:
-            pass
-    if not user_value:
-        raise ValueError("No value supplied for parameter '{}' and no default value".format(name))
-    if isinstance(user_value, dict):
-        # If substitute value is a complex object - it may require
-        # additional parameter substitutions
-        return _parse_template(json.dumps(user_value), template_obj, parameters)
-    if param_def['type'] == 'int':
-        return _validate_int(user_value, param_def)
-    elif param_def['type'] == 'bool':
-        return _validate_bool(user_value)
-    elif param_def['type'] == 'string':
-        return _validate_string(user_value, param_def)
-    else:
-        raise TypeError("Parameter type '{}' not supported.".format(param_def['type']))
-
-
-def _parse_arm_variable(name, template_obj, parameters):
-    """Render the value of an ARM variable.
-    :param str name: The name of the variable to render.
-    :param dict template_obj: The loaded contents of the JSON template.
-    :param dict parameters: The loaded contents of the JSON parameters.
-    """
-    try:
-        variable = _parse_arm_expression(
-            template_obj['variables'][name],
-            template_obj, parameters)
-    except KeyError:
-        raise ValueError("Template contains no definition for variable '{}'".format(name))
-    if isinstance(variable, dict):
-        # If substitute value is a complex object - it may require
-        # additional parameter substitutions
-        return _parse_template(json.dumps(variable), template_obj, parameters)
-    return variable
-
-
-def _parse_arm_concat(expression, template_obj, parameters):
-    """Evaluate an ARM concat expression.
-    :param str expression: The concat expression to evaluate.
-    :param dict template_obj: The loaded contents of the JSON template.
-    :param dict parameters: The loaded contents of the JSON parameters.
+def _parse_arm_concat(expression):
+    """Parse the arguments of an ARM concat expression.
+    :param str expression: The arguments of the concat expression.
+    :returns: A tuple of the parsed arguments.
     """
-    content = ""
+    arguments = []
     index = 0
     while index < len(expression):
         end = _find_nested(',', expression, index)
-        argument = expression[index:end].strip()
-        content += _parse_arm_expression(argument, template_obj, parameters)
+        arguments.append(_parse_arm_expression(expression[index:end].strip()))
         index = end + 1
-    return content
+    return tuple(arguments)
 
 
-def _parse_arm_expression(expression, template_obj, parameters):
-    """Determine if a section of the template is an ARM reference, and calculate
-    the replacement accordingly. The result will be correctly typed to suit the
-    parameter definition (e.g. will return a number if the parameter requires a number)
+def _parse_arm_expression(expression):
+    """Parse a section of the template contained within [] into an expression
+    tree of nested tuples: ('parameters', name), ('variables', name),
+    ('concat', (arguments, ..)) or ('value', string).
     :param str expression: A section of template contained within [].
-    :param dict template_obj: The loaded contents of the JSON template.
-    :param dict parameters: The loaded contents of the JSON parameters.
     """
-    if not isinstance(expression, str):
-        return expression
-    if expression[0] == '[' and expression[-1] == ']':
+    if expression[:1] == '[' and expression[-1:] == ']':
         # Remove the enclosing brackets to check the contents
-        return _parse_arm_expression(expression[1:-1], template_obj, parameters)
-    if expression[0] == '(' and expression[-1] == ')':
+        return _parse_arm_expression(expression[1:-1])
+    if expression[:1] == '(' and expression[-1:] == ')':
         # If the section is surrounded by ( ), then we need to further process the contents
         # as either a parameter name, or a concat operation
-        return _parse_arm_expression(expression[1:-1], template_obj, parameters)
-    if expression[0] == '\'' and expression[-1] == '\'':
+        return _parse_arm_expression(expression[1:-1])
+    if expression[:1] == '\'' and expression[-1:] == '\'':
         # If a string, remove quotes in order to perform parameter look-up
-        return expression[1:-1]
-    if re.match(r'^parameters', expression):
-        result = _parse_arm_parameter(expression[12:-2], template_obj, parameters)
-    elif re.match(r'^variables', expression):
-        result = _parse_arm_variable(expression[11:-2], template_obj, parameters)
-    elif re.match(r'^concat', expression):
-        result = _parse_arm_concat(expression[7:-1], template_obj, parameters)
-    elif re.match(r'^reference', expression):
+        return ('value', expression[1:-1])
+    if expression.startswith('parameters'):
+        return ('parameters', expression[12:-2])
+    elif expression.startswith('variables'):
+        return ('variables', expression[11:-2])
+    elif expression.startswith('concat'):
+        return ('concat', _parse_arm_concat(expression[7:-1]))
+    elif expression.startswith('reference'):
         raise NotImplementedError("ARM-style 'reference' syntax not supported.")
-    else:
-        result = expression
-    return result
+    return ('value', expression)
 
 
-def _parse_template_string(string_content, template_obj, parameters):
-    """Given a string value (including quotes), evaluate any embedded template expressions
-    delimited by '[' and ']'.
-    :param str string_content: The contents of the template string.
-    :param dict template_obj: The loaded JSON template file.
-    :param dict parameters: The contents of the parameters file.
+def _parse_template_string(string_content):
+    """Split a string value into literal text and the expression trees of any
+    embedded template expressions delimited by '[' and ']'.
+    :param str string_content: The string value from the template.
+    :returns: A list of literal strings and expression tuples.
     """
-    updated_content = ""
+    segments = []
+    literal = ''
     current_index = 0
     while current_index < len(string_content):
-        try:
-            expression_start = string_content.index('[', current_index)
-        except ValueError:  # No template expression to evaluate
+        expression_start = string_content.find('[', current_index)
+        if expression_start < 0:  # No template expression to evaluate
             break
-        if expression_start < len(string_content) - 1 and \
-                string_content[expression_start + 1] == '[':
+        if string_content[expression_start + 1:expression_start + 2] == '[':
             # Found escaped expression
-            updated_content += string_content[current_index:expression_start] + '['
+            literal += string_content[current_index:expression_start] + '['
             current_index = expression_start + 2
             continue
         expression_end = _find_nested(']', string_content, expression_start + 1)
         if expression_end >= len(string_content):
             # No closing delimiter for the expression (not our problem)
             break
+        literal += string_content[current_index:expression_start]
+        if literal:
+            segments.append(literal)
+            literal = ''
         # Everything between [ and ]
-        expression = string_content[expression_start + 1:expression_end]
-        parsed = _parse_arm_expression(expression, template_obj, parameters)
-        if _is_substitution(string_content, expression_start, expression_end):
-            # Replacing within the middle of a string
-            updated_content += string_content[current_index:expression_start] + str(parsed)
-            current_index = expression_end + 1
-        elif isinstance(parsed, bool):
-            parsed = "true" if parsed else "false"
-            updated_content += string_content[current_index:expression_start - 1] + parsed
-            current_index = expression_end + 2
-        elif isinstance(parsed, int):
-            # Replacing an entire element value, and we want to remove any surrounding quotes
-            updated_content += string_content[current_index:expression_start - 1] + str(parsed)
-            current_index = expression_end + 2
-        elif isinstance(parsed, dict):
-            json_content = json.dumps(parsed)
-            updated_content += string_content[current_index:expression_start - 1] + json_content
-            current_index = expression_end + 2
+        segments.append(_parse_arm_expression(
+            string_content[expression_start + 1:expression_end]))
+        current_index = expression_end + 1
+    literal += string_content[current_index:]
+    if literal:
+        segments.append(literal)
+    return segments
+
+
+def _parse_template_strings(template_obj, expressions=None):
+    """Parse every string value and key of a template which contains template expressions.
+    :param template_obj: The loaded JSON template, or a value within it.
+    :param dict expressions: The table of parsed strings to update.
+    :returns: A table mapping each string to its parsed segments.
+    """
+    expressions = {} if expressions is None else expressions
+    if isinstance(template_obj, dict):
+        for key, value in template_obj.items():
+            _parse_template_strings(key, expressions)
+            _parse_template_strings(value, expressions)
+    elif isinstance(template_obj, list):
+        for value in template_obj:
+            _parse_template_strings(value, expressions)
+    elif isinstance(template_obj, six.string_types) and '[' in template_obj:
+        expressions[template_obj] = _parse_template_string(template_obj)
+    return expressions
+
+
+class _TemplateEvaluator(object):
+    """Evaluates the template expressions within a loaded JSON template.
+    :param dict template_obj: The loaded contents of the JSON template.
+    :param dict parameters: The loaded contents of the JSON parameters.
+    :param dict expressions: The strings of the template already parsed by
+     `_parse_template_strings`, if any.
+    """
+
+    def __init__(self, template_obj, parameters, expressions=None):
+        self.template_obj = template_obj
+        self.parameters = parameters
+        self.expressions = expressions or {}
+        # The resolved parameters and variables, and those currently being resolved
+        self._resolved = {}
+        self._resolving = []
+
+    def _resolve(self, kind, name, resolver):
+        """Resolve a parameter or variable once per expansion.
+        :param str kind: Either 'parameters' or 'variables'.
+        :param str name: The name of the parameter or variable.
+        :param func resolver: Calculates the value of the parameter or variable.
+        """
+        key = (kind, name)
+        try:
+            value = self._resolved[key]
+        except KeyError:
+            if key in self._resolving:
+                cycle = self._resolving[self._resolving.index(key):] + [key]
+                raise ValueError("Template contains a circular reference: {}".format(
+                    ' -> '.join("{}('{}')".format(*k) for k in cycle)))
+            self._resolving.append(key)
+            try:
+                value = self._resolved[key] = resolver(name)
+            finally:
+                self._resolving.pop()
+        # Complex values are copied so that each substitution is independent
+        return copy.deepcopy(value) if isinstance(value, dict) else value
+
+    def parameter(self, name):
+        """Render the content of an ARM property
+        :param str name: The name of the property to render.
+        """
+        return self._resolve('parameters', name, self._parameter)
+
+    def variable(self, name):
+        """Render the value of an ARM variable.
+        :param str name: The name of the variable to render.
+        """
+        return self._resolve('variables', name, self._variable)
+
+    def _parameter(self, name):
+        if 'parameters' not in self.template_obj:
+            raise ValueError("Template defines no parameters but tried to use '{}'".format(name))
+        try:
+            param_def = self.template_obj['parameters'][name]
+        except KeyError:
+            raise ValueError("Template does not define parameter '{}'".format(name))
+        user_value = param_def.get('defaultValue')
+        if self.parameters and name in self.parameters:
+            # Support both ARM and dictionary syntax
+            # ARM: '<PropertyName>' : { 'value' : '<PropertyValue>' }
+            # Dictionary: '<PropertyName>' : <PropertyValue>'
+            user_value = self.parameters[name]
+            try:
+                user_value = user_value['value']
+            except TypeError:
+                pass
+        if not user_value:
+            raise ValueError(
+                "No value supplied for parameter '{}' and no default value".format(name))
+        if isinstance(user_value, dict):
+            # If substitute value is a complex object - it may require
+            # additional parameter substitutions
+            return self.evaluate(user_value)
+        if param_def['type'] == 'int':
+            return _validate_int(user_value, param_def)
+        elif param_def['type'] == 'bool':
+            return _validate_bool(user_value)
+        elif param_def['type'] == 'string':
+            return _validate_string(user_value, param_def)
         else:
-            updated_content += string_content[current_index:expression_start] + str(parsed)
-            current_index = expression_end + 1
-    updated_content += string_content[current_index:]
-    return updated_content
+            raise TypeError("Parameter type '{}' not supported.".format(param_def['type']))
+
+    def _variable(self, name):
+        try:
+            variable = self.template_obj['variables'][name]
+        except KeyError:
+            raise ValueError("Template contains no definition for variable '{}'".format(name))
+        if isinstance(variable, six.string_types):
+            variable = self.evaluate_expression(_parse_arm_expression(variable))
+        if isinstance(variable, dict):
+            # If substitute value is a complex object - it may require
+            # additional parameter substitutions
+            return self.evaluate(variable)
+        return variable
+
+    def evaluate_expression(self, expression):
+        """Calculate the value of a parsed ARM expression. The result will be correctly
+        typed to suit the parameter definition (e.g. will return a number if the parameter
+        requires a number)
+        :param tuple expression: The expression tree from `_parse_arm_expression`.
+        """
+        operation, argument = expression
+        if operation == 'parameters':
+            return self.parameter(argument)
+        elif operation == 'variables':
+            return self.variable(argument)
+        elif operation == 'concat':
+            return ''.join(self.evaluate_expression(a) for a in argument)
+        return argument
+
+    def evaluate_string(self, string_content):
+        """Given a string value, evaluate any embedded template expressions.
+        :param str string_content: The string value from the template.
+        """
+        if '[' not in string_content:
+            return string_content
+        try:
+            segments = self.expressions[string_content]
+        except KeyError:
+            segments = _parse_template_string(string_content)
+        if len(segments) == 1 and not isinstance(segments[0], six.string_types):
+            # Replacing an entire element value, which retains the type of the result
+            parsed = self.evaluate_expression(segments[0])
+            if isinstance(parsed, (bool, int, dict)):
+                return parsed
+            return parsed if isinstance(parsed, six.string_types) else str(parsed)
+        result = []
+        for segment in segments:
+            if not isinstance(segment, six.string_types):
+                # Replacing within the middle of a string
+                segment = self.evaluate_expression(segment)
+            result.append(segment if isinstance(segment, six.string_types) else str(segment))
+        return ''.join(result)
+
+    def evaluate(self, value):
+        """Expand all parameters and variables in a template value.
+        :param value: The loaded JSON template, or a value within it, to expand.
+        """
+        if isinstance(value, dict):
+            result = {}
+            for key, item in value.items():
+                key = self.evaluate_string(key)
+                key = key if isinstance(key, six.string_types) else str(key)
+                result[key] = self.evaluate(item)
+            return result
+        if isinstance(value, list):
+            return [self.evaluate(item) for item in value]
+        if isinstance(value, six.string_types):
+            return self.evaluate_string(value)
+        return value
 
 
-def _parse_template(template_str, template_obj, parameters):
+def _parse_template(value, template_obj, parameters, expressions=None):
     """Expand all parameters, and variables in the template.
 
-    We want to expand all template expressions (delimited by '[' and ']') in the supplied template
-    string. However, that syntax collides with JSON syntax for arrays and we don't want to collide
-    with any of those. To avoid such a collision, we iterate through all of the string values
-    (delimited by double quotes (")) and then expand template expressions only within those.
+    Template expressions (delimited by '[' and ']') are only expanded within the string
+    values and keys of the loaded JSON, so they cannot collide with JSON arrays.
 
-    :param str template_str: Content of the template file as a string.
+    :param value: The loaded JSON template, or a value within it, to expand.
     :param dict template_obj: Contents of the template file.
     :param dict parameters: Contents of the parameters file.
+    :param dict expressions: The strings of the template already parsed by
+     `_parse_template_strings`, if any.
     :returns: Fully resolved JSON template.
     """
-    updated_json = ""
-    current_index = 0
-    while current_index < len(template_str):
-        try:
-            string_start = template_str.index('"', current_index)
-        except ValueError:  # Didn't find another string to expand
-            break
-        try:
-            string_end = _find('"', template_str, string_start + 1)
-        except ValueError:  # Didn't find terminating quote for string (not our problem)
-            break
-        string_content = template_str[string_start:string_end + 1]
-        if '[' in string_content:
-            updated_json += template_str[current_index:string_start]
-            updated_json += _parse_template_string(string_content, template_obj, parameters)
+    return _TemplateEvaluator(template_obj, parameters, expressions).evaluate(value)
+
+
+def _parse_template_file(template_str, template_obj, validator=None):
+    """Validate a template and parse its template expressions. The result is cached
+    on disk by the content of the template file, so that repeated use of the same
+    template skips both steps.
+    :param str template_str: Content of the template file as a string.
+    :param dict template_obj: Contents of the template file.
+    :param func validator: The validation to apply to the template, if any.
+    :returns: The table of parsed template strings, see `_parse_template_strings`.
+    """
+    cache_size = az_config.getint(
+        'batch', 'template_cache_size', _TEMPLATE_CACHE_DEFAULT_SIZE_MB)
+    cache = cache_utils.FileCache('templates', cache_size * 1024 * 1024)
+    key = cache_utils.hash_content(
+        _TEMPLATE_CACHE_VERSION, validator.__name__ if validator else '', template_str)
+    expressions = cache.get(key)
+    if expressions is None:
+        if validator:
+            validator(template_obj)
+        expressions = _parse_template_strings(template_obj)
+        cache.set(key, expressions)
+    return expressions
+
+
+def _get_compressed_directories(compressed):
+    """Get the top-level directories of compressed resource files. The files are found in
+    these directories on the node, as listing each file could exceed the maximum length
+    of the command line."""
+    directories = set()
+    for path in compressed:
+        parts = path.replace('\\', '/').split('/')
+        directories.add(parts[0] if len(parts) > 1 and parts[0] not in ('', '.') else '.')
+    return ['.'] if '.' in directories else sorted(directories)
+
+
+def _get_windows_extraction_cmds(compressed, archives):
+    """Get the Windows commands that decompress and extract resource files."""
+    commands = []
+    if compressed:
+        directories = ','.join("'{}'".format(d.replace("'", "''"))
+                               for d in _get_compressed_directories(compressed))
+        suffix = FileUtils.COMPRESSED_RESOURCE_SUFFIX
+        commands.append((
+            "powershell -NoProfile -NonInteractive -Command \"$ErrorActionPreference = 'Stop'; "
+            "Get-ChildItem -LiteralPath {} -Recurse -Filter '*{}' | ForEach-Object {{ "
+            "$f = $_.FullName; $i = [IO.File]::OpenRead($f); "
+            "$o = [IO.File]::Create($f.Substring(0, $f.Length - {})); "
+            "$z = New-Object IO.Compression.GZipStream($i, "
+            "[IO.Compression.CompressionMode]::Decompress); $z.CopyTo($o); "
+            "$o.Close(); $z.Close(); Remove-Item -LiteralPath $f }}\"").format(
+                directories, suffix, len(suffix)))
+    for path, archive in archives:
+        if 'member' in archive:
+            directory = os.path.dirname(archive['filePath']) or '.'
+            extract_cmd = 'tar -x -O -f "{}" "{}" > "{}"'.format(
+                path, archive['member'], archive['filePath'].replace('/', '\\'))
         else:
-            updated_json += template_str[current_index:string_end + 1]
-        current_index = string_end + 1
-    updated_json += template_str[current_index:]
-    return json.loads(updated_json)
+            directory = archive['directory']
+            extract_cmd = 'tar -x -f "{}" -C "{}"'.format(path, directory)
+            if archive.get('prefix'):
+                extract_cmd += ' "{}*"'.format(archive['prefix'])
+        directory = directory.replace('/', '\\')
+        commands.append('(if not exist "{0}" mkdir "{0}") && {1}'.format(directory, extract_cmd))
+    return commands
 
 
-def _process_resource_files(request, fileutils):
+def _get_linux_extraction_cmds(compressed, archives):
+    """Get the Linux commands that decompress and extract resource files."""
+    commands = []
+    if compressed:
+        suffix = FileUtils.COMPRESSED_RESOURCE_SUFFIX
+        directories = [shell_escape(d if d == '.' else './' + d)
+                       for d in _get_compressed_directories(compressed)]
+        commands.append('find {} -name {} -exec gzip -d -f -S {} -- {{}} +'.format(
+            ' '.join(directories), shell_escape('*' + suffix), shell_escape(suffix)))
+    for path, archive in archives:
+        if 'member' in archive:
+            directory = os.path.dirname(archive['filePath']) or '.'
+            extract_cmd = 'tar -x -O -f {} {} > {}'.format(
+                shell_escape(path), shell_escape(archive['member']),
+                shell_escape(archive['filePath']))
+        else:
+            directory = archive['directory']
+            extract_cmd = 'tar -x -f {} -C {}'.format(shell_escape(path), shell_escape(directory))
+            if archive.get('prefix'):
+                # Match the prefix literally, followed by any characters including '/'
+                pattern = re.sub(r'([\\*?[])', r'\\\1', archive['prefix']) + '*'
+                extract_cmd += ' --wildcards --wildcards-match-slash {}'.format(
+                    shell_escape(pattern))
+        commands.append('mkdir -p {} && {}'.format(shell_escape(directory), extract_cmd))
+    return commands
+
+
+def _get_extraction_cmdline(command_line, compressed, archives, os_flavor):
+    """Prefix a command line with the decompression of compressed resource files, and
+    the extraction of packed files from the shards downloaded as resource files.
+    :param str command_line: The command line of the task downloading the files.
+    :param list compressed: The paths of the compressed files, each with the suffix
+     FileUtils.COMPRESSED_RESOURCE_SUFFIX.
+    :param list archives: Tuples of the path of each shard and the files to extract from it.
+    :param str os_flavor: The OS flavor of the pool.
+    :returns: The updated command line.
+    """
+    if os_flavor == pool_utils.PoolOperatingSystemFlavor.WINDOWS:
+        commands = _get_windows_extraction_cmds(compressed, archives)
+        return 'cmd /c "{}"'.format(' && '.join(commands + [command_line]))
+    elif os_flavor == pool_utils.PoolOperatingSystemFlavor.LINUX:
+        commands = _get_linux_extraction_cmds(compressed, archives)
+        return '/bin/bash -c {}'.format(shell_escape(' && '.join(commands + [command_line])))
+    raise ValueError("Unknown pool OS flavor: {}".format(os_flavor))
+
+
+def _process_resource_files(request, fileutils, get_os_flavor=None, get_pool=None):
     """Parse a request body for any references to resource files and transform
-    them to API resourceFile format where applicable.
+    them to API resourceFile format where applicable. Resource files uploaded
+    compressed or packed are decompressed or extracted by the command line of the
+    task that downloads them.
     :param dict request: Job or task specification.
+    :param func get_os_flavor: Gets the OS flavor of the pool. Only called if
+     compressed or packed resource files are referenced.
+    :param func get_pool: Gets the pool specification, if known, to check that packed
+     resource files can be extracted on a Windows pool.
     :returns: The updated job or task specification.
     """
     if isinstance(request, list):
-        return [_process_resource_files(r, fileutils) for r in request]
+        return [_process_resource_files(r, fileutils, get_os_flavor, get_pool) for r in request]
     try:
+        compressed = []
+        archives = []
         for parameter, value in request.items():
             if parameter in ['resourceFiles', 'commonResourceFiles'] and isinstance(value, list):
                 new_resources = []
                 for file_ref in value:
-                    new_resources.extend(fileutils.resolve_resource_file(file_ref))
+                    for resource in fileutils.resolve_resource_file(file_ref):
+                        if resource.pop('contentEncoding', None):
+                            compressed.append(resource['filePath'])
+                        archive = resource.pop('archive', None)
+                        if archive:
+                            archives.append((resource['filePath'], archive))
+                            if resource in new_resources:
+                                # A shard referenced by several resource files is
+                                # downloaded once
+                                continue
+                        new_resources.append(resource)
                 request[parameter] = new_resources
             elif isinstance(value, dict) or isinstance(value, list):
-                request[parameter] = _process_resource_files(value, fileutils)
+                request[parameter] = _process_resource_files(
+                    value, fileutils, get_os_flavor, get_pool)
+        if compressed or archives:
+            if not request.get('commandLine') or not get_os_flavor:
+                raise ValueError('Compressed or packed resource files can only be '
+                                 'referenced by a task with a command line.')
+            os_flavor = get_os_flavor()
+            if archives and os_flavor == pool_utils.PoolOperatingSystemFlavor.WINDOWS \
+                    and get_pool and not pool_utils.pool_includes_tar(get_pool()):
+                raise ValueError('Packed resource files are extracted with tar, which is only '
+                                 'included in Windows Server 2019 and later.')
+            request['commandLine'] = _get_extraction_cmdline(
+                request['commandLine'], compressed, archives, os_flavor)
     except AttributeError:
         # Request is not a dictionary - just return.
         pass
     return request
 
 
+def _collect_resource_file_sources(request, sources):
+    """Collect the sources of the resource file references in a request, including
+    those of task factory templates. Task factory placeholders are not yet substituted,
+    so prefixes are truncated at the first placeholder, and sources whose container
+    contains a placeholder are skipped.
+    :param request: A job or task specification (or part thereof).
+    :param list sources: The list to which the sources are added.
+    """
+    if isinstance(request, list):
+        for item in request:
+            _collect_resource_file_sources(item, sources)
+        return
+    if not isinstance(request, dict):
+        return
+    for parameter, value in request.items():
+        if parameter in ['resourceFiles', 'commonResourceFiles'] and isinstance(value, list):
+            for file_ref in value:
+                source = file_ref.get('source') if isinstance(file_ref, dict) else None
+                if not isinstance(source, dict):
+                    continue
+                container = source.get('fileGroup') or source.get('containerUrl')
+                if not isinstance(container, six.string_types) or '{' in container:
+                    continue
+                prefix = source.get('prefix')
+                if isinstance(prefix, six.string_types):
+                    source = dict(source, prefix=prefix.split('{', 1)[0])
+                sources.append(source)
+        elif isinstance(value, (dict, list)):
+            _collect_resource_file_sources(value, sources)
+
+
 def _parse_task_output_files(task, os_flavor, file_utils):
     """Process a task's outputFiles section and update the task accordingly.
     :param dict task: A task specification.
@@ -743,131 +994,205 @@ def _parse_task_output_files(task, os_flavor, file_utils):
     return new_task
 
 
-def _transform_sweep_str(data, parameters):
-    """Replace string placeholders with parametric sweep values.
+def _split_placeholders(data, pattern, placeholder):
+    """Split a string into literal segments and placeholder render functions.
     :param str data: The string containing placeholders.
-    :param list parameters: The sweep values, each value maps
-     to one of {0}, {1}, .. {n} by index.
+    :param pattern: The compiled regex matching a placeholder.
+    :param func placeholder: Creates the render function for a placeholder match.
+    :returns: A list of alternating literal strings and render functions,
+     starting and ending with a literal string.
     """
-    # Handle {n} or {n:m} scenario
-    reg = re.compile(r'\{(\d+)(:(\d+))?\}')
-
-    def replace(match):
-        r, r1, _, r3 = [data[start:end] for start, end in match.regs]
-        n = int(r1)
-        if n >= len(parameters):
-            raise ValueError("The parameter pattern '{}' is out of bound.".format(r))
-        number_str = str(parameters[n])
-        if ':' in r:
-            # This is {n:m} scenario
-            if parameters[n] < 0:
-                raise ValueError(
-                    "The parameter '{}' is negative and cannot be used in pattern '{}'.".format(
-                        parameters[n], r))
-            m = int(r3)
-            if m < 1 or m > 9:
-                raise ValueError(
-                    "The parameter pattern '{}' is out of bound. "
-                    "The padding number can be only between 1 to 9.".format(r))
-            return number_str.zfill(m)
-        else:
+    segments = []
+    position = 0
+    for match in pattern.finditer(data):
+        segments.append(data[position:match.start()])
+        segments.append(placeholder(match))
+        position = match.end()
+    segments.append(data[position:])
+    return segments
+
+
+def _sweep_placeholder(match):
+    """Create the render function for a {n} or {n:m} parametric sweep placeholder.
+    :param match: The regex match of the placeholder.
+    """
+    pattern = match.group(0)
+    index = int(match.group(1))
+    padding = None
+    if match.group(3) is not None:
+        padding = int(match.group(3))
+        if padding < 1 or padding > 9:
+            raise ValueError(
+                "The parameter pattern '{}' is out of bound. "
+                "The padding number can be only between 1 to 9.".format(pattern))
+
+    def render(parameters):
+        if index >= len(parameters):
+            raise ValueError("The parameter pattern '{}' is out of bound.".format(pattern))
+        if padding is None:
             # This is just {n} scenario
-            return number_str
-    return reg.sub(replace, data)
+            return str(parameters[index])
+        # This is {n:m} scenario
+        if parameters[index] < 0:
+            raise ValueError(
+                "The parameter '{}' is negative and cannot be used in pattern '{}'.".format(
+                    parameters[index], pattern))
+        return str(parameters[index]).zfill(padding)
+    return render
+
+
+def _file_placeholder(match):
+    """Create the render function for a {url}, {filePath}, {fileName} or
+    {fileNameWithoutExtension} file iteration placeholder.
+    :param match: The regex match of the placeholder.
+    """
+    prop = match.group(1)
+
+    def render(file_ref):
+        value = file_ref[prop]
+        if '{' in value or '}' in value:
+            raise ValueError(
+                "Invalid use of bracket characters, did you forget to escape (using {{}})?")
+        return value
+    return render
+
+
+def _transform_sweep_str(data):
+    """Split a string on its parametric sweep placeholders.
+    :param str data: The string containing placeholders. Each sweep
+     value maps to one of {0}, {1}, .. {n} by index.
+    """
+    return _split_placeholders(data, _SWEEP_PLACEHOLDER, _sweep_placeholder)
 
 
-def _transform_file_str(content, file_ref):
-    """Replace string with file value.
-    :param str content: The string to be replaced.
-    :param dict file_ref: The file information, containing 'url',
-     'filePath etc properties.
+def _transform_file_str(data):
+    """Split a string on its file iteration placeholders.
+    :param str data: The string containing placeholders for the file 'url',
+     'filePath' etc properties.
     """
-    replace_props = ['url', 'filePath', 'fileName', 'fileNameWithoutExtension']
-    for prop in replace_props:
-        content = re.sub("{" + prop + "}", file_ref[prop], content)
-    return content
+    return _split_placeholders(data, _FILE_PLACEHOLDER, _file_placeholder)
 
 
-def _replacement_transform(transformer, source_obj, source_key, context):
-    """Transform a string by applying specific context values.
+def _compile_replacement(transformer, source_str):
+    """Compile a string into a function which applies specific context values.
     By design, user should escape all the literal '{' or '}' to '{{' or '}}'.
     All other '{' or '}' characters are used for replacement
-    :param func transformer: The tranformation function to run.
+    :param func transformer: The function splitting the string on its placeholders.
+    :param str source_str: The string to be transformed.
+    :returns: A function taking the context and returning the transformed string,
+     or the unescaped string if it contains no placeholders.
+    """
+    # Handle '{' and '}' escape scenario : replace '{{' to _LEFT_BRACKET_REPLACE_CHAR,
+    # and '}}' to _RIGHT_BRACKET_REPLACE_CHAR. The reverse is used to handle {{{0}}}.
+    escaped = source_str.replace('{{', _LEFT_BRACKET_REPLACE_CHAR)[::-1]
+    escaped = escaped.replace('}}', _RIGHT_BRACKET_REPLACE_CHAR)[::-1]
+    segments = transformer(escaped)
+    for index in range(0, len(segments), 2):
+        if '{' in segments[index] or '}' in segments[index]:
+            raise ValueError(
+                "Invalid use of bracket characters, did you forget to escape (using {{}})?")
+        # Replace the escape characters back to '{' and '}'
+        segments[index] = segments[index].replace(
+            _LEFT_BRACKET_REPLACE_CHAR, '{').replace(_RIGHT_BRACKET_REPLACE_CHAR, '}')
+    head = segments[0]
+    parts = list(zip(segments[1::2], segments[2::2]))
+    if not parts:
+        return head
+    if len(parts) == 1:
+        placeholder, tail = parts[0]
+        return lambda context: head + placeholder(context) + tail
+
+    def render(context):
+        result = [head]
+        for placeholder, literal in parts:
+            result.append(placeholder(context))
+            result.append(literal)
+        return ''.join(result)
+    return render
+
+
+def _compile_field(transformer, source_obj, source_key):
+    """Replace a string in a task template with its compiled replacement.
+    :param func transformer: The function splitting the string on its placeholders.
     :param dict source_obj: The object containing the string to be transformed.
     :param str key: The key of the string to be transformed.
-    :param context: The specific context to apply to the string.
     """
-    source_str = source_obj.get(source_key)
-    if not source_str:
-        return {}
-    # Handle '{' and '}' escape scenario : replace '{{' to LEFT_BRACKET_REPLACE_CHAR,
-    # and '}}' to RIGHT_BRACKET_REPLACE_CHAR. The reverse function is used to handle {{{0}}}.
-    LEFT_BRACKET_REPLACE_CHAR = u'\uE800'  # pylint: disable=anomalous-unicode-escape-in-string
-    RIGHT_BRACKET_REPLACE_CHAR = u'\uE801'  # pylint: disable=anomalous-unicode-escape-in-string
-    transformed = re.sub(r'\{\{', LEFT_BRACKET_REPLACE_CHAR, source_str)[::-1]
-    transformed = re.sub(r'\}\}', RIGHT_BRACKET_REPLACE_CHAR, transformed)[::-1]
-    transformed = transformer(transformed, context)
-    if '{' in transformed or '}' in transformed:
-        raise ValueError(
-            "Invalid use of bracket characters, did you forget to escape (using {{}})?")
-    # Replace LEFT_BRACKET_REPLACE_CHAR back to '{', and RIGHT_BRACKET_REPLACE_CHAR back to '}'
-    transformed = re.sub(LEFT_BRACKET_REPLACE_CHAR, '{', transformed)
-    transformed = re.sub(RIGHT_BRACKET_REPLACE_CHAR, '}', transformed)
-    return {source_key: transformed}
-
-
-def _transform_repeat_task(task, context, index, transformer):
-    """Apply the transformer to a task template to yield a new task.
+    if source_obj.get(source_key):
+        source_obj[source_key] = _compile_replacement(transformer, source_obj[source_key])
+
+
+def _compile_repeat_task(task, transformer):
+    """Compile a task template so that the transformable strings are analysed
+    once, rather than for every task generated from it.
     :param dict task: The repeatTask task template.
-    :param context: The task-factory specific context to apply to the template.
-    :param index: The task factory index to use as task ID.
-    :param func transformer: The transforming function to apply the
-     context to the template.
+    :param func transformer: The function splitting a string on its placeholders.
+    :returns: A copy of the template with each transformable string replaced
+     by its compiled replacement function.
     """
-    new_task = copy.deepcopy(task)
-    new_task.update(_replacement_transform(transformer, new_task, 'commandLine', context))
-    new_task.update(_replacement_transform(transformer, new_task, 'displayName', context))
-    for resource in new_task.get('resourceFiles', []):
-        resource.update(_replacement_transform(transformer, resource, 'filePath', context))
-        try:
+    plan = copy.deepcopy(task)
+    _compile_field(transformer, plan, 'commandLine')
+    _compile_field(transformer, plan, 'displayName')
+    for resource in plan.get('resourceFiles', []):
+        _compile_field(transformer, resource, 'filePath')
+        if 'source' in resource:
             for param in ['fileGroup', 'prefix', 'containerUrl', 'url']:
-                resource['source'].update(
-                    _replacement_transform(transformer, resource['source'], param, context))
-        except KeyError:
-            resource.update(_replacement_transform(transformer, resource, 'blobSource', context))
-    for env_variable in new_task.get('environmentSettings', []):
+                _compile_field(transformer, resource['source'], param)
+        else:
+            _compile_field(transformer, resource, 'blobSource')
+    for env_variable in plan.get('environmentSettings', []):
         for param in ['name', 'value']:
-            env_variable.update(_replacement_transform(transformer, env_variable, param, context))
-    for output in new_task.get('outputFiles', []):
-        output.update(_replacement_transform(transformer, output, 'filePattern', context))
-        try:
+            _compile_field(transformer, env_variable, param)
+    for output in plan.get('outputFiles', []):
+        _compile_field(transformer, output, 'filePattern')
+        destination = output.get('destination', {})
+        if 'container' in destination:
             for param in ['path', 'containerSas']:
-                output['destination']['container'].update(
-                    _replacement_transform(
-                        transformer, output['destination']['container'], param, context))
-        except KeyError:
-            pass
-        try:
+                _compile_field(transformer, destination['container'], param)
+        if 'autoStorage' in destination:
             for param in ['path', 'fileGroup']:
-                output['destination']['autoStorage'].update(
-                    _replacement_transform(
-                        transformer, output['destination']['autoStorage'], param, context))
-        except KeyError:
-            pass
-    docker_options = new_task.get('clientExtensions', {}).get('dockerOptions', {})
-    docker_options.update(_replacement_transform(transformer, docker_options, 'image', context))
+                _compile_field(transformer, destination['autoStorage'], param)
+    docker_options = plan.get('clientExtensions', {}).get('dockerOptions', {})
+    _compile_field(transformer, docker_options, 'image')
     for volume in docker_options.get('dataVolumes', []):
         for param in ['hostPath', 'containerPath']:
-            volume.update(_replacement_transform(transformer, volume, param, context))
+            _compile_field(transformer, volume, param)
     for volume in docker_options.get('sharedDataVolumes', []):
         for param in ['name', 'containerPath']:
-            volume.update(_replacement_transform(transformer, volume, param, context))
-    new_task['id'] = str(index)
-    return new_task
+            _compile_field(transformer, volume, param)
+    return plan
 
 
-def _parse_parameter_sets(parameter_sets):
-    """Parse parametric sweep set, and return all possible values in array.
+def _compile_renderer(plan):
+    """Compile a task template, as returned by `_compile_repeat_task`, into a
+    function which creates a new task by applying a context to the template.
+    :param plan: The compiled template, or a value within it.
+    :returns: A function taking the context, or None for a value which can be
+     reused as is.
+    """
+    if callable(plan):
+        return plan
+    if isinstance(plan, dict):
+        renderers = [(k, _compile_renderer(v)) for k, v in plan.items()]
+        static = {k: plan[k] for k, r in renderers if not r}
+        dynamic = [(k, r) for k, r in renderers if r]
+
+        def render_dict(context):
+            result = dict(static)
+            for key, render in dynamic:
+                result[key] = render(context)
+            return result
+        return render_dict
+    if isinstance(plan, list):
+        renderers = [_compile_renderer(v) for v in plan]
+        if not any(renderers):
+            return lambda _: list(plan)
+        renderers = [r or (lambda _, v=v: v) for r, v in zip(renderers, plan)]
+        return lambda context: [render(context) for render in renderers]
+    return None
+
+
+def _parse_parameter_ranges(parameter_sets):
+    """Parse parametric sweep set, and return the range of values for each set.
     :param list parameter_sets: An array of parameter sets.
     """
     if not parameter_sets:
@@ -892,7 +1217,14 @@ def _parse_parameter_sets(parameter_sets):
                 "'step' must be a positive number when 'end' is greater than 'start'")
         end = end + 1 if end >= start else end - 1
         iterations.append(range(start, end, step))
-    return itertools.product(*iterations)
+    return iterations
+
+
+def _parse_parameter_sets(parameter_sets):
+    """Parse parametric sweep set, and return all possible values as an iterator.
+    :param list parameter_sets: An array of parameter sets.
+    """
+    return itertools.product(*_parse_parameter_ranges(parameter_sets))
 
 
 def _parse_repeat_task(task):
@@ -910,28 +1242,81 @@ def _parse_repeat_task(task):
     return new_task
 
 
+def _parse_merge_task(factory, task_count):
+    """Parse the optional merge task of a task factory, which depends on
+    all of the tasks generated by the factory.
+    :param dict factory: A loaded JSON task factory object.
+    :param int task_count: The number of tasks generated by the factory.
+    :returns: The merge task, or None if no merge task is defined.
+    """
+    try:
+        merge_task = _parse_repeat_task(factory['mergeTask'])
+    except KeyError:  # No merge task
+        return None
+    merge_task['id'] = 'merge'
+    merge_task['dependsOn'] = {'taskIdRanges': {'start': 0, 'end': task_count - 1}}
+    return merge_task
+
+
+class _GeneratedTasks(object):
+    """An iterator over the tasks of a task factory, which are generated lazily. The first
+    task and the merge task are generated up front, so that errors in the task templates
+    are raised before the job is added.
+    :param list first: The first task, if any, as a list.
+    :param remaining: An iterator over the remaining tasks.
+    :param dict merge_task: The merge task to follow the generated tasks, if any.
+    """
+
+    def __init__(self, first, remaining, merge_task):
+        self.first = first
+        self.remaining = remaining
+        self.merge_task = merge_task
+        self._tasks = itertools.chain(first, remaining, [merge_task] if merge_task else [])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._tasks)
+
+    next = __next__  # Python 2
+
+
+def _generate_tasks(plan, contexts, merge_task):
+    """Lazily generate the tasks of a task factory.
+    :param dict plan: The compiled repeatTask task template.
+    :param contexts: An iterable of the contexts to apply to the template.
+    :param dict merge_task: The merge task to follow the generated tasks, if any.
+    :returns: A _GeneratedTasks iterator.
+    """
+    render = _compile_renderer(plan)
+    contexts = enumerate(contexts)
+
+    def render_task(index, context):
+        new_task = render(context)
+        new_task['id'] = str(index)
+        return new_task
+
+    first = [render_task(i, c) for i, c in itertools.islice(contexts, 1)]
+    return _GeneratedTasks(first, (render_task(i, c) for i, c in contexts), merge_task)
+
+
 def _expand_parametric_sweep(factory):
-    """Parse parametric sweep task factory object, and return task list.
+    """Parse parametric sweep task factory object, and return a task generator.
     :param dict factory: A loaded JSON task factory object.
     """
     try:
-        permutations = _parse_parameter_sets(factory['parameterSets'])
+        ranges = _parse_parameter_ranges(factory['parameterSets'])
     except (KeyError, TypeError):
         raise ValueError('Parameter set in parametric sweep task factory is missing or invalid.')
     try:
         repeat_task = _parse_repeat_task(factory['repeatTask'])
     except (KeyError, TypeError):
         raise ValueError('No repeat task is defined in parametric sweep task factory.')
-    task_objs = [_transform_repeat_task(repeat_task, p, i, _transform_sweep_str)
-                 for i, p in enumerate(permutations)]
-    try:
-        merge_task = _parse_repeat_task(factory['mergeTask'])
-        merge_task['id'] = 'merge'
-        merge_task['dependsOn'] = {'taskIdRanges': {'start': 0, 'end': len(task_objs) - 1}}
-        task_objs.append(merge_task)
-    except KeyError:  # No merge task
-        pass
-    return task_objs
+    task_count = reduce(operator.mul, (len(r) for r in ranges), 1)
+    merge_task = _parse_merge_task(factory, task_count)
+    plan = _compile_repeat_task(repeat_task, _transform_sweep_str)
+    return _generate_tasks(plan, itertools.product(*ranges), merge_task)
 
 
 def _expand_task_collection(factory):
@@ -960,7 +1345,7 @@ def _expand_task_collection(factory):
 
 
 def _expand_task_per_file(factory, fileutils):
-    """Parse file iteration task factory object, and return task list.
+    """Parse file iteration task factory object, and return a task generator.
     :param dict factory: A loaded JSON task factory object.
     """
     try:
@@ -971,16 +1356,12 @@ def _expand_task_per_file(factory, fileutils):
         repeat_task = _parse_repeat_task(factory['repeatTask'])
     except (KeyError, TypeError):
         raise ValueError('No repeat task is defined in file iteration task factory.')
-    task_objs = [_transform_repeat_task(repeat_task, f, i, _transform_file_str)
-                 for i, f in enumerate(files)]
-    try:
-        merge_task = _parse_repeat_task(factory['mergeTask'])
-        merge_task['id'] = 'merge'
-        merge_task['dependsOn'] = {'taskIdRanges': {'start': 0, 'end': len(task_objs) - 1}}
-        task_objs.append(merge_task)
-    except KeyError:  # No merge task
-        pass
-    return task_objs
+    if any('pack' in f for f in files):
+        raise ValueError("Files uploaded with 'batch file upload --pack' can't be "
+                         "iterated by a file iteration task factory.")
+    merge_task = _parse_merge_task(factory, len(files))
+    plan = _compile_repeat_task(repeat_task, _transform_file_str)
+    return _generate_tasks(plan, files, merge_task)
 
 
 def expand_application_template(job, working_dir):
@@ -1001,11 +1382,13 @@ def expand_application_template(job, working_dir):
     except (EnvironmentError, ValueError) as error:
         raise ValueError("Failed to parse JSON loaded from '{}': {}".
                          format(template_filepath, error))
-    _validate_application_template(template_loaded)
+    expressions = _parse_template_file(
+        template_str, template_loaded, _validate_application_template)
     _validate_parameter_usage(job['applicationTemplateInfo'].get('parameters'),
                               template_loaded.get('parameters'))
-    job_from_template = _parse_template(template_str, template_loaded,
-                                        job['applicationTemplateInfo'].get('parameters'))
+    job_from_template = _parse_template(template_loaded, template_loaded,
+                                        job['applicationTemplateInfo'].get('parameters'),
+                                        expressions)
     metadata = _merge_metadata(job_from_template.get('metadata'), job.get('metadata'))
     _validate_metadata(metadata)
     metadata.append({'name': 'az_batch:template_filepath', 'value': template_filepath})
@@ -1027,7 +1410,8 @@ def expand_template(template_file, parameter_file=None):
     """
     try:
         with open(template_file, 'r') as template:
-            template_json = json.load(template)
+            template_str = template.read()
+            template_json = json.loads(template_str)
         parameter_json = {}
         if parameter_file:
             with open(parameter_file, 'r') as parameters:
@@ -1035,13 +1419,17 @@ def expand_template(template_file, parameter_file=None):
     except (EnvironmentError, ValueError) as error:
         raise ValueError("Invalid JSON file: {}".format(error))
     parameters = _get_template_params(template_json, parameter_json)
-    return _parse_template(json.dumps(template_json), template_json, parameters)
+    expressions = _parse_template_file(template_str, template_json)
+    return _parse_template(template_json, template_json, parameters, expressions)
 
 
 def expand_task_factory(job_obj, fileutils):
-    """Parse a task factory object and expand to a list of tasks.
+    """Parse a task factory object and expand to a collection of tasks.
+    Parametric sweep and file iteration factories are validated, and their first task
+    and merge task generated, immediately, but their other tasks are generated lazily
+    as the collection is consumed.
     :param dict job_obj: The JSON job entity loaded from a template.
-    :returns: a list of task entities.
+    :returns: an iterable of task entities.
     """
     task_factory = job_obj.pop('taskFactory')
     try:
@@ -1058,6 +1446,34 @@ def expand_task_factory(job_obj, fileutils):
         raise TypeError("'{}' is not a valid Task Factory type.".format(factory_type))
 
 
+def get_task_factory_templates(task_factory, tasks):
+    """Return the task specifications from which every task generated by a task
+    factory is derived, so that the requirements of the tasks can be determined
+    without generating every task.
+    :param dict task_factory: A loaded JSON task factory object.
+    :param tasks: The tasks returned by `expand_task_factory` for the task factory.
+    :returns: a list of task entities.
+    """
+    if task_factory.get('type') == 'taskCollection':
+        return tasks
+    return [_parse_repeat_task(task_factory[t])
+            for t in ['repeatTask', 'mergeTask'] if t in task_factory]
+
+
+def get_generated_tasks(tasks):
+    """Return the tasks of a collection which have already been generated: every task
+    of a list, or the first task and merge task of a task factory generating its
+    tasks lazily.
+    :param tasks: The tasks returned by `expand_task_factory` or `process_task_collection`.
+    :returns: a list of task entities.
+    """
+    if isinstance(tasks, _GeneratedTasks):
+        return tasks.first + ([tasks.merge_task] if tasks.merge_task else [])
+    if isinstance(tasks, list):
+        return tasks
+    return []
+
+
 def construct_setup_task(existing_task, command_info, os_flavor):
     """Constructs a command line for the start task/job prep task which will
     run the setup script.
@@ -1106,9 +1522,10 @@ def construct_setup_task(existing_task, command_info, os_flavor):
 def process_job_for_output_files(job, tasks, os_flavor, file_utils):
     """Process a job and its collection of tasks for any tasks which use outputFiles.
     If a task does use outputFiles, we add to the jobs jobPrepTask for the install step.
-    NOTE: This edits the task collection and job in-line!
+    The tasks themselves are updated by process_task_collection.
+    NOTE: This edits the job in-line!
     :param dict job: A job specification.
-    :param list tasks: A list of task specifications.
+    :param list tasks: A list of task specifications, or the templates they are generated from.
     :param string os_flavor: The OS flavor of the pool.
     :returns: A dictionary with 'cmdLine' and 'resourceFiles'.
     """
@@ -1121,11 +1538,8 @@ def process_job_for_output_files(job, tasks, os_flavor, file_utils):
                                                          file_utils)
         if original_task != job['jobManagerTask']:
             must_edit_job = True
-    if tasks:
-        for index, task in enumerate(tasks):
-            tasks[index] = _parse_task_output_files(task, os_flavor, file_utils)
-            if task != tasks[index]:
-                must_edit_job = True
+    if tasks and any(t.get('outputFiles') is not None for t in tasks):
+        must_edit_job = True
     if must_edit_job:
         resource_files = list(_FILE_EGRESS_RESOURCES)
         if os_flavor == pool_utils.PoolOperatingSystemFlavor.WINDOWS:
@@ -1180,15 +1594,63 @@ def process_task_package_references(tasks, os_flavor):
     return _get_installation_cmdline(packages, os_flavor)
 
 
-def post_processing(request, fileutils):
+def process_task_collection(tasks, os_flavor, fileutils,  # pylint: disable=too-many-arguments
+                            get_os_flavor=None, get_pool=None):
+    """Apply the post-processing steps to each task in a collection.
+    Package references are removed (they are installed by the job preparation task),
+    and resource file and output file references are transformed. The tasks generated
+    lazily by a task factory are processed as they are generated, except for the first
+    task and the merge task, so that invalid references are found before the job is added.
+    :param tasks: A list of task specifications, or an iterable of generated tasks.
+    :param str os_flavor: The OS flavor of the pool.
+    :param func get_os_flavor: Gets the OS flavor of the pool, if it is not already known,
+     to decompress compressed resource files.
+    :param func get_pool: Gets the pool specification, to check that packed resource
+     files can be extracted.
+    :returns: The updated task specifications, in a list if a list was supplied.
+    """
+    get_os_flavor = get_os_flavor or (lambda: os_flavor)
+
+    def process(task):
+        task.pop('packageReferences', None)
+        task = _process_resource_files(task, fileutils, get_os_flavor, get_pool)
+        return _parse_task_output_files(task, os_flavor, fileutils)
+
+    if isinstance(tasks, list):
+        return [process(t) for t in tasks]
+    if isinstance(tasks, _GeneratedTasks):
+        return _GeneratedTasks([process(t) for t in tasks.first],
+                               (process(t) for t in tasks.remaining),
+                               process(tasks.merge_task) if tasks.merge_task else None)
+    return (process(t) for t in tasks)
+
+
+def post_processing(request, fileutils, get_os_flavor=None, get_pool=None):
     """Parse job or task to process new resource file references.
     :param dict request: A job or task specification (or list thereof).
+    :param func get_os_flavor: Gets the OS flavor of the pool, to decompress
+     compressed resource files.
+    :param func get_pool: Gets the pool specification, to check that packed resource
+     files can be extracted.
     """
     # Reform all new resource file references in standard ResourceFiles
     if isinstance(request, list):
-        return [_process_resource_files(i, fileutils) for i in request]
+        return [_process_resource_files(i, fileutils, get_os_flavor, get_pool) for i in request]
     else:
-        return _process_resource_files(request, fileutils)
+        return _process_resource_files(request, fileutils, get_os_flavor, get_pool)
+
+
+def prefetch_resource_files(request, fileutils):
+    """List every container referenced by the resource files of a job or task
+    specification concurrently, ahead of post-processing.
+    :param dict request: A job or task specification, which may include a task factory.
+    """
+    sources = []
+    _collect_resource_file_sources(request, sources)
+    task_factory = request.get('taskFactory') if isinstance(request, dict) else None
+    if isinstance(task_factory, dict) and task_factory.get('type') == 'taskPerFile':
+        sources.append(task_factory.get('source'))
+    fileutils.prefetch_container_lists(sources)
 
 
 def should_get_pool(tasks):
@@ -0,0 +1,133 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+# This module is also used by the file egress uploader where the CLI is installed, so it
+# depends only on the standard library.
+
+import threading
+import time
+
+
+class TransferTuner(object):
+    """Tunes the number of concurrent connections and the size of the blocks used by blob
+    transfers, from the throughput measured as transfers complete. The connections are
+    hill-climbed: they keep changing in the same direction, in growing steps, while the
+    throughput improves, and change back once it doesn't. They are halved when the
+    storage service responds that it is busy.
+    :param int connections: The initial number of concurrent connections.
+    :param int max_connections: The maximum number of concurrent connections.
+    :param int max_block_size: The largest block size to use.
+    """
+
+    SAMPLE_PERIOD = 2.0  # Seconds of transfers measured per throughput sample
+    MIN_IMPROVEMENT = 0.05  # Relative change in throughput taken as an improvement
+    BLOCK_DURATION = 2.0  # Seconds a block should take to transfer over one connection
+    THROTTLING_STATUS_CODES = (500, 503)  # Operation timed out, and server busy
+
+    def __init__(self, connections, max_connections, max_block_size):
+        if connections < 1 or max_connections < connections:
+            raise ValueError('The initial connections must be between 1 and {}.'.format(
+                max_connections))
+        self.connections = connections
+        self.max_connections = max_connections
+        self.max_block_size = max_block_size
+        self.lock = threading.Lock()
+        self._step = 1
+        self._throughput = None  # Bytes per second of the previous sample
+        self._connection_throughput = None  # Bytes per second of one connection
+        self._sample_start = None
+        self._sample_bytes = 0
+        self._throttled_at = None
+
+    def get_connections(self, blocks=None, max_connections=None):
+        """Get the number of connections to use for a transfer.
+        :param int blocks: The number of blocks or ranges of the transfer, if known.
+        :param int max_connections: A limit on the connections, if supplied by the user.
+        """
+        connections = self.connections
+        if max_connections:
+            connections = min(connections, max_connections)
+        if blocks:
+            connections = min(connections, blocks)
+        return max(1, connections)
+
+    def get_block_size(self, size, min_block_size, connections=1):
+        """Get the size of the blocks in which to upload a file. Blocks are sized to take a
+        couple of seconds over one connection, leaving enough blocks to keep each of the
+        connections busy.
+        :param int size: The size of the file.
+        :param int min_block_size: The default block size, which is doubled as needed.
+        :param int connections: The number of connections used to upload the file.
+        """
+        with self.lock:
+            connection_throughput = self._connection_throughput
+        block_size = min_block_size
+        if connection_throughput:
+            target = min(self.max_block_size, connection_throughput * self.BLOCK_DURATION)
+            while block_size * 2 <= target:
+                block_size *= 2
+        while block_size > min_block_size and block_size * connections > size:
+            block_size //= 2
+        return max(block_size, min_block_size)
+
+    def record(self, size, start):
+        """Record a completed transfer, adjusting the connections once enough transfers
+        have been measured.
+        :param int size: The number of bytes transferred.
+        :param float start: The time at which the transfer started.
+        """
+        now = time.time()
+        with self.lock:
+            if self._sample_start is None:
+                self._sample_start = start
+            self._sample_bytes += size
+            elapsed = now - self._sample_start
+            if elapsed < self.SAMPLE_PERIOD:
+                return
+            throughput = self._sample_bytes / elapsed
+            self._sample_start = now
+            self._sample_bytes = 0
+            self._connection_throughput = throughput / self.connections
+            if self._throughput is not None:
+                if throughput > self._throughput * (1 + self.MIN_IMPROVEMENT):
+                    self._step = self._step * 2
+                else:
+                    self._step = -1 if self._step > 0 else 1
+            self._throughput = throughput
+            self._step = max(-self.connections // 2, min(self._step, self.connections))
+            self.connections = max(1, min(self.max_connections, self.connections + self._step))
+
+    def record_throttling(self):
+        """Halve the connections after the storage service responds that it is busy. The
+        responses to requests already in flight are ignored."""
+        now = time.time()
+        with self.lock:
+            if self._throttled_at is not None and \
+                    now - self._throttled_at < self.SAMPLE_PERIOD:
+                return
+            self._throttled_at = now
+            self.connections = max(1, self.connections // 2)
+            self._step = 1
+            self._throughput = None
+            self._sample_start = None
+            self._sample_bytes = 0
+
+    def watch(self, client):
+        """Watch the responses received by a storage client for throttling, chaining any
+        response callback already set on the client.
+        :param client: The storage service client.
+        """
+        previous = getattr(client, 'response_callback', None)
+        if getattr(previous, 'tuner', None) is self:
+            return
+
+        def callback(response):
+            if response.status in self.THROTTLING_STATUS_CODES:
+                self.record_throttling()
+            if previous:
+                previous(response)
+
+        callback.tuner = self
+        client.response_callback = callback
@@ -5,6 +5,7 @@
 
 import os
 import json
+import time
 try:
     from urllib.parse import urlsplit
 except ImportError:
@@ -13,10 +14,15 @@ except ImportError:
 from msrest.serialization import Deserializer
 from msrest.exceptions import DeserializationError
 
+from msrestazure.azure_exceptions import CloudError
 from azure.mgmt.batch import BatchManagementClient
 
 from azure.cli.core._config import az_config
 from azure.cli.core.commands.client_factory import get_mgmt_service_client
+from azure.cli.command_modules.batch_extensions._cache_utils import (
+    get_account_cache, hash_content)
+
+_ACCOUNT_INDEX_VERSION = '1'
 
 
 # COMPLETER
@@ -188,6 +194,32 @@ def validate_file_destination(namespace):
         namespace.destination = file_path
 
 
+def _find_account_id(client, account_name, host, refresh=False):
+    """Find the resource ID of a Batch account from its endpoint. The resource IDs of
+    every account in the subscription are cached, indexed by name and endpoint, so
+    that the subscription is only listed when the index is missing or out of date.
+    :param client: The Batch management client.
+    :param str account_name: The name of the Batch account.
+    :param str host: The host name of the account endpoint.
+    :param bool refresh: Whether to rebuild the index, ignoring the cached index.
+    :returns: The resource ID of the account, or None if it was not found.
+    """
+    cache, ttl = get_account_cache()
+    cache_key = hash_content(_ACCOUNT_INDEX_VERSION, client.config.subscription_id)
+    account_key = '{}/{}'.format(account_name, host)
+    index = cache.get(cache_key)
+    if index and not refresh and 0 <= time.time() - index.get('time', 0) < ttl:
+        try:
+            return index['accounts'][account_key]
+        except KeyError:
+            pass  # The account may have been created since the index was built
+    accounts = {}
+    for account in client.batch_account.list():
+        accounts['{}/{}'.format(account.name, account.account_endpoint)] = account.id
+    cache.set(cache_key, {'time': time.time(), 'accounts': accounts})
+    return accounts.get(account_key)
+
+
 def validate_client_parameters(namespace):
     """Retrieves Batch connection parameters from environment variables"""
 
@@ -201,18 +233,23 @@ def validate_client_parameters(namespace):
 
     # if account name is specified but no key, attempt to query
     if namespace.account_name and namespace.account_endpoint and not namespace.account_key:
+        from azure.cli.core.commands.arm import parse_resource_id
         endpoint = urlsplit(namespace.account_endpoint)
         host = endpoint.netloc
         client = get_mgmt_service_client(BatchManagementClient)
-        acc = next((x for x in client.batch_account.list()
-                    if x.name == namespace.account_name and x.account_endpoint == host), None)
-        if acc:
-            from azure.cli.core.commands.arm import parse_resource_id
-            rg = parse_resource_id(acc.id)['resource_group']
-            namespace.account_key = \
-                client.batch_account.get_keys(rg, namespace.account_name).primary  # pylint: disable=no-member
-        else:
-            raise ValueError("Batch account '{}' not found.".format(namespace.account_name))
+        for refresh in [False, True]:
+            account_id = _find_account_id(client, namespace.account_name, host, refresh)
+            if not account_id:
+                raise ValueError("Batch account '{}' not found.".format(namespace.account_name))
+            rg = parse_resource_id(account_id)['resource_group']
+            try:
+                namespace.account_key = \
+                    client.batch_account.get_keys(rg, namespace.account_name).primary  # pylint: disable=no-member
+                break
+            except CloudError:
+                if refresh:
+                    raise
+                # The account may have moved since the index was built
     else:
         if not namespace.account_name:
             raise ValueError("Need specifiy batch account in command line or enviroment variable.")
@@ -14,6 +14,7 @@ custom_path = 'azure.cli.command_modules.batch_extensions.custom#{}'
 # NCJ Commands
 
 cli_command(__name__, 'batch file upload', custom_path.format('upload_file'), account_mgmt_client_factory)
+cli_command(__name__, 'batch file sync', custom_path.format('sync_file'), account_mgmt_client_factory)
 cli_command(__name__, 'batch file download', custom_path.format('download_file'), account_mgmt_client_factory)
 
 cli_command(__name__, 'batch pool create', custom_path.format('create_pool'), batch_data_service_factory)
@@ -6,13 +6,15 @@
 import json
 import os
 import errno
+import itertools
 
 from azure.batch.models import (
     PoolAddParameter, CloudServiceConfiguration, VirtualMachineConfiguration,
     ImageReference, PoolInformation, JobAddParameter, JobManagerTask,
     JobConstraints, StartTask, JobAddOptions, PoolAddOptions)
 from azure.cli.command_modules.batch_extensions._file_utils import (
-    FileUtils, resolve_file_paths, upload_blob, resolve_remote_paths, download_blob)
+    FileUtils, SyncManifest, iter_file_paths, upload_blobs, resolve_remote_paths,
+    download_blobs, touch_container)
 import azure.cli.command_modules.batch_extensions._template_utils as template_utils
 import azure.cli.command_modules.batch_extensions._pool_utils as pool_utils
 import azure.cli.command_modules.batch_extensions._job_utils as job_utils
@@ -62,7 +64,9 @@ def create_pool(client, account_name=None, account_endpoint=None,  # pylint:disa
         # - Resource Files
         # - etc
         file_utils = FileUtils(None, account_name, None, account_endpoint)
-        json_obj = template_utils.post_processing(json_obj, file_utils)
+        template_utils.prefetch_resource_files(json_obj, file_utils)
+        json_obj = template_utils.post_processing(
+            json_obj, file_utils, lambda: pool_utils.get_pool_target_os_type(json_obj))
 
         # Batch Shipyard integration
         if 'clientExtensions' in json_obj and 'dockerOptions' in json_obj['clientExtensions']:
@@ -133,8 +137,11 @@ def create_job(client, account_name=None, account_endpoint=None,  # pylint:disab
                pool_id=None, priority=None, uses_task_dependencies=False, metadata=None,
                job_max_wall_clock_time=None, job_max_task_retry_count=None,
                job_manager_task_command_line=None, job_manager_task_environment_settings=None,
-               job_manager_task_id=None, job_manager_task_resource_files=None):
+               job_manager_task_id=None, job_manager_task_resource_files=None,
+               task_submission_threads=None):
     # pylint: disable=too-many-branches, too-many-statements
+    auto_complete = False
+    task_collection = []
     if template or json_file:
         working_folder = '.'
         if template:
@@ -160,12 +167,17 @@ def create_job(client, account_name=None, account_endpoint=None,  # pylint:disab
             logger.warning('You are using an experimental feature {Application Templates}.')
             json_obj = template_utils.expand_application_template(json_obj, working_folder)
 
-        auto_complete = False
-        task_collection = []
+        task_templates = []
         file_utils = FileUtils(None, account_name, None, account_endpoint)
+        template_utils.prefetch_resource_files(json_obj, file_utils)
         if 'taskFactory' in json_obj:
             logger.warning('You are using an experimental feature {Task Factory}.')
+            task_factory = json_obj['taskFactory']
             task_collection = template_utils.expand_task_factory(json_obj, file_utils)
+            # Tasks are generated lazily, so inspect the templates they are generated from
+            # to determine the requirements of the job.
+            task_templates = template_utils.get_task_factory_templates(
+                task_factory, task_collection)
 
             # If job has a task factory and terminate job on all tasks complete is set, the job will
             # already be terminated when we add the tasks, so we need to set to noAction, then patch
@@ -174,7 +186,7 @@ def create_job(client, account_name=None, account_endpoint=None,  # pylint:disab
                 auto_complete = json_obj['onAllTasksComplete']
                 json_obj['onAllTasksComplete'] = 'noaction'
 
-        should_get_pool = template_utils.should_get_pool(task_collection)
+        should_get_pool = template_utils.should_get_pool(task_templates)
         pool_os_flavor = None
         if should_get_pool:
             pool = job_utils.get_target_pool(client, json_obj)
@@ -195,24 +207,43 @@ def create_job(client, account_name=None, account_endpoint=None,  # pylint:disab
         commands = []
         # Handle package management on tasks
         commands.append(template_utils.process_task_package_references(
-            task_collection, pool_os_flavor))
+            task_templates, pool_os_flavor))
+
+        target_pools = [pool] if should_get_pool else []
+        pool_os_flavors = []
+
+        def get_pool():
+            # The pool is only fetched if compressed or packed resource files need a
+            # command line to decompress or extract them
+            if not target_pools:
+                target_pools.append(job_utils.get_target_pool(client, json_obj))
+            return target_pools[0]
+
+        def get_pool_os_flavor():
+            if not pool_os_flavors:
+                pool_os_flavors.append(
+                    pool_os_flavor or pool_utils.get_pool_target_os_type(get_pool()))
+            return pool_os_flavors[0]
 
         # Handle any special post-processing steps.
         # - Application templates
         # - Resource Files
         # - Output Files
         # - etc
-        json_obj = template_utils.post_processing(json_obj, file_utils)
-        if task_collection:
-            task_collection = template_utils.post_processing(task_collection, file_utils)
-
+        json_obj = template_utils.post_processing(
+            json_obj, file_utils, get_pool_os_flavor, get_pool)
         commands.append(template_utils.process_job_for_output_files(
-            json_obj, task_collection, pool_os_flavor, file_utils))
+            json_obj, task_templates, pool_os_flavor, file_utils))
         json_obj['jobPreparationTask'] = template_utils.construct_setup_task(
             json_obj.get('jobPreparationTask'), commands, pool_os_flavor)
+        if task_templates:
+            # Generated tasks are processed as they are submitted, other than the first
+            # task and merge task, which are processed before the job is added.
+            task_collection = template_utils.process_task_collection(
+                task_collection, pool_os_flavor, file_utils, get_pool_os_flavor, get_pool)
 
         # Batch Shipyard integration
-        if any(t.get('clientExtensions', {}).get('dockerOptions') for t in task_collection):
+        if any(t.get('clientExtensions', {}).get('dockerOptions') for t in task_templates):
             logger.warning('You are using an experimental feature'
                            ' {Job and task creation with Batch Shipyard}.')
             # batchShipyardUtils.createJobAndAddTasks(
@@ -244,12 +275,16 @@ def create_job(client, account_name=None, account_endpoint=None,  # pylint:disab
                                               environment_settings=job_manager_task_environment_settings)  # pylint: disable=line-too-long
             job.job_manager_task = job_manager_task
 
+    # Validate the submission of the tasks before the job is added
+    job_utils.validate_task_submission(template_utils.get_generated_tasks(task_collection),
+                                       task_submission_threads)
+
     def add_job_and_tasks():
         add_option = JobAddOptions()
         client.job.add(job, add_option)
 
         if task_collection:
-            job_utils.deploy_tasks(client, job.id, task_collection)
+            job_utils.deploy_tasks(client, job.id, task_collection, task_submission_threads)
             if auto_complete:
                 # If the option to terminate the job was set, we need to reapply it with a patch
                 # now that the tasks have been added.
@@ -263,40 +298,88 @@ def create_job(client, account_name=None, account_endpoint=None,  # pylint:disab
 create_job.__doc__ = JobAddParameter.__doc__ + "\n" + JobConstraints.__doc__
 
 
+def _upload_files(file_utils, local_path, file_group,  # pylint: disable=too-many-arguments
+                  remote_path=None, flatten=None, max_connections=None, sync=False,
+                  recursive=False, exclude=None, compress=False, pack=False, dedup=False):
+    path, files = iter_file_paths(local_path, recursive, exclude)
+    try:
+        first_file = next(files)
+    except StopIteration:
+        raise ValueError('No files or directories found matching local path {}'.format(local_path))
+    # Deduplicated files are compared by content, whose hashes are cached in the manifest
+    manifest = SyncManifest(path) if sync or dedup else None
+    pending = [itertools.chain([first_file], files)]
+
+    def upload(blob_client):
+        # Files are uploaded as they are found, rather than after enumerating them all.
+        # An upload retried with a new storage key enumerates the files again, as the
+        # rejected upload may have consumed some of them.
+        found = pending.pop() if pending else iter_file_paths(local_path, recursive, exclude)[1]
+        uploads = ((f, os.path.relpath(f, path)) for f in found)
+        upload_blobs(uploads, file_group, blob_client, remote_path=remote_path,
+                     flatten=flatten, max_connections=max_connections, manifest=manifest,
+                     compress=compress, pack=pack, dedup=dedup)
+
+    try:
+        file_utils.storage_operation(upload)
+    finally:
+        if manifest:
+            manifest.save()
+    # Invalidate any cached listings of the file group, including those of other clients
+    file_utils.storage_operation(
+        lambda blob_client: touch_container(blob_client, file_group))
+
+
 def upload_file(client, local_path, file_group,  # pylint: disable=too-many-arguments
-                resource_group=None, account_name=None, remote_path=None, flatten=None):
+                resource_group=None, account_name=None, remote_path=None, flatten=None,
+                max_connections=None, recursive=False, exclude=None, compress=False,
+                pack=False, dedup=False):
     """Upload local file or directory of files to storage"""
     file_utils = FileUtils(client, account_name, resource_group, None)
-    blob_client = file_utils.resolve_storage_account()
-    path, files = resolve_file_paths(local_path)
-    if len(files) > 0:
-        for f in files:
-            file_name = os.path.relpath(f, path)
-            upload_blob(f, file_group, file_name, blob_client,
-                        remote_path=remote_path, flatten=flatten)
-    else:
-        raise ValueError('No files or directories found matching local path {}'.format(local_path))
+    _upload_files(file_utils, local_path, file_group, remote_path=remote_path,
+                  flatten=flatten, max_connections=max_connections,
+                  recursive=recursive, exclude=exclude, compress=compress, pack=pack,
+                  dedup=dedup)
+
+
+def sync_file(client, local_path, file_group,  # pylint: disable=too-many-arguments
+              resource_group=None, account_name=None, remote_path=None, flatten=None,
+              max_connections=None, recursive=False, exclude=None, compress=False,
+              dedup=False):
+    """Upload the local files whose content differs from the files in storage"""
+    file_utils = FileUtils(client, account_name, resource_group, None)
+    _upload_files(file_utils, local_path, file_group, remote_path=remote_path,
+                  flatten=flatten, max_connections=max_connections, sync=True,
+                  recursive=recursive, exclude=exclude, compress=compress, dedup=dedup)
 
 
 def download_file(client, local_path, file_group,  # pylint: disable=too-many-arguments
-                  resource_group=None, account_name=None, remote_path=None, overwrite=False):
+                  resource_group=None, account_name=None, remote_path=None, overwrite=False,
+                  max_connections=None):
     """Download auto-storage file or directory of files to local"""
     file_utils = FileUtils(client, account_name, resource_group, None)
-    blob_client = file_utils.resolve_storage_account()
     if remote_path and not remote_path.endswith('/'):
         remote_path += '/'
-    files = resolve_remote_paths(blob_client, file_group, remote_path)
+    files = file_utils.storage_operation(
+        lambda blob_client: resolve_remote_paths(blob_client, file_group, remote_path))
     if len(files) > 0:
+        downloads = []
+        directories = set()
         for f in files:
             file_name = os.path.realpath(\
                 os.path.join(local_path, f.name[len(remote_path):] if remote_path else f.name))
             if not os.path.exists(file_name) or overwrite:
-                if not os.path.exists(os.path.dirname(file_name)):
-                    try:
-                        os.makedirs(os.path.dirname(file_name))
-                    except OSError as exc: # Guard against race condition
-                        if exc.errno != errno.EEXIST:
-                            raise
-                download_blob(f.name, file_group, file_name, blob_client)
+                downloads.append((f, file_name))
+                directories.add(os.path.dirname(file_name))
+        # Create the directory tree once, before downloading concurrently
+        for directory in directories:
+            try:
+                os.makedirs(directory)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise
+        file_utils.storage_operation(
+            lambda blob_client: download_blobs(downloads, file_group, blob_client,
+                                               max_connections=max_connections))
     else:
         raise ValueError('No files found matching remote path {}'.format(remote_path))
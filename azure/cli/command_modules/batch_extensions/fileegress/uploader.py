@@ -9,6 +9,7 @@ import logging
 import logging.handlers
 import os
 import sys
+import time
 import traceback
 import multiprocessing
 try:
@@ -24,9 +25,16 @@ import azure.storage.blob
 # local imports
 import util
 import configuration
+# The transfer tuner is optional, so that the scripts downloaded to a node
+# are self-contained. Without it the connections used are fixed.
+try:
+    from azure.cli.command_modules.batch_extensions import _transfer_utils
+except ImportError:
+    _transfer_utils = None
 # import typing
 
 _NUM_STORAGE_WORKERS = max(4, multiprocessing.cpu_count())
+_MAX_STORAGE_WORKERS = max(64, _NUM_STORAGE_WORKERS)
 
 
 # predefine WindowsError if we are not on windows
@@ -254,6 +262,16 @@ class FileUploader(object):
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
+        # Tunes the connections used to upload large files, if available,
+        # starting from one per core. The block size of this storage SDK
+        # is fixed.
+        self.tuner = None
+        if _transfer_utils is not None:
+            self.tuner = _transfer_utils.TransferTuner(
+                _NUM_STORAGE_WORKERS,
+                _MAX_STORAGE_WORKERS,
+                azure.storage.blob.BlockBlobService.MAX_BLOCK_SIZE)
+
     def _upload_file(
             self,
             blob_client,  # type: azure.storage.blob.BlockBlobService
@@ -273,11 +291,24 @@ class FileUploader(object):
                          path, container_name, blob_name)
         start_time = util.datetime_utcnow()
 
-        blob_client.create_blob_from_path(
-            container_name,
-            blob_name,
-            path,
-            max_connections=_NUM_STORAGE_WORKERS)
+        if self.tuner is None:
+            blob_client.create_blob_from_path(
+                container_name,
+                blob_name,
+                path,
+                max_connections=_NUM_STORAGE_WORKERS)
+        else:
+            size = os.path.getsize(path)
+            block_size = blob_client.MAX_BLOCK_SIZE
+            blocks = (size + block_size - 1) // block_size
+            self.tuner.watch(blob_client)
+            start = time.time()
+            blob_client.create_blob_from_path(
+                container_name,
+                blob_name,
+                path,
+                max_connections=self.tuner.get_connections(blocks=blocks))
+            self.tuner.record(size, start)
 
         end_time = util.datetime_utcnow()
         self.logger.info(
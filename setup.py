@@ -34,7 +34,8 @@ DEPENDENCIES = [
     'azure-cli-batch'
 ]
 DEPENDENCIES_27 = {
-    ":python_version<'3.4'": ['pathlib>=1.0.1']
+    ":python_version<'3.4'": ['pathlib>=1.0.1'],
+    ":python_version<'3.0'": ['futures']
 }
 
 
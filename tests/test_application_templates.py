@@ -6,9 +6,13 @@
 
 import copy
 import os
+import shutil
+import tempfile
 import unittest
 
+from mock import patch
 from azure.cli.command_modules.batch import _help
+from azure.cli.command_modules.batch_extensions import _cache_utils as cache_utils
 from azure.cli.command_modules.batch_extensions import _template_utils as utils
 
 
@@ -26,6 +30,13 @@ class TestBatchNCJAppTemplates(unittest.TestCase):
         # File path to an application path with parameters
         self.apptemplate_with_params_path = os.path.join(self.data_dir,
             'batch-applicationTemplate-parameters.json')
+
+        # Parsed templates are cached in a temporary directory
+        self.cache_root = tempfile.mkdtemp()
+        patcher = patch.object(cache_utils, '_CACHE_ROOT', self.cache_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_root)
         return super(TestBatchNCJAppTemplates, self).setUp()
 
     def test_batch_ncj_validate_job_requesting_app_template(self):
@@ -0,0 +1,79 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, Mock
+from azure.cli.command_modules.batch_extensions import _cache_utils as utils
+from azure.cli.command_modules.batch_extensions import _template_utils as template_utils
+
+
+class TestBatchNCJCache(unittest.TestCase):
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.cache_root = tempfile.mkdtemp()
+        patcher = patch.object(utils, '_CACHE_ROOT', self.cache_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_root)
+        return super(TestBatchNCJCache, self).setUp()
+
+    def test_batch_ncj_cache_get_and_set(self):
+        cache = utils.FileCache('test', 1024)
+        key = utils.hash_content('content')
+        self.assertEqual(key, utils.hash_content(u'content'))
+        self.assertNotEqual(key, utils.hash_content('con', 'tent'))
+        self.assertIsNone(cache.get(key))
+        cache.set(key, {'value': [1, 'two']})
+        self.assertEqual(cache.get(key), {'value': [1, 'two']})
+        cache.remove(key)
+        self.assertIsNone(cache.get(key))
+
+        with open(os.path.join(cache.directory, 'corrupt.json'), 'w') as cache_file:
+            cache_file.write('{')
+        self.assertIsNone(cache.get('corrupt'))
+
+        cache = utils.FileCache('disabled', 0)
+        cache.set(key, 'value')
+        self.assertIsNone(cache.get(key))
+        self.assertFalse(os.path.exists(cache.directory))
+
+    def test_batch_ncj_cache_evicts_least_recently_used(self):
+        cache = utils.FileCache('test', 250)
+        value = 'x' * 98  # 100 bytes once serialized
+        for index, key in enumerate(['a', 'b']):
+            cache.set(key, value)
+            os.utime(cache._path(key), (index, index))
+        cache.get('a')
+        cache.set('c', value)
+        self.assertEqual(cache.get('a'), value)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), value)
+        self.assertEqual(sorted(os.listdir(cache.directory)), ['a.json', 'c.json'])
+
+    def test_batch_ncj_cache_parsed_templates(self):
+        template_str = '{"value": "[parameters(\'name\')] and [[escaped]"}'
+        template = {"value": "[parameters('name')] and [[escaped]"}
+        validator = Mock(__name__='validator')
+        expressions = template_utils._parse_template_file(template_str, template, validator)
+        self.assertEqual(expressions, {template['value']: [
+            ('parameters', 'name'), ' and [escaped]']})
+        self.assertEqual(validator.call_count, 1)
+
+        expressions = template_utils._parse_template_file(template_str, template, validator)
+        self.assertEqual(validator.call_count, 1)
+        self.assertEqual(expressions, {template['value']: [
+            ['parameters', 'name'], ' and [escaped]']})
+        template['parameters'] = {'name': {'type': 'string'}}
+        resolved = template_utils._parse_template(
+            template, template, {'name': 'cached'}, expressions)
+        self.assertEqual(resolved['value'], 'cached and [escaped]')
+
+        template_utils._parse_template_file(template_str, template, Mock(__name__='other'))
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_root, 'templates'))), 2)
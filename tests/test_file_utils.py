@@ -3,11 +3,27 @@
 # Licensed under the MIT License. See License.txt in the project root for license information.
 # --------------------------------------------------------------------------------------------
 
+import base64
+import gzip
+import hashlib
+import io
+import json
 import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 
+from mock import patch, Mock, ANY
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.blob import Blob, BlobPermissions, BlockBlobService
+from azure.storage.blob.models import BlobPrefix
 from azure.cli.command_modules.batch import _help
+from azure.cli.command_modules.batch_extensions import _cache_utils as cache_utils
 from azure.cli.command_modules.batch_extensions import _file_utils as utils
+from azure.cli.command_modules.batch_extensions import custom
 
 
 class TestBatchNCJFiles(unittest.TestCase):
@@ -16,6 +32,10 @@ class TestBatchNCJFiles(unittest.TestCase):
     def setUp(self):
         self.win_base = os.path.join(os.path.dirname(__file__), 'data')
         self.nix_base = self.win_base.replace('\\', '/')
+        # Each test starts with an untuned transfer tuner
+        patcher = patch.object(utils, '_transfer_tuner', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
         return super(TestBatchNCJFiles, self).setUp()
 
     def test_batch_ncj_generate_container_from_filegroup(self):
@@ -175,3 +195,1016 @@ class TestBatchNCJFiles(unittest.TestCase):
         self.assertEqual(resources[1]['blobSource'],
                          "https://blob.fgrp-data/subdir/more/data2.txt")
         self.assertEqual(resources[1]['filePath'], "subdir/more/data2.txt")
+
+    def test_batch_ncj_list_container_contents_sas(self):
+        blob_service = Mock()
+        blob_service.list_blobs.return_value = [Mock(), Mock()]
+        blob_service.list_blobs.return_value[0].name = 'data/first file.txt'
+        blob_service.list_blobs.return_value[1].name = 'other.txt'
+        blob_service.make_blob_url.side_effect = \
+            lambda container, name, sas_token: 'https://blob/{}/{}?{}'.format(
+                container, name, sas_token)
+        blob_service.generate_blob_shared_access_signature.return_value = 'blobsas'
+        blob_service.generate_container_shared_access_signature.return_value = 'containersas'
+
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        file_utils.use_container_sas = False
+        blobs = file_utils.list_container_contents({'fileGroup': 'data'}, 'fgrp-data', blob_service)
+        self.assertEqual(blobs[0]['url'], 'https://blob/fgrp-data/data/first%20file.txt?blobsas')
+        self.assertEqual(blob_service.generate_blob_shared_access_signature.call_count, 2)
+
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        file_utils.use_container_sas = True
+        blobs = file_utils.list_container_contents(
+            {'fileGroup': 'data', 'prefix': 'data/'}, 'fgrp-data', blob_service)
+        self.assertEqual([b['url'] for b in blobs],
+                         ['https://blob/fgrp-data/data/first%20file.txt?containersas'])
+        file_utils.list_container_contents({'fileGroup': 'data'}, 'fgrp-data', blob_service)
+        self.assertEqual(file_utils.get_container_read_sas('fgrp-data', blob_service),
+                         'containersas')
+        blob_service.generate_container_shared_access_signature.assert_called_once_with(
+            'fgrp-data', permission=BlobPermissions.READ, start=ANY, expiry=ANY)
+        self.assertEqual(blob_service.generate_blob_shared_access_signature.call_count, 2)
+
+    def test_batch_ncj_list_container_contents_prefix(self):
+        names = ['input/b.txt', 'input/a.txt', 'inputs.txt', 'output/c.txt', 'input']
+
+        def list_blobs(container, prefix=None):  # pylint: disable=unused-argument
+            blobs = []
+            for name in names:
+                if not prefix or name.startswith(prefix):
+                    blobs.append(Mock())
+                    blobs[-1].name = name
+            return blobs
+
+        blob_service = Mock()
+        blob_service.list_blobs.side_effect = list_blobs
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        file_utils.use_container_sas = True
+        source = {'fileGroup': 'data', 'prefix': 'input/'}
+        blobs = file_utils.list_container_contents(source, 'fgrp-data', blob_service)
+        self.assertEqual([b['filePath'] for b in blobs], ['input/a.txt', 'input/b.txt'])
+        blob_service.list_blobs.assert_any_call('fgrp-data', prefix='input/')
+        # The pack directory is listed once for listings of any prefix
+        blob_service.list_blobs.assert_any_call('fgrp-data', prefix='.packs/')
+        self.assertEqual(blob_service.list_blobs.call_count, 2)
+
+        source['prefix'] = 'input/a'
+        blobs = file_utils.list_container_contents(source, 'fgrp-data', blob_service)
+        self.assertEqual([b['filePath'] for b in blobs], ['input/a.txt'])
+        self.assertEqual(blob_service.list_blobs.call_count, 2)
+
+        file_utils.MAX_PREFIX_LISTINGS = 2
+        source['prefix'] = 'output/'
+        file_utils.list_container_contents(source, 'fgrp-data', blob_service)
+        source['prefix'] = 'input'
+        blobs = file_utils.list_container_contents(source, 'fgrp-data', blob_service)
+        self.assertEqual([b['filePath'] for b in blobs],
+                         ['input', 'input/a.txt', 'input/b.txt', 'inputs.txt'])
+        blob_service.list_blobs.assert_called_with('fgrp-data', prefix=None)
+        self.assertEqual(blob_service.list_blobs.call_count, 4)
+
+        del source['prefix']
+        blobs = file_utils.list_container_contents(source, 'fgrp-data', blob_service)
+        self.assertEqual(len(blobs), 5)
+        self.assertEqual(blob_service.list_blobs.call_count, 4)
+
+    def test_batch_ncj_prefetch_container_lists(self):
+        blob_service = Mock()
+        blob_service.list_blobs.return_value = []
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        file_utils.resolved_storage_client = blob_service
+        file_utils.prefetch_container_lists([
+            {'fileGroup': 'data', 'prefix': 'input/'},
+            {'fileGroup': 'data', 'prefix': 'input/a'},
+            {'fileGroup': 'data', 'prefix': 'output/'},
+            {'fileGroup': 'more'},
+            {'fileGroup': 'more', 'prefix': 'input/'},
+            {'fileGroup': 'bad#name'},
+            {'url': 'https://host/file'}])
+        listed = sorted(c[1].get('prefix') or '' for c in blob_service.list_blobs.call_args_list)
+        self.assertEqual(listed, ['', '.packs/', 'input/', 'output/'])
+        self.assertEqual(sorted(file_utils.resource_file_cache), ['fgrp-more'])
+        self.assertEqual(sorted(file_utils.resource_file_prefix_cache['fgrp-data']),
+                         ['input/', 'output/'])
+
+        file_utils.list_container_contents(
+            {'fileGroup': 'data', 'prefix': 'input/b'}, 'fgrp-data', blob_service)
+        file_utils.list_container_contents({'fileGroup': 'more'}, 'fgrp-more', blob_service)
+        self.assertEqual(blob_service.list_blobs.call_count, 4)
+
+    def test_batch_ncj_listing_cache(self):
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        blob_service = Mock(account_name='account')
+        blob_service.list_blobs.return_value = [Mock()]
+        blob_service.list_blobs.return_value[0].name = 'input/a.txt'
+        blob_service.get_container_properties.return_value.properties.etag = '"etag1"'
+        source = {'fileGroup': 'data', 'prefix': 'input/'}
+
+        def list_contents():
+            file_utils = utils.FileUtils(None, 'account', None, None)
+            file_utils.use_container_sas = True
+            return file_utils.list_container_contents(source, 'fgrp-data', blob_service)
+
+        with patch.object(cache_utils, '_CACHE_ROOT', cache_root), \
+                patch.object(utils.az_config, 'getint', return_value=60):
+            # Each listing of the prefix also lists the pack directory
+            self.assertEqual(list_contents()[0]['filePath'], 'input/a.txt')
+            self.assertEqual(list_contents()[0]['filePath'], 'input/a.txt')
+            self.assertEqual(blob_service.list_blobs.call_count, 2)
+
+            blob_service.get_container_properties.return_value.properties.etag = '"etag2"'
+            list_contents()
+            self.assertEqual(blob_service.list_blobs.call_count, 4)
+
+            with patch.object(utils.time, 'time', return_value=time.time() + 120):
+                list_contents()
+            self.assertEqual(blob_service.list_blobs.call_count, 6)
+
+            blob_service.get_container_properties.side_effect = Exception('Forbidden')
+            list_contents()
+            self.assertEqual(blob_service.list_blobs.call_count, 8)
+
+        with patch.object(cache_utils, '_CACHE_ROOT', cache_root):
+            list_contents()
+            self.assertEqual(blob_service.list_blobs.call_count, 10)
+
+    @patch.object(utils, 'get_mgmt_service_client')
+    def test_batch_ncj_resolve_storage_account_cache(self, mock_storage_client):
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        account = Mock(location='westus',
+                       id='/subscriptions/sub/resourceGroups/rg/providers/'
+                          'Microsoft.Batch/batchAccounts/account')
+        account.name = 'account'
+        account.auto_storage.storage_account_id = \
+            '/subscriptions/sub/resourceGroups/srg/providers/Microsoft.Storage/' \
+            'storageAccounts/storage'
+        client = Mock()
+        client.config.subscription_id = 'sub'
+        client.list.return_value = [account]
+        client.get.return_value = account
+        list_keys = mock_storage_client.return_value.storage_accounts.list_keys
+        list_keys.return_value.keys = [Mock(value='a2V5')]
+        endpoint = 'https://account.westus.batch.azure.com'
+
+        with patch.object(cache_utils, '_CACHE_ROOT', cache_root), \
+                patch.object(utils.az_config, 'getint', return_value=3600):
+            file_utils = utils.FileUtils(client, 'account', None, endpoint)
+            self.assertEqual(file_utils.resolve_storage_account().account_name, 'storage')
+            list_keys.assert_called_once_with('srg', 'storage')
+            self.assertEqual(client.list.call_count, 1)
+            self.assertFalse(file_utils.storage_key_cached)
+
+            file_utils = utils.FileUtils(client, 'account', None, endpoint)
+            self.assertEqual(file_utils.resolve_storage_account().account_name, 'storage')
+            self.assertTrue(file_utils.storage_key_cached)
+            self.assertEqual(list_keys.call_count, 1)
+
+            # A rejected key is refreshed, and the operation retried
+            operation = Mock(side_effect=[utils.AzureHttpError('Forbidden', 403), 'result'])
+            self.assertEqual(file_utils.storage_operation(operation), 'result')
+            self.assertEqual(list_keys.call_count, 2)
+            self.assertEqual(operation.call_count, 2)
+            client.get.assert_called_once_with('rg', 'account')
+            operation = Mock(side_effect=utils.AzureHttpError('Forbidden', 403))
+            with self.assertRaises(utils.AzureHttpError):
+                file_utils.storage_operation(operation)
+            self.assertEqual(operation.call_count, 1)
+
+            # Once expired, the account is looked up directly in its cached resource group
+            with patch.object(utils.time, 'time', return_value=time.time() + 7200):
+                file_utils = utils.FileUtils(client, 'account', None, endpoint)
+                file_utils.resolve_storage_account()
+            self.assertEqual(client.get.call_count, 2)
+            self.assertEqual(client.list.call_count, 1)
+            self.assertEqual(list_keys.call_count, 3)
+
+        # By default only the account is cached, and the key is looked up every time
+        def getint(section, option, fallback):  # pylint: disable=unused-argument
+            return 0 if option == 'storage_key_cache_ttl' else 3600
+
+        with patch.object(cache_utils, '_CACHE_ROOT', cache_root), \
+                patch.object(utils.az_config, 'getint', side_effect=getint):
+            lookups = []
+            for _ in range(2):
+                file_utils = utils.FileUtils(client, 'account', None, endpoint)
+                self.assertEqual(file_utils.resolve_storage_account().account_name, 'storage')
+                self.assertFalse(file_utils.storage_key_cached)
+                lookups.append((list_keys.call_count, client.get.call_count))
+            self.assertEqual(lookups[1], (lookups[0][0] + 1, lookups[0][1]))
+        for root, _, names in os.walk(cache_root):
+            for name in names:
+                with open(os.path.join(root, name)) as cache_file:
+                    self.assertNotIn('a2V5', cache_file.read())
+
+    def test_batch_ncj_upload_blobs_connection_budget(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        files = []
+        for index, size in enumerate([100, 5, 5, 5, 5, 5, 5, 5]):
+            path = os.path.join(local_dir, 'file{}.txt'.format(index))
+            with open(path, 'w') as local_file:
+                local_file.write('x' * size)
+            files.append((path, os.path.basename(path)))
+
+        lock = threading.Lock()
+        in_use = [0, 0]  # Current and maximum number of connections in use
+
+        def upload(**kwargs):
+            with lock:
+                in_use[0] += kwargs['max_connections']
+                in_use[1] = max(in_use)
+            time.sleep(0.01)
+            with lock:
+                in_use[0] -= kwargs['max_connections']
+
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=50, MAX_BLOCK_SIZE=10)
+        blob_service.create_container.return_value = True
+        blob_service.create_blob_from_path.side_effect = upload
+        with patch.object(utils, '_upload_blob_blocks') as mock_upload_blocks:
+            mock_upload_blocks.side_effect = \
+                lambda *args, **kwargs: upload(max_connections=args[-1])
+            utils.upload_blobs(files, 'data', blob_service, max_connections=3)
+        self.assertEqual(blob_service.create_blob_from_path.call_count, 7)
+        self.assertLessEqual(in_use[1], 3)
+        connections = {c[1]['blob_name']: c[1]['max_connections']
+                       for c in blob_service.create_blob_from_path.call_args_list}
+        self.assertEqual(connections['file1.txt'], 1)
+        self.assertEqual(mock_upload_blocks.call_args[0][2], 'file0.txt')
+        self.assertIn(mock_upload_blocks.call_args[0][-1], [1, 2, 3])
+
+        blob_service.create_blob_from_path.side_effect = ValueError('Upload failed')
+        with self.assertRaises(ValueError):
+            utils.upload_blobs(files[1:], 'data', blob_service, max_connections=2)
+        with self.assertRaises(ValueError):
+            utils.upload_blobs(files, 'data', blob_service, max_connections=0)
+
+    def test_batch_ncj_upload_files_retried_with_new_key(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        names = ['file{}.txt'.format(index) for index in range(5)]
+        for name in names:
+            with open(os.path.join(local_dir, name), 'w') as local_file:
+                local_file.write(name)
+
+        uploaded = []
+
+        def upload(container_name, blob_name, **kwargs):  # pylint: disable=unused-argument
+            if len(uploaded) == 2 and not upload.rejected:
+                upload.rejected = True
+                raise AzureHttpError('Forbidden', 403)
+            uploaded.append(blob_name)
+
+        upload.rejected = False
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=1000, MAX_BLOCK_SIZE=100)
+        blob_service.list_blobs.return_value = []
+        blob_service.get_container_metadata.return_value = {}
+        blob_service.create_blob_from_path.side_effect = upload
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        file_utils.storage_key_cached = True
+        with patch.object(file_utils, 'resolve_storage_account', return_value=blob_service), \
+                patch.object(file_utils, 'invalidate_storage_account') as mock_invalidate:
+            custom._upload_files(file_utils, local_dir, 'data', max_connections=1)  # pylint: disable=protected-access
+        mock_invalidate.assert_called_once_with()
+        # The files enumerated before the key was rejected are uploaded by the retry
+        self.assertTrue(upload.rejected)
+        self.assertEqual(sorted(set(uploaded)), names)
+        # The container is touched to invalidate cached listings, even if this client
+        # doesn't cache them
+        self.assertEqual(file_utils.listing_cache_ttl, 0)
+        blob_service.set_container_metadata.assert_called_once_with(
+            'fgrp-data', {'lastupload': ANY})
+
+    def test_batch_ncj_download_blobs(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        blobs = []
+        for index, size in enumerate([100, 5, 5]):
+            blob = Mock()
+            blob.name = 'file{}.txt'.format(index)
+            blob.properties.content_length = size
+            blobs.append((blob, os.path.join(local_dir, blob.name)))
+
+        def download(container, blob_name, stream, **kwargs):  # pylint: disable=unused-argument
+            self.assertEqual(container, 'fgrp-data')
+            # Large blobs are preallocated, as their ranges may be written in any order
+            self.assertEqual(os.fstat(stream.fileno()).st_size,
+                             100 if blob_name == 'file0.txt' else 5)
+            if blob_name == 'file2.txt':
+                raise ValueError('Download failed')
+
+        blob_service = Mock(MAX_SINGLE_GET_SIZE=32, MAX_CHUNK_GET_SIZE=4)
+        blob_service.get_blob_to_stream.side_effect = download
+        utils.download_blobs(blobs[:2], 'data', blob_service, max_connections=4)
+        connections = {c[0][1]: c[1]['max_connections']
+                       for c in blob_service.get_blob_to_stream.call_args_list}
+        self.assertEqual(connections['file1.txt'], 1)
+        self.assertIn(connections['file0.txt'], [1, 2, 3, 4])
+        with self.assertRaises(ValueError):
+            utils.download_blobs(blobs[2:], 'data', blob_service)
+        self.assertEqual(sorted(os.listdir(local_dir)), ['file0.txt', 'file1.txt'])
+
+    def test_batch_ncj_upload_blobs_skips_uploaded_files(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        files = []
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            path = os.path.join(local_dir, name)
+            with open(path, 'w') as local_file:
+                local_file.write(name)
+            files.append((path, os.path.join('dir', name)))
+
+        uploaded = []
+        for name, modified in [('a.txt', str(os.path.getmtime(files[0][0]))),
+                               ('b.txt', '0.0')]:
+            blob = Mock(metadata={'lastmodified': modified})
+            blob.name = 'inputs/dir/' + name
+            uploaded.append(blob)
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=50, MAX_BLOCK_SIZE=10)
+        blob_service.create_container.return_value = False
+        blob_service.list_blobs.return_value = uploaded
+        utils.upload_blobs(files, 'data', blob_service, remote_path='inputs/')
+
+        blob_service.create_container.assert_called_once_with('fgrp-data')
+        blob_service.list_blobs.assert_called_once_with(
+            'fgrp-data', prefix='inputs/dir/', delimiter='/', include=ANY)
+        self.assertEqual(blob_service.get_blob_metadata.call_count, 0)
+        self.assertEqual(sorted(c[1]['blob_name']
+                                for c in blob_service.create_blob_from_path.call_args_list),
+                         ['inputs/dir/b.txt', 'inputs/dir/c.txt'])
+
+    def test_batch_ncj_sync_blobs_by_content_hash(self):
+        cache_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_root)
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        files = []
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            path = os.path.join(local_dir, name)
+            with open(path, 'w') as local_file:
+                local_file.write(name)
+            os.utime(path, (1000, 1000))
+            files.append((path, name))
+
+        blob_a = Mock(metadata={'sha256': utils.hash_file(files[0][0]), 'lastmodified': '0.0'})
+        blob_a.name = 'a.txt'
+        blob_b = Mock(metadata={'sha256': 'changed', 'lastmodified': '1000.0'})
+        blob_b.name = 'b.txt'
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=50, MAX_BLOCK_SIZE=10)
+        blob_service.create_container.return_value = False
+        blob_service.list_blobs.return_value = [blob_a, blob_b]
+
+        with patch.object(cache_utils, '_CACHE_ROOT', cache_root):
+            manifest = utils.SyncManifest(local_dir)
+            utils.upload_blobs(files, 'data', blob_service, manifest=manifest)
+            manifest.save()
+            uploads = {c[1]['blob_name']: c[1]['metadata']
+                       for c in blob_service.create_blob_from_path.call_args_list}
+            self.assertEqual(sorted(uploads), ['b.txt', 'c.txt'])
+            self.assertEqual(uploads['c.txt'], {'lastmodified': '1000.0',
+                                                'sha256': utils.hash_file(files[2][0])})
+
+            # Unchanged files are not hashed again
+            manifest = utils.SyncManifest(local_dir)
+            with patch.object(utils, 'hash_file') as mock_hash:
+                self.assertEqual(manifest.get_content_hash(files[2][0]),
+                                 uploads['c.txt']['sha256'])
+                self.assertEqual(mock_hash.call_count, 0)
+                os.utime(files[2][0], (2000, 2000))
+                manifest.get_content_hash(files[2][0])
+                self.assertEqual(mock_hash.call_count, 1)
+
+    def test_batch_ncj_upload_blob_blocks_resumes(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        path = os.path.join(local_dir, 'large.bin')
+        with open(path, 'wb') as local_file:
+            local_file.write(b'0123456789' * 3 + b'end')
+        put_blocks = []
+        failures = [None, None, Exception('Interrupted'), None]
+
+        def put_block(container, blob_name, block, block_id):  # pylint: disable=unused-argument
+            # Blocks are read from the mapped file, and hashed ahead of their upload
+            data = bytes(block.read())
+            self.assertEqual(block.content_md5.result(),
+                             base64.b64encode(hashlib.md5(data).digest()).decode('utf-8'))
+            put_blocks.append((data, block_id))
+            failure = failures.pop(0) if failures else None
+            if failure:
+                raise failure
+
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=20, MAX_BLOCK_SIZE=10)
+        blob_service.get_block_list.side_effect = AzureMissingResourceHttpError('Not found', 404)
+        blob_service.put_block.side_effect = put_block
+        with self.assertRaises(Exception):
+            utils.upload_blob(path, 'data', 'large.bin', blob_service,
+                              uploaded_metadata={}, max_connections=1)
+        self.assertEqual([b[0] for b in put_blocks],
+                         [b'0123456789', b'0123456789', b'0123456789', b'end'])
+        self.assertEqual(len(set(len(b[1]) for b in put_blocks)), 1)
+        self.assertEqual(blob_service.put_block_list.call_count, 0)
+
+        # Blocks 0, 1 and 3 were uploaded before the failure
+        uncommitted = []
+        for data, block_id in [put_blocks[0], put_blocks[1], put_blocks[3]]:
+            uncommitted.append(Mock(id=block_id, size=len(data)))
+        blob_service.get_block_list.side_effect = None
+        blob_service.get_block_list.return_value.uncommitted_blocks = uncommitted
+        uploaded = list(put_blocks)
+        del put_blocks[:]
+        # The interrupted upload is resumed with its own block size, rather than a tuned one
+        with patch.object(utils.get_transfer_tuner(), 'get_block_size', return_value=20):
+            utils.upload_blob(path, 'data', 'large.bin', blob_service,
+                              uploaded_metadata={}, max_connections=2)
+        self.assertEqual(put_blocks, [uploaded[2]])
+        put_blocks = uploaded
+        block_list = blob_service.put_block_list.call_args[0][2]
+        self.assertEqual([b.id for b in block_list], [b[1] for b in put_blocks])
+        self.assertEqual(len(block_list), 4)
+        self.assertEqual(blob_service.put_block_list.call_args[1]['metadata']['lastmodified'],
+                         str(os.path.getmtime(path)))
+
+    def test_batch_ncj_mapped_block_requests(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        path = os.path.join(local_dir, 'large.bin')
+        with open(path, 'wb') as local_file:
+            local_file.write(b'0123456789')
+        mapping, view = utils._map_file(path)
+        block = utils._MappedBlock(view, 2, 5)
+        self.assertEqual(len(block), 5)
+        self.assertEqual(bytes(block.read(3)), b'234')
+        self.assertEqual(bytes(block.read()), b'56')
+        self.assertEqual(block.seek(-2, os.SEEK_END), 3)
+
+        block.content_md5 = Mock()
+        block.content_md5.result.return_value = 'hash'
+        previous = Mock()
+        blob_service = Mock(request_callback=previous)
+        utils._watch_block_requests(blob_service)
+        callback = blob_service.request_callback
+        utils._watch_block_requests(blob_service)
+        self.assertIs(blob_service.request_callback, callback)
+
+        # Each attempt of a request sends the whole block, with its precomputed hash
+        request = Mock(body=block, headers={})
+        blob_service.request_callback(request)
+        self.assertEqual(block.tell(), 0)
+        self.assertEqual(request.headers, {'Content-MD5': 'hash'})
+        blob_service.request_callback(Mock(body=b'data', headers={}))
+        self.assertEqual(previous.call_count, 2)
+        block.close()
+        if view is not mapping:
+            view.release()
+        mapping.close()
+
+    def test_batch_ncj_iter_file_paths(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        for path in ['a.txt', 'b.tmp', 'sub/c.txt', 'sub/d.tmp', 'sub/deeper/e.txt', 'skip/f.txt']:
+            path = os.path.join(local_dir, *path.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as local_file:
+                local_file.write(path)
+
+        def relative_files(*args, **kwargs):
+            root, files = utils.iter_file_paths(*args, **kwargs)
+            self.assertFalse(isinstance(files, list))
+            return sorted(os.path.relpath(f, root).replace('\\', '/') for f in files)
+
+        self.assertEqual(relative_files(local_dir), ['a.txt', 'b.tmp'])
+        self.assertEqual(relative_files(local_dir, recursive=True),
+                         ['a.txt', 'b.tmp', 'skip/f.txt', 'sub/c.txt', 'sub/d.tmp',
+                          'sub/deeper/e.txt'])
+        self.assertEqual(relative_files(local_dir, recursive=True, exclude=['*.tmp', 'skip']),
+                         ['a.txt', 'sub/c.txt', 'sub/deeper/e.txt'])
+        self.assertEqual(relative_files(os.path.join(local_dir, '**', '*.txt'), exclude=['sub/*']),
+                         ['a.txt', 'skip/f.txt'])
+        self.assertEqual(relative_files(os.path.join(local_dir, 'a.txt')), ['a.txt'])
+
+    def test_batch_ncj_uploaded_metadata_by_directory(self):
+        def list_blobs(container, prefix=None, **kwargs):  # pylint: disable=unused-argument
+            blob = Mock(metadata={'lastmodified': prefix})
+            blob.name = '{}file.txt'.format(prefix or '')
+            return [blob, BlobPrefix()]
+
+        blob_service = Mock()
+        blob_service.list_blobs.side_effect = list_blobs
+        uploaded = utils._UploadedMetadata('fgrp-data', blob_service)
+        with patch.object(utils.FileUtils, 'MAX_LISTED_DIRECTORIES', 2):
+            self.assertEqual(uploaded.get('file.txt'), {'lastmodified': None})
+            self.assertEqual(uploaded.get('dir/file.txt'), {'lastmodified': 'dir/'})
+            self.assertIsNone(uploaded.get('dir/other.txt'))
+            self.assertEqual(blob_service.list_blobs.call_count, 2)
+            uploaded.get('file.txt')
+            uploaded.get('other/file.txt')
+            self.assertEqual(blob_service.list_blobs.call_count, 3)
+            uploaded.get('dir/file.txt')
+            self.assertEqual(blob_service.list_blobs.call_count, 4)
+
+    def test_batch_ncj_uploaded_metadata_listed_outside_lock(self):
+        listing = threading.Event()
+        listed = threading.Event()
+        slow_listings = []
+
+        def list_blobs(container, prefix=None, **kwargs):  # pylint: disable=unused-argument
+            if prefix == 'slow/':
+                slow_listings.append(prefix)
+                listing.set()
+                listed.wait(5)
+                slow_listings.remove(prefix)
+            elif prefix == 'fast/':
+                self.assertEqual(slow_listings, ['slow/'])
+            blob = Mock(metadata={'lastmodified': prefix})
+            blob.name = '{}file.txt'.format(prefix)
+            return [blob]
+
+        blob_service = Mock()
+        blob_service.list_blobs.side_effect = list_blobs
+        uploaded = utils._UploadedMetadata('fgrp-data', blob_service)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(uploaded.get('slow/file.txt')))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(listing.wait(5))
+        # Another directory is listed while the slow listing is in progress
+        self.assertEqual(uploaded.get('fast/file.txt'), {'lastmodified': 'fast/'})
+        listed.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [{'lastmodified': 'slow/'}] * 2)
+        self.assertEqual(blob_service.list_blobs.call_count, 2)
+
+        blob_service.list_blobs.side_effect = [ValueError('listing failed'), []]
+        with self.assertRaises(ValueError):
+            uploaded.get('failed/file.txt')
+        self.assertIsNone(uploaded.get('failed/file.txt'))
+
+    def test_batch_ncj_indexed_files_listed_per_container(self):
+        listing = threading.Event()
+        listed = threading.Event()
+        slow_listings = []
+
+        def list_blobs(container, prefix=None, **kwargs):  # pylint: disable=unused-argument
+            if container == 'fgrp-slow':
+                slow_listings.append(container)
+                listing.set()
+                listed.wait(5)
+                slow_listings.remove(container)
+            else:
+                self.assertEqual(slow_listings, ['fgrp-slow'])
+            return []
+
+        blob_service = Mock()
+        blob_service.list_blobs.side_effect = list_blobs
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        results = []
+
+        def list_slow():
+            results.append(file_utils._list_indexed_files('fgrp-slow', blob_service))  # pylint: disable=protected-access
+
+        threads = [threading.Thread(target=list_slow) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        self.assertTrue(listing.wait(5))
+        # Another container is listed while the slow listing is in progress
+        self.assertEqual(file_utils._list_indexed_files('fgrp-fast', blob_service), [])  # pylint: disable=protected-access
+        listed.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, [[], []])
+        self.assertEqual(blob_service.list_blobs.call_count, 2)
+
+    def test_batch_ncj_compressed_blobs(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        path = os.path.join(local_dir, 'data.csv')
+        content = b'1,2,3\n' * 1000
+        with open(path, 'wb') as local_file:
+            local_file.write(content)
+        uploads = []
+
+        def upload(**kwargs):
+            with open(kwargs['file_path'], 'rb') as compressed_file:
+                uploads.append((kwargs, gzip.GzipFile(fileobj=compressed_file).read()))
+
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=1024 * 1024)
+        blob_service.create_blob_from_path.side_effect = upload
+        uploaded = {'data.csv': {'lastmodified': str(os.path.getmtime(path))}}
+        utils.upload_blob(path, 'data', 'data.csv', blob_service, compress=True,
+                          uploaded_metadata=uploaded)
+        kwargs, uploaded_content = uploads[0]
+        self.assertEqual(uploaded_content, content)
+        self.assertEqual(kwargs['content_settings'].content_encoding, 'gzip')
+        self.assertEqual(kwargs['metadata']['originalsize'], str(len(content)))
+        self.assertFalse(os.path.exists(kwargs['file_path']))
+
+        uploaded['data.csv'] = kwargs['metadata']
+        utils.upload_blob(path, 'data', 'data.csv', blob_service, compress=True,
+                          uploaded_metadata=uploaded)
+        self.assertEqual(blob_service.create_blob_from_path.call_count, 1)
+
+        blobs = [Mock(), Mock()]
+        for blob, name, encoding in zip(blobs, ['a.csv', 'b.csv'], ['gzip', None]):
+            blob.name = name
+            blob.properties.content_length = 100
+            blob.properties.content_settings.content_encoding = encoding
+        blob_service = Mock(MAX_SINGLE_GET_SIZE=32, MAX_CHUNK_GET_SIZE=4)
+        blob_service.list_blobs.return_value = blobs
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        file_utils.use_container_sas = True
+        references = file_utils.list_container_contents(
+            {'fileGroup': 'data'}, 'fgrp-data', blob_service)
+        self.assertEqual([r.get('contentEncoding') for r in references], ['gzip', None])
+
+        utils.download_blobs([(b, os.path.join(local_dir, b.name)) for b in blobs],
+                             'data', blob_service, max_connections=4)
+        connections = {c[0][1]: c[1]['max_connections']
+                       for c in blob_service.get_blob_to_stream.call_args_list}
+        self.assertEqual(connections['a.csv'], 1)
+        self.assertEqual(os.path.getsize(os.path.join(local_dir, 'a.csv')), 0)
+        self.assertEqual(os.path.getsize(os.path.join(local_dir, 'b.csv')), 100)
+
+    def test_batch_ncj_download_compressed_blob_in_one_request(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        content = b'1,2,3\n' * 20
+        requests = []
+
+        def get_blob(service, container_name, blob_name, snapshot=None, start_range=None,
+                     end_range=None, **kwargs):  # pylint: disable=unused-argument
+            # Each range of a gzip-encoded blob can't be decoded on its own
+            requests.append((start_range, end_range))
+            # Whether or not the client makes a ranged first request, it covers the blob
+            self.assertGreater(service.MAX_SINGLE_GET_SIZE, len(content))
+            if start_range is not None and end_range - start_range + 1 < len(content):
+                raise ValueError('Ranged request of a compressed blob')
+            blob = Blob(blob_name, content=content)
+            blob.properties.content_length = len(content)
+            blob.properties.content_range = 'bytes 0-{0}/{1}'.format(len(content) - 1,
+                                                                     len(content))
+            return blob
+
+        blob = Mock()
+        blob.name = 'a.csv'
+        blob.properties.content_length = len(content)
+        blob.properties.content_settings.content_encoding = 'gzip'
+        blob_service = BlockBlobService(account_name='account', account_key='a2V5')
+        blob_service.MAX_SINGLE_GET_SIZE = 32
+        with patch.object(BlockBlobService, '_get_blob', autospec=True, side_effect=get_blob):
+            utils.download_blobs([(blob, os.path.join(local_dir, 'a.csv'))], 'data',
+                                 blob_service, max_connections=4)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(blob_service.MAX_SINGLE_GET_SIZE, 32)
+        with open(os.path.join(local_dir, 'a.csv'), 'rb') as local_file:
+            self.assertEqual(local_file.read(), content)
+
+    def test_batch_ncj_packed_blobs(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        files = []
+        for name, size in [('a.txt', 5), ('sub/b.txt', 5), ('sub/c.txt', 5), ('big.txt', 100)]:
+            path = os.path.join(local_dir, *name.split('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as local_file:
+                local_file.write('x' * size)
+            files.append((path, name))
+
+        blobs = {}
+
+        def upload(container_name, blob_name, file_path, **kwargs):  # pylint: disable=unused-argument
+            if blob_name.endswith('.tar'):
+                with tarfile.open(file_path) as shard:
+                    blobs[blob_name] = shard.getnames()
+
+        def get_text(container_name, blob_name):  # pylint: disable=unused-argument
+            if blob_name not in blobs:
+                raise AzureMissingResourceHttpError('Not found', 404)
+            return Mock(content=blobs[blob_name])
+
+        # Pack two of the small files in each shard
+        member_size = io.BytesIO()
+        with tarfile.open(fileobj=member_size, mode='w') as shard:
+            shard.add(files[0][0], arcname=files[0][1])
+            member_size = member_size.tell()
+
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=1000, MAX_BLOCK_SIZE=100)
+        blob_service.create_container.return_value = True
+        blob_service.create_blob_from_path.side_effect = upload
+        blob_service.create_blob_from_text.side_effect = \
+            lambda container_name, blob_name, text, **kwargs: blobs.update({blob_name: text})
+        blob_service.get_blob_to_text.side_effect = get_text
+        with patch.object(utils.FileUtils, 'MAX_PACKED_FILE_SIZE', 50), \
+                patch.object(utils.FileUtils, 'PACK_SHARD_SIZE', 2 * member_size):
+            utils.upload_blobs(iter(files), 'data', blob_service, remote_path='in', pack=True)
+            pack_directory = utils._get_pack_directory('in/')
+            shards = sorted(n for n in blobs if n.endswith('.tar'))
+            shard_directory = shards[0].rpartition('/')[0] + '/'
+            self.assertTrue(shard_directory.startswith(pack_directory))
+            self.assertEqual(shards, [shard_directory + '00000.tar',
+                                      shard_directory + '00001.tar'])
+            self.assertEqual(blobs[shards[0]], ['in/a.txt', 'in/sub/b.txt'])
+            self.assertEqual(blobs[shards[1]], ['in/sub/c.txt'])
+            self.assertEqual(blobs[pack_directory + 'index.json'].count('in/'), 3)
+            uploads = blob_service.create_blob_from_path.call_args_list
+            self.assertEqual(uploads[0][1]['blob_name'], 'in/big.txt')
+            self.assertFalse(any(os.path.exists(c[1]['file_path']) for c in uploads[1:]))
+
+            utils.upload_blobs(iter(files[:3]), 'data', blob_service, remote_path='in', pack=True)
+            self.assertEqual(blob_service.create_blob_from_path.call_count, 3)
+
+            # A changed pack is uploaded to new shards, and the previous shards are only
+            # deleted once the new index references the new shards
+            index = blobs[pack_directory + 'index.json']
+            operations = []
+            blob_service.create_blob_from_text.side_effect = \
+                lambda container_name, blob_name, text, **kwargs: operations.append(('index', text))
+            blob_service.delete_blob.side_effect = \
+                lambda container_name, blob_name: operations.append(('delete', blob_name))
+            os.utime(files[0][0], (0, 0))
+            utils.upload_blobs(iter(files[:3]), 'data', blob_service, remote_path='in', pack=True)
+            self.assertEqual([o[0] for o in operations], ['index', 'delete', 'delete'])
+            self.assertEqual([o[1] for o in operations[1:]], shards)
+            self.assertNotIn(shard_directory, operations[0][1])
+
+            # A failed upload leaves the previous pack referenced, and removes its own shards
+            del operations[:]
+            blob_service.create_blob_from_path.side_effect = \
+                lambda container_name, blob_name, **kwargs: operations.append(('shard', blob_name))
+            blob_service.create_blob_from_text.side_effect = ValueError('Upload failed')
+            os.utime(files[0][0], (1, 1))
+            with self.assertRaises(ValueError):
+                utils.upload_blobs(iter(files[:3]), 'data', blob_service, remote_path='in',
+                                   pack=True)
+            self.assertEqual([o[0] for o in operations], ['shard', 'shard', 'delete', 'delete'])
+            self.assertEqual([o[1] for o in operations[:2]], [o[1] for o in operations[2:]])
+            self.assertEqual(blobs[pack_directory + 'index.json'], index)
+
+        listed = [Mock(), Mock(), Mock()]
+        for blob, name in zip(listed, ['in/big.txt', shards[0], pack_directory + 'index.json']):
+            blob.name = name
+            blob.properties.content_settings.content_encoding = None
+        blob_service.list_blobs.side_effect = \
+            lambda container, prefix=None: [b for b in listed if b.name.startswith(prefix)]
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        file_utils.use_container_sas = True
+        blob_service.make_blob_url.side_effect = \
+            lambda container, name, sas_token: 'https://blob/{}'.format(name)
+        references = file_utils.list_container_contents(
+            {'fileGroup': 'data', 'prefix': 'in/sub/'}, 'fgrp-data', blob_service)
+        self.assertEqual([(r['filePath'], r['pack']) for r in references],
+                         [('in/sub/b.txt', shards[0]), ('in/sub/c.txt', shards[1])])
+        resource_files = utils.convert_blobs_to_resource_files(
+            references, {'source': {'fileGroup': 'data', 'prefix': 'in/sub/'}})
+        self.assertEqual(resource_files, [
+            {'blobSource': 'https://blob/' + shard, 'filePath': shard,
+             'archive': {'directory': '.', 'prefix': 'in/sub/'}} for shard in shards])
+
+        # A file uploaded separately before is deleted once its packed file is uploaded
+        separate = Mock(metadata={'lastmodified': '0'})
+        separate.name = 'in/a.txt'
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=1000, MAX_BLOCK_SIZE=100)
+        blob_service.create_container.return_value = False
+        blob_service.list_blobs.side_effect = \
+            lambda container, prefix=None, **kwargs: [separate] if prefix == 'in/' else []
+        blob_service.get_blob_to_text.side_effect = AzureMissingResourceHttpError('Not found', 404)
+        operations = []
+        blob_service.create_blob_from_text.side_effect = \
+            lambda container_name, blob_name, text, **kwargs: operations.append(('index', blob_name))
+        blob_service.delete_blob.side_effect = \
+            lambda container_name, blob_name: operations.append(('delete', blob_name))
+        with patch.object(utils.FileUtils, 'MAX_PACKED_FILE_SIZE', 50):
+            utils.upload_blobs(iter(files[:2]), 'data', blob_service, remote_path='in', pack=True)
+        self.assertEqual(operations, [('index', pack_directory + 'index.json'),
+                                      ('delete', 'in/a.txt')])
+
+    def test_batch_ncj_packed_blobs_added_to_index(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        files = []
+        for name in ['a.txt', 'b.txt', 'c.txt']:
+            path = os.path.join(local_dir, name)
+            with open(path, 'w') as local_file:
+                local_file.write(name)
+            files.append((path, name))
+
+        index_name = utils._get_pack_directory(None) + 'index.json'  # pylint: disable=protected-access
+        blobs = {}
+        deleted = []
+
+        def set_index(container_name, blob_name, text, **kwargs):  # pylint: disable=unused-argument
+            self.assertEqual(blob_name, index_name)
+            self.assertEqual(kwargs.get('if_match'), blobs.get(blob_name, (None, None))[1])
+            blobs[blob_name] = (text, hashlib.sha256(text.encode('utf-8')).hexdigest())
+
+        def get_text(container_name, blob_name):  # pylint: disable=unused-argument
+            if blob_name not in blobs:
+                raise AzureMissingResourceHttpError('Not found', 404)
+            return Mock(content=blobs[blob_name][0], properties=Mock(etag=blobs[blob_name][1]))
+
+        def indexed():
+            index = json.loads(blobs[index_name][0])
+            return [sorted(f[0] for f in shard['files']) for shard in index['shards']]
+
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=1000, MAX_BLOCK_SIZE=100)
+        blob_service.create_container.return_value = True
+        blob_service.create_blob_from_text.side_effect = set_index
+        blob_service.get_blob_to_text.side_effect = get_text
+        blob_service.delete_blob.side_effect = \
+            lambda container_name, blob_name: deleted.append(blob_name)
+        utils.upload_blobs(iter(files[:2]), 'data', blob_service, pack=True)
+        self.assertEqual(indexed(), [['a.txt', 'b.txt']])
+        first_shard = json.loads(blobs[index_name][0])['shards'][0]['name']
+
+        # Files packed by a later upload are added to the index
+        utils.upload_blobs(iter(files[2:]), 'data', blob_service, pack=True)
+        self.assertEqual(indexed(), [['a.txt', 'b.txt'], ['c.txt']])
+        # A file packed again replaces its entry, and a shard is only deleted once none
+        # of its files are indexed
+        os.utime(files[0][0], (0, 0))
+        utils.upload_blobs(iter(files[:1]), 'data', blob_service, pack=True)
+        self.assertEqual(indexed(), [['b.txt'], ['c.txt'], ['a.txt']])
+        self.assertEqual(deleted, [])
+        os.utime(files[1][0], (0, 0))
+        utils.upload_blobs(iter(files[1:2]), 'data', blob_service, pack=True)
+        self.assertEqual(indexed(), [['c.txt'], ['a.txt'], ['b.txt']])
+        self.assertEqual(deleted, [first_shard])
+
+        # An index updated concurrently is merged again
+        def update_concurrently(container_name, blob_name, text, **kwargs):  # pylint: disable=unused-argument
+            blob_service.create_blob_from_text.side_effect = set_index
+            index = json.loads(blobs[index_name][0])
+            index['shards'].append({'name': 'other.tar', 'files': [['d.txt', 5, 0]]})
+            blobs[index_name] = (json.dumps(index), 'concurrent')
+            raise AzureHttpError('Precondition failed', 412)
+
+        blob_service.create_blob_from_text.side_effect = update_concurrently
+        os.utime(files[2][0], (0, 0))
+        utils.upload_blobs(iter(files[2:]), 'data', blob_service, pack=True)
+        self.assertEqual(indexed(), [['a.txt'], ['b.txt'], ['d.txt'], ['c.txt']])
+
+    def test_batch_ncj_download_packed_blobs(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        shard = io.BytesIO()
+        with tarfile.open(fileobj=shard, mode='w') as archive:
+            for name in ['in/a.txt', 'in/sub/b.txt', 'in/c.txt']:
+                member = tarfile.TarInfo(name)
+                member.size = len(name)
+                archive.addfile(member, io.BytesIO(name.encode('utf-8')))
+        shard_name = utils._get_pack_directory('in') + 'pack/00000.tar'
+        index_name = utils._get_pack_directory('in') + 'index.json'
+        index = {'version': 1, 'shards': [{'name': shard_name, 'files': [
+            ['in/a.txt', 8, 0], ['in/sub/b.txt', 12, 0], ['in/c.txt', 8, 0]]}]}
+
+        listed = []
+        for name in ['in/c.txt', shard_name, index_name]:
+            blob = Mock()
+            blob.name = name
+            blob.properties.content_length = 8
+            blob.properties.content_settings.content_encoding = None
+            listed.append(blob)
+
+        def download(container, blob_name, stream, **kwargs):  # pylint: disable=unused-argument
+            stream.write(shard.getvalue() if blob_name == shard_name else b'separate')
+
+        blob_service = Mock(MAX_SINGLE_GET_SIZE=32, MAX_CHUNK_GET_SIZE=4)
+        blob_service.list_blobs.side_effect = \
+            lambda container, prefix=None: [b for b in listed if b.name.startswith(prefix or '')]
+        blob_service.get_blob_to_text.return_value = Mock(content=json.dumps(index))
+        blob_service.get_blob_to_stream.side_effect = download
+
+        # The shards and index aren't downloaded, but the files packed in them are
+        blobs = utils.resolve_remote_paths(blob_service, 'data', None)
+        self.assertEqual(sorted(b.name for b in blobs), ['in/a.txt', 'in/c.txt', 'in/sub/b.txt'])
+        os.makedirs(os.path.join(local_dir, 'sub'))
+        utils.download_blobs([(b, os.path.join(local_dir, *b.name.split('/')[1:])) for b in blobs],
+                             'data', blob_service)
+        # The shard is downloaded once, and the separately uploaded file takes precedence
+        self.assertEqual(sorted(c[0][1] for c in blob_service.get_blob_to_stream.call_args_list),
+                         sorted(['in/c.txt', shard_name]))
+        for name, content in [('a.txt', 'in/a.txt'), ('sub/b.txt', 'in/sub/b.txt'),
+                              ('c.txt', 'separate')]:
+            with open(os.path.join(local_dir, *name.split('/'))) as local_file:
+                self.assertEqual(local_file.read(), content)
+
+        index['shards'][0]['files'].append(['in/d.txt', 8, 0])
+        blob_service.get_blob_to_text.return_value = Mock(content=json.dumps(index))
+        blobs = [b for b in utils.resolve_remote_paths(blob_service, 'data', 'in/')
+                 if b.name == 'in/d.txt']
+        with self.assertRaises(ValueError):
+            utils.download_blobs([(blobs[0], os.path.join(local_dir, 'd.txt'))], 'data',
+                                 blob_service)
+        self.assertFalse(os.path.exists(os.path.join(local_dir, 'd.txt')))
+
+    def test_batch_ncj_deduplicated_blobs(self):
+        local_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, local_dir)
+        files = []
+        for name, content in [('a.bin', 'shared'), ('b.bin', 'shared'), ('c.bin', 'other')]:
+            path = os.path.join(local_dir, name)
+            with open(path, 'w') as local_file:
+                local_file.write(content)
+            files.append((path, name))
+        shared, other = utils.hash_file(files[0][0]), utils.hash_file(files[2][0])
+
+        stored = set()
+        manifests = {}
+
+        def get_text(container_name, blob_name):
+            if (container_name, blob_name) not in manifests:
+                raise AzureMissingResourceHttpError('Not found', 404)
+            text, etag = manifests[(container_name, blob_name)]
+            return Mock(content=text, properties=Mock(etag=etag))
+
+        def create_text(container_name, blob_name, text, if_match=None, if_none_match=None):
+            etag = manifests.get((container_name, blob_name), (None, None))[1]
+            if (if_none_match and etag) or (if_match and if_match != etag):
+                raise AzureHttpError('Precondition failed', 412)
+            manifests[(container_name, blob_name)] = (text, str(len(manifests)) + text)
+
+        blob_service = Mock(MAX_SINGLE_PUT_SIZE=1000, MAX_BLOCK_SIZE=100,
+                            MAX_SINGLE_GET_SIZE=1000, MAX_CHUNK_GET_SIZE=100)
+        blob_service.create_container.return_value = True
+        blob_service.exists.side_effect = lambda container, name: name in stored
+        blob_service.create_blob_from_path.side_effect = \
+            lambda container_name, blob_name, **kwargs: stored.add(blob_name)
+        blob_service.get_blob_to_text.side_effect = get_text
+        blob_service.create_blob_from_text.side_effect = create_text
+        with self.assertRaises(ValueError):
+            utils.upload_blobs(iter(files), 'data', blob_service, dedup=True, compress=True)
+
+        # Identical files are stored once in the content container
+        utils.upload_blobs(iter(files), 'data', blob_service, remote_path='in', dedup=True)
+        self.assertEqual(sorted(c[1]['container_name'] for c in
+                                blob_service.create_blob_from_path.call_args_list),
+                         ['fgrpcontent', 'fgrpcontent'])
+        self.assertEqual(stored, set([shared, other]))
+        manifest_name = utils._get_pack_directory('in') + 'manifest.json'
+        manifest = json.loads(manifests[('fgrp-data', manifest_name)][0])
+        self.assertEqual(manifest['files'], [['in/a.bin', shared, 6], ['in/b.bin', shared, 6],
+                                             ['in/c.bin', other, 5]])
+
+        # Uploading the same content to another file group only writes its manifest, which
+        # is merged again if it's changed concurrently
+        create_text('fgrp-more', manifest_name, json.dumps({'version': 1, 'files': [
+            ['in/z.bin', other, 5]]}))
+
+        def create_text_once_conflicted(*args, **kwargs):
+            if create_text_once_conflicted.conflicted:
+                return create_text(*args, **kwargs)
+            create_text_once_conflicted.conflicted = True
+            raise AzureHttpError('Precondition failed', 412)
+
+        create_text_once_conflicted.conflicted = False
+        blob_service.create_blob_from_text.side_effect = create_text_once_conflicted
+        utils.upload_blobs(iter(files[:1]), 'more', blob_service, remote_path='in', dedup=True)
+        self.assertEqual(blob_service.create_blob_from_path.call_count, 2)
+        manifest = json.loads(manifests[('fgrp-more', manifest_name)][0])
+        self.assertEqual(manifest['files'], [['in/a.bin', shared, 6], ['in/z.bin', other, 5]])
+
+        # Unchanged files aren't uploaded or listed again
+        blob_service.exists.reset_mock()
+        blob_service.create_blob_from_text.reset_mock()
+        utils.upload_blobs(iter(files), 'data', blob_service, remote_path='in', dedup=True)
+        self.assertEqual(blob_service.exists.call_count, 0)
+        self.assertEqual(blob_service.create_blob_from_text.call_count, 0)
+
+        # Deduplicated files are referenced by a SAS URL of their content
+        listed = [Mock(), Mock()]
+        for blob, name in zip(listed, ['in/c.bin', manifest_name]):
+            blob.name = name
+            blob.properties.content_length = 5
+            blob.properties.content_settings.content_encoding = None
+        blob_service.list_blobs.side_effect = \
+            lambda container, prefix=None: [b for b in listed if b.name.startswith(prefix or '')]
+        blob_service.generate_blob_shared_access_signature.side_effect = \
+            lambda container, name, **kwargs: 'sas-' + container
+        blob_service.make_blob_url.side_effect = \
+            lambda container, name, sas_token: 'https://{}/{}?{}'.format(container, name, sas_token)
+        file_utils = utils.FileUtils(None, 'account', None, None)
+        references = file_utils.list_container_contents(
+            {'fileGroup': 'data', 'prefix': 'in/'}, 'fgrp-data', blob_service)
+        self.assertEqual([(r['filePath'], r['url']) for r in references], [
+            ('in/a.bin', 'https://fgrpcontent/{}?sas-fgrpcontent'.format(shared)),
+            ('in/b.bin', 'https://fgrpcontent/{}?sas-fgrpcontent'.format(shared)),
+            ('in/c.bin', 'https://fgrp-data/in/c.bin?sas-fgrp-data')])
+        self.assertEqual(blob_service.generate_blob_shared_access_signature.call_count, 2)
+        with self.assertRaises(ValueError):
+            utils.FileUtils(None, 'account', None, None).list_container_contents(
+                {'containerUrl': 'https://account/fgrp-data?sas', 'prefix': 'in/a'},
+                'fgrp-data', blob_service)
+
+        # ...and are downloaded from their content
+        blobs = utils.resolve_remote_paths(blob_service, 'data', 'in/')
+        self.assertEqual(sorted(b.name for b in blobs), ['in/a.bin', 'in/b.bin', 'in/c.bin'])
+        utils.download_blobs([(b, os.path.join(local_dir, 'out-' + os.path.basename(b.name)))
+                              for b in blobs], 'data', blob_service)
+        downloads = sorted(c[0][:2] for c in blob_service.get_blob_to_stream.call_args_list)
+        self.assertEqual(downloads, sorted([('fgrpcontent', shared), ('fgrpcontent', shared),
+                                            ('fgrp-data', 'in/c.bin')]))
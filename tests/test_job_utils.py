@@ -0,0 +1,233 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import threading
+import time
+import unittest
+
+from mock import Mock, patch
+from msrest.exceptions import ClientRequestError
+from azure.batch.models import (
+    TaskAddCollectionResult, TaskAddResult, TaskAddStatus, BatchError, ErrorMessage,
+    BatchErrorException)
+from azure.cli.core._util import CLIError
+from azure.cli.command_modules.batch_extensions import _job_utils as utils
+
+
+def _task_results(tasks, failures=None):
+    failures = failures or {}
+    results = []
+    for task in tasks:
+        if task.id in failures:
+            status, code = failures[task.id]
+            error = BatchError(code=code, message=ErrorMessage(value='{} error'.format(code)))
+            results.append(TaskAddResult(status, task.id, error=error))
+        else:
+            results.append(TaskAddResult(TaskAddStatus.success, task.id))
+    return TaskAddCollectionResult(value=results)
+
+
+def _batch_error(code):
+    error = BatchError(code=code, message=ErrorMessage(value='{} error'.format(code)))
+    return BatchErrorException(lambda *_: error, Mock())
+
+
+class TestBatchNCJJobs(unittest.TestCase):
+    # pylint: disable=protected-access
+
+    def _mock_client(self, add_collection):
+        def add(job_id, tasks):
+            result = add_collection(job_id, tasks)
+            return result if result is not None else _task_results(tasks)
+
+        client = Mock()
+        client._deserialize.side_effect = lambda _, tasks: [Mock(id=t['id']) for t in tasks]
+        client.task.add_collection.side_effect = add
+        return client
+
+    def test_batch_ncj_deploy_tasks_in_order(self):
+        submitted = []
+        lock = threading.Lock()
+
+        def add_collection(job_id, tasks):
+            self.assertEqual(job_id, 'job')
+            with lock:
+                submitted.append([t.id for t in tasks])
+
+        client = self._mock_client(add_collection)
+        tasks = ({'id': str(i), 'commandLine': 'cmd'} for i in range(250))
+        utils.deploy_tasks(client, 'job', tasks, 3)
+        self.assertEqual(client.task.add_collection.call_count, 3)
+        self.assertEqual(sorted(len(c) for c in submitted), [50, 100, 100])
+        self.assertEqual(sorted(int(t) for c in submitted for t in c), list(range(250)))
+
+    def test_batch_ncj_deploy_tasks_bounded_concurrency(self):
+        state = {'running': 0, 'peak': 0}
+        lock = threading.Lock()
+
+        def add_collection(*_):
+            with lock:
+                state['running'] += 1
+                state['peak'] = max(state['peak'], state['running'])
+            time.sleep(0.02)
+            with lock:
+                state['running'] -= 1
+
+        client = self._mock_client(add_collection)
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(1000)]
+        utils.deploy_tasks(client, 'job', tasks, 2)
+        self.assertEqual(client.task.add_collection.call_count, 10)
+        self.assertEqual(state['peak'], 2)
+
+    def test_batch_ncj_deploy_tasks_dependencies_wait(self):
+        added = []
+        lock = threading.Lock()
+
+        def add_collection(_, tasks):
+            if tasks[0].id == 'merge':
+                with lock:
+                    self.assertEqual(len(added), 300)
+            else:
+                time.sleep(0.02)
+            with lock:
+                added.extend(t.id for t in tasks)
+
+        client = self._mock_client(add_collection)
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(300)]
+        tasks.append({'id': 'merge', 'commandLine': 'cmd',
+                      'dependsOn': {'taskIdRanges': {'start': 0, 'end': 299}}})
+        utils.deploy_tasks(client, 'job', tasks, 4)
+        self.assertEqual(added[-1], 'merge')
+
+    @patch.object(utils.time, 'sleep')
+    def test_batch_ncj_deploy_tasks_aggregate_errors(self, _):
+        def add_collection(_, tasks):
+            if tasks[0].id in ['0', '100']:
+                raise ClientRequestError('failed at {}'.format(tasks[0].id))
+
+        client = self._mock_client(add_collection)
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(200)]
+        with self.assertRaises(CLIError) as error:
+            utils.deploy_tasks(client, 'job', tasks, 2)
+        self.assertIn('failed at 0', str(error.exception))
+        self.assertIn('failed at 100', str(error.exception))
+
+        with self.assertRaises(ValueError):
+            utils.deploy_tasks(client, 'job', tasks, 0)
+
+    @patch.object(utils.time, 'sleep')
+    def test_batch_ncj_deploy_tasks_retry_failed_tasks(self, mock_sleep):
+        attempts = []
+        failures = {
+            '3': (TaskAddStatus.server_error, 'ServerBusy'),
+            '7': (TaskAddStatus.client_error, 'OperationTimedOut'),
+            '8': (TaskAddStatus.client_error, 'TaskExists')}
+
+        def add_collection(_, tasks):
+            attempts.append(sorted(t.id for t in tasks))
+            if len(attempts) == 1:
+                return _task_results(tasks, failures)
+            return _task_results(tasks, {'7': (TaskAddStatus.client_error, 'TaskExists')})
+
+        client = self._mock_client(add_collection)
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(10)]
+        utils.deploy_tasks(client, 'job', tasks)
+        self.assertEqual(attempts[1], ['3', '7'])
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+
+    @patch.object(utils.time, 'sleep')
+    def test_batch_ncj_deploy_tasks_retry_limits(self, mock_sleep):
+        def add_collection(_, tasks):
+            return _task_results(tasks, {'1': (TaskAddStatus.server_error, 'ServerBusy')})
+
+        client = self._mock_client(add_collection)
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(3)]
+        with self.assertRaises(CLIError) as error:
+            utils.deploy_tasks(client, 'job', tasks)
+        self.assertIn("'1'", str(error.exception))
+        self.assertEqual(client.task.add_collection.call_count, utils.MAX_TASK_ADD_RETRIES + 1)
+        self.assertEqual(mock_sleep.call_count, utils.MAX_TASK_ADD_RETRIES)
+
+        def add_invalid(_, tasks):
+            return _task_results(tasks, {'2': (TaskAddStatus.client_error, 'InvalidPropertyValue')})
+
+        client = self._mock_client(add_invalid)
+        with self.assertRaises(CLIError) as error:
+            utils.deploy_tasks(client, 'job', tasks)
+        self.assertIn('InvalidPropertyValue error', str(error.exception))
+        self.assertEqual(client.task.add_collection.call_count, 1)
+
+    @patch.object(utils.time, 'sleep')
+    def test_batch_ncj_deploy_tasks_retry_request_errors(self, mock_sleep):
+        attempts = []
+
+        def add_collection(_, tasks):
+            attempts.append(len(tasks))
+            if len(attempts) < 3:
+                raise ClientRequestError('Connection reset')
+
+        client = self._mock_client(add_collection)
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(10)]
+        utils.deploy_tasks(client, 'job', tasks)
+        self.assertEqual(attempts, [10, 10, 10])
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        client = self._mock_client(Mock(side_effect=ClientRequestError('Connection reset')))
+        with self.assertRaises(CLIError):
+            utils.deploy_tasks(client, 'job', tasks)
+        self.assertEqual(client.task.add_collection.call_count, utils.MAX_TASK_ADD_RETRIES + 1)
+
+    def test_batch_ncj_retry_delay(self):
+        for attempt in range(1, 10):
+            delay = utils._retry_delay(attempt)
+            self.assertTrue(0 <= delay <= utils.RETRY_MAX_DELAY)
+
+    def test_batch_ncj_chunk_tasks_by_size(self):
+        large_value = 'x' * 100000
+        tasks = [{'id': str(i), 'commandLine': 'cmd',
+                  'environmentSettings': [{'name': 'CONFIG', 'value': large_value}]}
+                 for i in range(25)]
+        chunks = list(utils._chunk_tasks(tasks))
+        self.assertEqual([len(c) for c in chunks], [10, 10, 5])
+        self.assertEqual([t['id'] for c in chunks for t in c], [str(i) for i in range(25)])
+
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(150)]
+        self.assertEqual([len(c) for c in utils._chunk_tasks(tasks)], [100, 50])
+
+        tasks = [{'id': 'huge', 'commandLine': 'x' * utils.MAX_TASKS_SIZE_IN_BATCH}]
+        with self.assertRaises(ValueError):
+            list(utils._chunk_tasks(tasks))
+
+    def test_batch_ncj_validate_task_submission(self):
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(10)]
+        utils.validate_task_submission(tasks)
+        utils.validate_task_submission(tasks, 1)
+        with self.assertRaises(ValueError):
+            utils.validate_task_submission(tasks, 0)
+        with self.assertRaises(ValueError):
+            utils.validate_task_submission(
+                tasks + [{'id': 'huge', 'commandLine': 'x' * utils.MAX_TASKS_SIZE_IN_BATCH}])
+
+    def test_batch_ncj_deploy_tasks_split_large_request(self):
+        submitted = []
+
+        def add_collection(_, tasks):
+            if len(tasks) > 25:
+                raise _batch_error('RequestBodyTooLarge')
+            submitted.append(len(tasks))
+
+        client = self._mock_client(add_collection)
+        tasks = [{'id': str(i), 'commandLine': 'cmd'} for i in range(100)]
+        utils.deploy_tasks(client, 'job', tasks)
+        self.assertEqual(submitted, [25, 25, 25, 25])
+
+        def add_single(_, tasks):
+            raise _batch_error('RequestBodyTooLarge')
+
+        client = self._mock_client(add_single)
+        with self.assertRaises(CLIError) as error:
+            utils.deploy_tasks(client, 'job', tasks[:1])
+        self.assertIn('RequestBodyTooLarge error', str(error.exception))
@@ -5,12 +5,15 @@
 
 import json
 import os
+import shutil
+import tempfile
 import unittest
 
 from mock import patch, Mock
 from azure.storage import CloudStorageAccount
 from azure.storage.blob.blockblobservice import BlockBlobService
 from azure.cli.command_modules.batch import _help
+from azure.cli.command_modules.batch_extensions import _cache_utils as cache_utils
 from azure.cli.command_modules.batch_extensions import _template_utils as utils
 from azure.cli.command_modules.batch_extensions import _pool_utils
 from azure.cli.command_modules.batch_extensions import _file_utils
@@ -18,54 +21,59 @@ from azure.cli.command_modules.batch_extensions import _file_utils
 # pylint: disable=too-many-lines
 
 
+def _render_replacement(transformer, source_str, context):
+    rendered = utils._compile_replacement(transformer, source_str)  # pylint:disable=protected-access
+    return rendered(context) if callable(rendered) else rendered
+
+
 class TestBatchNCJTemplates(unittest.TestCase):
     # pylint: disable=attribute-defined-outside-init,no-member,too-many-public-methods
 
     def setUp(self):
         self.data_dir = os.path.join(os.path.dirname(__file__), 'data')
+        # Parsed templates are cached in a temporary directory
+        self.cache_root = tempfile.mkdtemp()
+        patcher = patch.object(cache_utils, '_CACHE_ROOT', self.cache_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_root)
         return super(TestBatchNCJTemplates, self).setUp()
 
     def test_batch_ncj_expression_evaluation(self):
         # It should replace a string containing only an expression
         definition = {'value': "['evaluateMe']"}
-        template = json.dumps(definition)
         parameters = {}
-        result = utils._parse_template(template, definition, parameters)  # pylint:disable=protected-access
+        result = utils._parse_template(definition, definition, parameters)  # pylint:disable=protected-access
         self.assertEqual(result['value'], 'evaluateMe')
 
         # It should replace an expression within a string
         definition = {'value': "prequel ['alpha'] sequel"}
-        template = json.dumps(definition)
         parameters = {}
-        result = utils._parse_template(template, definition, parameters)  # pylint:disable=protected-access
+        result = utils._parse_template(definition, definition, parameters)  # pylint:disable=protected-access
         self.assertEqual(result['value'], 'prequel alpha sequel')
 
         # It should replace multiple expressions within a string
         definition = {'value': "prequel ['alpha'] interquel ['beta'] sequel"}
-        template = json.dumps(definition)
         parameters = {}
-        result = utils._parse_template(template, definition, parameters)  # pylint:disable=protected-access
+        result = utils._parse_template(definition, definition, parameters)  # pylint:disable=protected-access
         self.assertEqual(result['value'], 'prequel alpha interquel beta sequel')
 
         # It should unescape an escaped expression
         definition = {'value': "prequel [['alpha'] sequel"}
-        template = json.dumps(definition)
         parameters = {}
-        result = utils._parse_template(template, definition, parameters)  # pylint:disable=protected-access
+        result = utils._parse_template(definition, definition, parameters)  # pylint:disable=protected-access
         self.assertEqual(result['value'], "prequel ['alpha'] sequel")
 
         # It should not choke on JSON containing string arrays
         definition = {'values': ["alpha", "beta", "gamma", "[43]"]}
-        template = json.dumps(definition)
         parameters = {}
-        result = utils._parse_template(template, definition, parameters)  # pylint:disable=protected-access
+        result = utils._parse_template(definition, definition, parameters)  # pylint:disable=protected-access
         self.assertEqual(result['values'], ["alpha", "beta", "gamma", "43"])
 
         # It should not choke on JSON containing number arrays
         definition = {'values': [1, 1, 2, 3, 5, 8, 13]}
-        template = json.dumps(definition)
         parameters = {}
-        result = utils._parse_template(template, definition, parameters)  # pylint:disable=protected-access
+        result = utils._parse_template(definition, definition, parameters)  # pylint:disable=protected-access
         self.assertEqual(result['values'], [1, 1, 2, 3, 5, 8, 13])
 
     def test_batch_ncj_parameters(self):
@@ -77,14 +85,13 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 'code': {'type': 'string'}
             }
         }
-        temaplate_string = json.dumps(template)
         parameters = {'code': 'stringValue'}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "stringValue")
 
         # It should replace numeric value for string parameter as a string
         parameters = {'code': 42}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "42")
 
         # It should replace int value for int parameter
@@ -94,14 +101,13 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 'code': {'type': 'int'}
             }
         }
-        temaplate_string = json.dumps(template)
         parameters = {'code': 42}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], 42)
 
         # It should replace string value for int parameter as int
         parameters = {'code': "42"}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], 42)
 
         # It should replace int values for int parameters in nested expressions
@@ -112,9 +118,8 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 'height': {'type': 'int'}
             }
         }
-        temaplate_string = json.dumps(template)
         parameters = {'width': 1920, 'height': 1080}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['framesize'], "Framesize is (1920x1080)")
 
         # It should replace bool value for bool parameter
@@ -124,14 +129,13 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 'code': {'type': 'bool'}
             }
         }
-        temaplate_string = json.dumps(template)
         parameters = {'code': True}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], True)
 
         # It should replace string value for bool parameter as bool value
         parameters = {'code': 'true'}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], True)
 
         # It should report an error for an unsupported parameter type
@@ -141,10 +145,9 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 'code': {'type': 'currency'}
             }
         }
-        temaplate_string = json.dumps(template)
         parameters = {'code': True}
         with self.assertRaises(TypeError):
-            utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+            utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
 
     def test_batch_ncj_variables(self):
 
@@ -155,9 +158,8 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 "code": "enigmatic"
             }
         }
-        temaplate_string = json.dumps(template)
         parameters = {}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "enigmatic")
 
         # It should replace function result for a variable
@@ -167,51 +169,100 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 "code": "[concat('this', '&', 'that')]"
             }
         }
-        temaplate_string = json.dumps(template)
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "this&that")
 
+        # It should expand expressions within complex variable values and keys
+        template = {
+            'result': "[variables('settings')]",
+            '[parameters(\'key\')]': "value",
+            'parameters': {
+                'key': {'type': 'string'},
+                'path': {'type': 'string'}
+            },
+            'variables': {
+                'settings': {'path': "[parameters('path')]", 'values': ["[[escaped]", 1]}
+            }
+        }
+        parameters = {'key': 'named', 'path': 'C:\\data "quoted"'}
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
+        self.assertEqual(resolved['result'],
+                         {'path': 'C:\\data "quoted"', 'values': ["[escaped]", 1]})
+        self.assertEqual(resolved['named'], "value")
+        self.assertEqual(template['variables']['settings']['path'], "[parameters('path')]")
+
+    def test_batch_ncj_variables_resolved_once(self):
+        template = {
+            'values': ["[variables('outer')]", "[variables('outer')]-[variables('inner')]"],
+            'objects': ["[variables('settings')]", "[variables('settings')]"],
+            'parameters': {'code': {'type': 'string'}},
+            'variables': {
+                'outer': "[concat(variables('inner'), '-', parameters('code'))]",
+                'inner': "[concat('a', 'b')]",
+                'settings': {'value': "[variables('inner')]"}
+            }
+        }
+        with patch.object(utils, '_parse_arm_expression',
+                          wraps=utils._parse_arm_expression) as parse:  # pylint:disable=protected-access
+            resolved = utils._parse_template(template, template, {'code': 'c'})  # pylint:disable=protected-access
+            self.assertEqual(
+                sorted(c[0][0] for c in parse.call_args_list if c[0][0].startswith('[concat')),
+                sorted(template['variables'][v] for v in ['outer', 'inner']))
+        self.assertEqual(resolved['values'], ['ab-c', 'ab-c-ab'])
+        self.assertEqual(resolved['objects'], [{'value': 'ab'}, {'value': 'ab'}])
+        self.assertIsNot(resolved['objects'][0], resolved['objects'][1])
+
+        # It should report circular references
+        template = {
+            'result': "[variables('first')]",
+            'parameters': {'code': {'type': 'string'}},
+            'variables': {
+                'first': "[concat('x', variables('second'))]",
+                'second': {'value': "[parameters('code')]"}
+            }
+        }
+        parameters = {'code': {'value': {'nested': "[variables('first')]"}}}
+        with self.assertRaises(ValueError) as error:
+            utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
+        self.assertIn("variables('first') -> variables('second') -> parameters('code') -> "
+                      "variables('first')", str(error.exception))
+
     def test_batch_ncj_concat(self):
 
         # It should handle strings
         template = {
             "result": "[concat('alpha', 'beta', 'gamma')]"
         }
-        temaplate_string = json.dumps(template)
         parameters = {}
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "alphabetagamma")
 
         # It should handle strings and numbers
         template = {
             "result": "[concat('alpha', 42, 'beta', 3, '.', 1415, 'gamma')]"
         }
-        temaplate_string = json.dumps(template)
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "alpha42beta3.1415gamma")
 
         # It should handle strings containing commas correctly
         template = {
             "result": "[concat('alpha', ', ', 'beta', ', ', 'gamma')]"
         }
-        temaplate_string = json.dumps(template)
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "alpha, beta, gamma")
 
         # It should handle strings containing square brackets correctly
         template = {
             "result": "[concat('alpha', '[', 'beta', ']', 'gamma')]"
         }
-        temaplate_string = json.dumps(template)
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "alpha[beta]gamma")
 
         # It should handle nested concat function calls
         template = {
             "result": "[concat('alpha ', concat('this', '&', 'that'), ' gamma')]"
         }
-        temaplate_string = json.dumps(template)
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "alpha this&that gamma")
 
         # It should handle nested parameters() function calls
@@ -222,8 +273,7 @@ class TestBatchNCJTemplates(unittest.TestCase):
             }
         }
         parameters = {"name": "Frodo"}
-        temaplate_string = json.dumps(template)
-        resolved = utils._parse_template(temaplate_string, template, parameters)  # pylint:disable=protected-access
+        resolved = utils._parse_template(template, template, parameters)  # pylint:disable=protected-access
         self.assertEqual(resolved['result'], "alpha Frodo gamma")
 
     def test_batch_ncj_expand_template_with_parameter_file(self):
@@ -238,48 +288,38 @@ class TestBatchNCJTemplates(unittest.TestCase):
 
     def test_batch_ncj_replace_parametric_sweep_command(self):
         test_input = {"value": "cmd {{{0}}}.mp3 {1}.mp3"}
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 10])
-        self.assertEqual(replaced["value"], 'cmd {5}.mp3 10.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd {5}.mp3 10.mp3')
         test_input["value"] = "cmd {{{0}}}.mp3 {{{1}}}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 10])
-        self.assertEqual(replaced["value"], 'cmd {5}.mp3 {10}.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd {5}.mp3 {10}.mp3')
         test_input["value"] = "cmd {{0}}.mp3 {1}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 10])
-        self.assertEqual(replaced["value"], 'cmd {0}.mp3 10.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd {0}.mp3 10.mp3')
         test_input["value"] = "cmd {0}.mp3 {1}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 10])
-        self.assertEqual(replaced["value"], 'cmd 5.mp3 10.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd 5.mp3 10.mp3')
         test_input["value"] = "cmd {0}{1}.mp3 {1}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 10])
-        self.assertEqual(replaced["value"], 'cmd 510.mp3 10.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd 510.mp3 10.mp3')
         test_input["value"] = "cmd {0}.mp3 {0}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 10])
-        self.assertEqual(replaced["value"], 'cmd 5.mp3 5.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd 5.mp3 5.mp3')
         test_input["value"] = "cmd {0:3}.mp3 {0}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 10])
-        self.assertEqual(replaced["value"], 'cmd 005.mp3 5.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd 005.mp3 5.mp3')
         test_input["value"] = "cmd {0:3}.mp3 {1:3}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 1234])
-        self.assertEqual(replaced["value"], 'cmd 005.mp3 1234.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 1234])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd 005.mp3 1234.mp3')
         test_input["value"] = "cmd {{}}.mp3"
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5, 1234])
-        self.assertEqual(replaced["value"], 'cmd {}.mp3')
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 1234])  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd {}.mp3')
         test_input["value"] = ("gs -dQUIET -dSAFER -dBATCH -dNOPAUSE -dNOPROMPT -sDEVICE=pngalpha "
                                "-sOutputFile={0}-%03d.png -r250 {0}.pdf && for f in *.png;"
                                " do tesseract $f ${{f%.*}};done")
-        replaced = utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                                test_input, "value", [5])
+        replaced = _render_replacement(utils._transform_sweep_str, test_input["value"], [5])  # pylint:disable=protected-access
         self.assertEqual(
-            replaced["value"],
+            replaced,
             "gs -dQUIET -dSAFER -dBATCH -dNOPAUSE -dNOPROMPT -sDEVICE=pngalpha "
             "-sOutputFile=5-%03d.png -r250 5.pdf && for f in *.png; do tesseract "
             "$f ${f%.*};done")
@@ -287,24 +327,19 @@ class TestBatchNCJTemplates(unittest.TestCase):
     def test_batch_ncj_replace_invalid_parametric_sweep(self):
         test_input = {"value": "cmd {0}.mp3 {2}.mp3"}
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                         test_input, "value", [5, 10])
+            _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
         test_input["value"] = "cmd {}.mp3 {2}.mp3"
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                         test_input, "value", [5, 10])
+            _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
         test_input["value"] = "cmd {{0}}}.mp3 {1}.mp3"
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                         test_input, "value", [5, 10])
+            _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
         test_input["value"] = "cmd {0:3}.mp3 {1}.mp3"
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                         test_input, "value", [-5, 10])
+            _render_replacement(utils._transform_sweep_str, test_input["value"], [-5, 10])  # pylint:disable=protected-access
         test_input["value"] = "cmd {0:-3}.mp3 {1}.mp3"
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_sweep_str,  # pylint:disable=protected-access
-                                         test_input, "value", [5, 10])
+            _render_replacement(utils._transform_sweep_str, test_input["value"], [5, 10])  # pylint:disable=protected-access
 
     def test_batch_ncj_replace_file_iteration_command(self):
         file_info = {
@@ -314,26 +349,22 @@ class TestBatchNCJTemplates(unittest.TestCase):
             "fileNameWithoutExtension": "blob"
         }
         test_input = {"value": "cmd {{{url}}}.mp3 {filePath}.mp3"}
-        replaced = utils._replacement_transform(utils._transform_file_str,  # pylint:disable=protected-access
-                                                test_input, "value", file_info)
-        self.assertEqual(replaced["value"],
+        replaced = _render_replacement(utils._transform_file_str, test_input["value"], file_info)  # pylint:disable=protected-access
+        self.assertEqual(replaced,
                          'cmd {http://someurl/container/path/blob.ext}.mp3 path/blob.ext.mp3')
         test_input["value"] = "cmd {{{fileName}}}.mp3 {{{fileNameWithoutExtension}}}.mp3"
-        replaced = utils._replacement_transform(utils._transform_file_str,  # pylint:disable=protected-access
-                                                test_input, "value", file_info)
-        self.assertEqual(replaced["value"], 'cmd {blob.ext}.mp3 {blob}.mp3')
+        replaced = _render_replacement(utils._transform_file_str, test_input["value"], file_info)  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd {blob.ext}.mp3 {blob}.mp3')
         test_input["value"] = "cmd {{fileName}}.mp3 {fileName}.mp3"
-        replaced = utils._replacement_transform(utils._transform_file_str,  # pylint:disable=protected-access
-                                                test_input, "value", file_info)
-        self.assertEqual(replaced["value"], 'cmd {fileName}.mp3 blob.ext.mp3')
+        replaced = _render_replacement(utils._transform_file_str, test_input["value"], file_info)  # pylint:disable=protected-access
+        self.assertEqual(replaced, 'cmd {fileName}.mp3 blob.ext.mp3')
         test_input["value"] = (
             "gs -dQUIET -dSAFER -dBATCH -dNOPAUSE -dNOPROMPT -sDEVICE=pngalpha "
             "-sOutputFile={fileNameWithoutExtension}-%03d.png -r250 "
             "{fileNameWithoutExtension}.pdf && for f in *.png; do tesseract $f ${{f%.*}};done")
-        replaced = utils._replacement_transform(utils._transform_file_str,  # pylint:disable=protected-access
-                                                test_input, "value", file_info)
+        replaced = _render_replacement(utils._transform_file_str, test_input["value"], file_info)  # pylint:disable=protected-access
         self.assertEqual(
-            replaced["value"],
+            replaced,
             "gs -dQUIET -dSAFER -dBATCH -dNOPAUSE -dNOPROMPT -sDEVICE=pngalpha "
             "-sOutputFile=blob-%03d.png -r250 blob.pdf && for f in *.png; do tesseract "
             "$f ${f%.*};done")
@@ -347,16 +378,13 @@ class TestBatchNCJTemplates(unittest.TestCase):
         }
         test_input = {"value": "cmd {url}.mp3 {fullNameWithSome}.mp3"}
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_file_str,  # pylint:disable=protected-access
-                                         test_input, "value", file_info)
+            _render_replacement(utils._transform_file_str, test_input["value"], file_info)  # pylint:disable=protected-access
         test_input["value"] = "cmd {}.mp3 {url}.mp3"
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_file_str,  # pylint:disable=protected-access
-                                         test_input, "value", file_info)
+            _render_replacement(utils._transform_file_str, test_input["value"], file_info)  # pylint:disable=protected-access
         test_input["value"] = "cmd {{url}}}.mp3 {filePath}.mp3"
         with self.assertRaises(ValueError):
-            utils._replacement_transform(utils._transform_file_str,  # pylint:disable=protected-access
-                                         test_input, "value", file_info)
+            _render_replacement(utils._transform_file_str, test_input["value"], file_info)  # pylint:disable=protected-access
 
     def test_batch_ncj_parse_parameter_sets(self):
         parsed = utils._parse_parameter_sets([{'start': 1, 'end': 2}])  # pylint:disable=protected-access
@@ -668,6 +696,98 @@ class TestBatchNCJTemplates(unittest.TestCase):
         }
         utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
 
+    def test_batch_ncj_parametricsweep_expands_lazily(self):
+        template = {
+            "parameterSets": [
+                {"start": 1, "end": 1000},
+                {"start": 1, "end": 1000}
+            ],
+            "repeatTask": {"commandLine": "cmd {0} {1}"},
+            "mergeTask": {"commandLine": "summary.exe"}
+        }
+        result = utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+        self.assertEqual(next(result), {"commandLine": "cmd 1 1", "id": "0"})
+        self.assertEqual(next(result), {"commandLine": "cmd 1 2", "id": "1"})
+        merge_task = utils._parse_merge_task(template, 1000 * 1000)  # pylint: disable=protected-access
+        self.assertEqual(merge_task['dependsOn'], {"taskIdRanges": {"start": 0, "end": 999999}})
+        templates = utils.get_task_factory_templates(dict(template, type='parametricSweep'),
+                                                     result)
+        self.assertEqual([t['commandLine'] for t in templates], ["cmd {0} {1}", "summary.exe"])
+
+    def test_batch_ncj_task_factory_errors_raised_before_iteration(self):
+        template = {
+            "parameterSets": [{"start": 1, "end": 1000}],
+            "repeatTask": {"commandLine": "cmd {1}"}
+        }
+        with self.assertRaises(ValueError):
+            utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+        template['repeatTask']['commandLine'] = 'cmd {0:10}'
+        with self.assertRaises(ValueError):
+            utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+
+        # The first task and merge task are post-processed before the others are generated
+        template['repeatTask'] = {
+            "commandLine": "cmd {0}",
+            "outputFiles": [{"filePattern": "*.txt", "destination": {}, "uploadDetails": {}}]}
+        tasks = utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+        with self.assertRaises(ValueError):
+            utils.process_task_collection(tasks, _pool_utils.PoolOperatingSystemFlavor.LINUX,
+                                          Mock())
+        template['repeatTask'] = {"commandLine": "cmd {0}"}
+        template['mergeTask'] = {"commandLine": "merge",
+                                 "resourceFiles": [{"source": {"fileGroup": "data"}}]}
+        fileutils = Mock()
+        fileutils.resolve_resource_file.side_effect = ValueError('No file group data')
+        tasks = utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+        with self.assertRaises(ValueError):
+            utils.process_task_collection(tasks, None, fileutils)
+
+        del template['mergeTask']
+        tasks = utils.process_task_collection(
+            utils._expand_parametric_sweep(template), None, fileutils)  # pylint: disable=protected-access
+        self.assertEqual(next(tasks), {"commandLine": "cmd 1", "id": "0"})
+        self.assertEqual(next(tasks), {"commandLine": "cmd 2", "id": "1"})
+
+        # The tasks of a task collection aren't expanded again for their templates
+        factory = {"type": "taskCollection", "tasks": [{"id": "a", "commandLine": "cmd"}]}
+        tasks = utils.expand_task_factory({"taskFactory": factory}, None)
+        self.assertIs(utils.get_task_factory_templates(factory, tasks), tasks)
+        self.assertIs(utils.get_generated_tasks(tasks), tasks)
+        template['mergeTask'] = {"commandLine": "merge"}
+        tasks = utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+        self.assertEqual([t['id'] for t in utils.get_generated_tasks(tasks)], ['0', 'merge'])
+
+    def test_batch_ncj_compiled_repeat_task(self):
+        template = {
+            "parameterSets": [{"start": 1, "end": 2}],
+            "repeatTask": {
+                "commandLine": "cmd {0:3} ${{HOME}}",
+                "constraints": {"maxTaskRetryCount": 3},
+                "environmentSettings": [{"name": "NAME", "value": "{{literal}}"}],
+                "outputFiles": [{
+                    "filePattern": "*.txt",
+                    "destination": {"autoStorage": {"fileGroup": "group", "path": "out/{0}"}},
+                    "uploadDetails": {"taskStatus": "TaskSuccess"}
+                }]
+            }
+        }
+        result = list(utils._expand_parametric_sweep(template))  # pylint: disable=protected-access
+        self.assertEqual([t['commandLine'] for t in result], ["cmd 001 ${HOME}", "cmd 002 ${HOME}"])
+        self.assertEqual(result[1]['environmentSettings'], [{"name": "NAME", "value": "{literal}"}])
+        self.assertEqual(result[1]['outputFiles'][0]['destination'],
+                         {"autoStorage": {"fileGroup": "group", "path": "out/2"}})
+        # Each task must be an independent copy of the template
+        result[0]['constraints']['maxTaskRetryCount'] = 1
+        result[0]['outputFiles'][0]['destination'].pop('autoStorage')
+        self.assertEqual(result[1]['constraints'], {"maxTaskRetryCount": 3})
+        self.assertIn('autoStorage', result[1]['outputFiles'][0]['destination'])
+        self.assertEqual(template['repeatTask']['commandLine'], "cmd {0:3} ${{HOME}}")
+
+        # Invalid brackets are reported before any task is generated
+        template['repeatTask']['commandLine'] = "cmd {0}}"
+        with self.assertRaises(ValueError):
+            utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+
     def test_batch_ncj_preserve_resourcefiles(self):
         fileutils = _file_utils.FileUtils(None, None, None, None)
         request = {
@@ -722,6 +842,151 @@ class TestBatchNCJTemplates(unittest.TestCase):
         with self.assertRaises(ValueError):
             utils.post_processing(request, fileutils)
 
+    def test_batch_ncj_prefetch_resourcefiles(self):
+        job = {
+            "id": "job",
+            "jobManagerTask": {
+                "resourceFiles": [{"source": {"fileGroup": "manager"}},
+                                  {"blobSource": "https://blob/file", "filePath": "file"}]
+            },
+            "taskFactory": {
+                "type": "taskPerFile",
+                "source": {"fileGroup": "inputs", "prefix": "data/"},
+                "repeatTask": {
+                    "commandLine": "cat {fileName}",
+                    "resourceFiles": [
+                        {"source": {"fileGroup": "inputs", "prefix": "data/{fileName}"}},
+                        {"source": {"fileGroup": "{fileNameWithoutExtension}"}}
+                    ]
+                }
+            }
+        }
+        file_utils = Mock()
+        utils.prefetch_resource_files(job, file_utils)
+        sources = file_utils.prefetch_container_lists.call_args[0][0]
+        self.assertEqual(sorted(sources, key=lambda s: sorted(s.items())), [
+            {"fileGroup": "inputs", "prefix": "data/"},
+            {"fileGroup": "inputs", "prefix": "data/"},
+            {"fileGroup": "manager"}])
+        self.assertEqual(job['taskFactory']['repeatTask']['resourceFiles'][0]['source']['prefix'],
+                         "data/{fileName}")
+
+    def test_batch_ncj_decompress_resourcefiles(self):
+        blobs = [
+            {'filePath': 'data/a.csv', 'url': 'https://blob/a.csv', 'contentEncoding': 'gzip'},
+            {'filePath': 'data/b.csv', 'url': 'https://blob/b.csv'}]
+        fileutils = Mock()
+        fileutils.resolve_resource_file.side_effect = lambda ref: [dict(ref)] \
+            if 'blobSource' in ref else _file_utils.convert_blobs_to_resource_files(blobs, ref)
+        get_os_flavor = Mock(return_value=_pool_utils.PoolOperatingSystemFlavor.LINUX)
+        job = {
+            'jobManagerTask': {
+                'commandLine': 'process.sh',
+                'resourceFiles': [{'source': {'fileGroup': 'data'}, 'filePath': 'in'}]
+            },
+            'jobPreparationTask': {
+                'commandLine': 'prepare.sh',
+                'resourceFiles': [{'blobSource': 'https://blob/c.csv', 'filePath': 'c.csv'}]
+            }
+        }
+        utils.post_processing(job, fileutils, get_os_flavor)
+        self.assertEqual(job['jobManagerTask']['resourceFiles'], [
+            {'blobSource': 'https://blob/a.csv', 'filePath': 'in/data/a.csv.fgrp.gz'},
+            {'blobSource': 'https://blob/b.csv', 'filePath': 'in/data/b.csv'}])
+        self.assertEqual(job['jobManagerTask']['commandLine'],
+                         "/bin/bash -c 'find ./in -name '\"'\"'*.fgrp.gz'\"'\"' "
+                         "-exec gzip -d -f -S .fgrp.gz -- {} + && process.sh'")
+        self.assertEqual(job['jobPreparationTask']['commandLine'], 'prepare.sh')
+        self.assertEqual(get_os_flavor.call_count, 1)
+
+        task = {'commandLine': 'process.cmd',
+                'resourceFiles': [{'source': {'fileGroup': 'data'}}]}
+        tasks = list(utils.process_task_collection(
+            [task], None, fileutils,
+            lambda: _pool_utils.PoolOperatingSystemFlavor.WINDOWS))
+        self.assertTrue(tasks[0]['commandLine'].startswith('cmd /c "powershell '))
+        self.assertIn("Get-ChildItem -LiteralPath 'data' -Recurse -Filter '*.fgrp.gz'",
+                      tasks[0]['commandLine'])
+        self.assertTrue(tasks[0]['commandLine'].endswith(' && process.cmd"'))
+
+        # The compressed files are found by directory, rather than each being listed
+        blobs = [{'filePath': 'data/{}.csv'.format(i), 'url': 'https://blob/{}.csv'.format(i),
+                  'contentEncoding': 'gzip'} for i in range(1000)]
+        task = {'commandLine': 'process.sh',
+                'resourceFiles': [{'source': {'fileGroup': 'data'}, 'filePath': 'in'},
+                                  {'source': {'fileGroup': 'data'}, 'filePath': 'other'}]}
+        utils.post_processing(task, fileutils, get_os_flavor)
+        self.assertEqual(len(task['resourceFiles']), 2000)
+        self.assertTrue(task['commandLine'].startswith(
+            "/bin/bash -c 'find ./in ./other -name "))
+        self.assertLess(len(task['commandLine']), 200)
+
+        with self.assertRaises(ValueError):
+            utils.post_processing({'resourceFiles': [{'source': {'fileGroup': 'data'}}]},
+                                  fileutils, get_os_flavor)
+        task = {'commandLine': 'process.sh',
+                'resourceFiles': [{'source': {'fileGroup': 'data'}}]}
+        with self.assertRaises(ValueError):
+            list(utils.process_task_collection([task], None, fileutils))
+
+    def test_batch_ncj_extract_packed_resourcefiles(self):
+        blobs = [
+            {'filePath': 'in/a.txt', 'url': 'https://blob/0.tar', 'pack': '.packs/p/0.tar'},
+            {'filePath': 'in/b.txt', 'url': 'https://blob/0.tar', 'pack': '.packs/p/0.tar'}]
+        fileutils = Mock()
+        fileutils.resolve_resource_file.side_effect = \
+            lambda ref: _file_utils.convert_blobs_to_resource_files(
+                [b for b in blobs if b['filePath'].startswith(ref['source']['prefix'])], ref)
+        task = {
+            'commandLine': 'process.sh',
+            'resourceFiles': [{'source': {'fileGroup': 'data', 'prefix': 'in/'},
+                               'filePath': 'inputs'},
+                              {'source': {'fileGroup': 'data', 'prefix': 'in/b.txt'},
+                               'filePath': 'b.txt'}]
+        }
+        utils.post_processing(task, fileutils,
+                              lambda: _pool_utils.PoolOperatingSystemFlavor.LINUX)
+        self.assertEqual(task['resourceFiles'], [
+            {'blobSource': 'https://blob/0.tar', 'filePath': '.packs/p/0.tar'}])
+        self.assertEqual(task['commandLine'], "/bin/bash -c 'mkdir -p inputs && "
+                         "tar -x -f .packs/p/0.tar -C inputs --wildcards --wildcards-match-slash "
+                         "'\"'\"'in/*'\"'\"' && mkdir -p . && "
+                         "tar -x -O -f .packs/p/0.tar in/b.txt > b.txt && process.sh'")
+
+        task = {'commandLine': 'process.cmd',
+                'resourceFiles': [{'source': {'fileGroup': 'data', 'prefix': 'in/'},
+                                   'filePath': 'inputs/data'}]}
+        utils.post_processing(task, fileutils,
+                              lambda: _pool_utils.PoolOperatingSystemFlavor.WINDOWS)
+        self.assertEqual(task['commandLine'],
+                         'cmd /c "(if not exist "inputs\\data" mkdir "inputs\\data") && '
+                         'tar -x -f ".packs/p/0.tar" -C "inputs/data" "in/*" && process.cmd"')
+
+        def windows_pool(sku):
+            return {'virtualMachineConfiguration': {'imageReference': {
+                'publisher': 'MicrosoftWindowsServer', 'offer': 'WindowsServer', 'sku': sku}}}
+        for pool in [windows_pool('2019-Datacenter'),
+                     {'cloudServiceConfiguration': {'osFamily': '6'}}]:
+            task = {'commandLine': 'process.cmd',
+                    'resourceFiles': [{'source': {'fileGroup': 'data', 'prefix': 'in/'}}]}
+            utils.post_processing(task, fileutils,
+                                  lambda: _pool_utils.PoolOperatingSystemFlavor.WINDOWS,
+                                  lambda p=pool: p)
+            self.assertIn('tar -x -f', task['commandLine'])
+        for pool in [windows_pool('2016-Datacenter'),
+                     {'cloudServiceConfiguration': {'osFamily': '5'}}]:
+            task = {'commandLine': 'process.cmd',
+                    'resourceFiles': [{'source': {'fileGroup': 'data', 'prefix': 'in/'}}]}
+            with self.assertRaises(ValueError):
+                utils.post_processing(task, fileutils,
+                                      lambda: _pool_utils.PoolOperatingSystemFlavor.WINDOWS,
+                                      lambda p=pool: p)
+
+        factory = {'source': {'fileGroup': 'data'}, 'repeatTask': {'commandLine': 'cat'}}
+        fileutils.get_container_list.return_value = blobs
+        with self.assertRaises(ValueError):
+            utils._expand_task_per_file(factory, fileutils)  # pylint: disable=protected-access
+
     def test_batch_ncj_validate_parameter(self):
         content = {
             'a': {
@@ -903,7 +1168,7 @@ class TestBatchNCJTemplates(unittest.TestCase):
                 "clientExtensions": {"dockerOptions": {"image": 'ncj/merge'}}
             }
         ]
-        result = utils._expand_parametric_sweep(template)  # pylint: disable=protected-access
+        result = list(utils._expand_parametric_sweep(template))  # pylint: disable=protected-access
         self.assertEqual(expected, result)
 
     def test_batch_ncj_simple_linux_package_manager(self):
@@ -1236,6 +1501,8 @@ class TestBatchNCJTemplates(unittest.TestCase):
         commands = [None]
         commands.append(utils.process_job_for_output_files(
             job, taskList, _pool_utils.PoolOperatingSystemFlavor.LINUX, None))
+        taskList = list(utils.process_task_collection(
+            taskList, _pool_utils.PoolOperatingSystemFlavor.LINUX, None))
         job['jobPreparationTask'] = utils.construct_setup_task(
             job.get('jobPreparationTask'), commands, _pool_utils.PoolOperatingSystemFlavor.LINUX)
         self.assertFalse('outputFiles' in taskList[0])
@@ -1341,6 +1608,8 @@ class TestBatchNCJTemplates(unittest.TestCase):
         mock_file_utils.resolved_storage_client = CloudStorageAccount('storgeaccount', 'VGhpcyBpcyBrZXkgMQ==').create_block_blob_service()
         commands.append(utils.process_job_for_output_files(
             job, taskList, _pool_utils.PoolOperatingSystemFlavor.LINUX, mock_file_utils))
+        taskList = list(utils.process_task_collection(
+            taskList, _pool_utils.PoolOperatingSystemFlavor.LINUX, mock_file_utils))
         job['jobPreparationTask'] = utils.construct_setup_task(
             job.get('jobPreparationTask'), commands, _pool_utils.PoolOperatingSystemFlavor.LINUX)
         self.assertFalse('outputFiles' in taskList[0])
@@ -0,0 +1,89 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import unittest
+
+from mock import patch, Mock
+from azure.cli.command_modules.batch_extensions import _transfer_utils as utils
+
+
+class TestBatchNCJTransferTuner(unittest.TestCase):
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.now = [0.0]
+        patcher = patch.object(utils.time, 'time', lambda: self.now[0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return super(TestBatchNCJTransferTuner, self).setUp()
+
+    def sample(self, tuner, throughput):
+        start = self.now[0]
+        self.now[0] += tuner.SAMPLE_PERIOD
+        tuner.record(int(throughput * tuner.SAMPLE_PERIOD), start)
+
+    def test_batch_ncj_tuner_hill_climbs_connections(self):
+        tuner = utils.TransferTuner(4, 20, 1024)
+        self.assertEqual(tuner.get_connections(), 4)
+        self.assertEqual(tuner.get_connections(blocks=2), 2)
+        self.assertEqual(tuner.get_connections(max_connections=3), 3)
+
+        # Transfers within a sample period don't change the connections
+        tuner.record(1000, self.now[0])
+        self.assertEqual(tuner.connections, 4)
+
+        # Connections grow in larger steps while the throughput improves
+        connections = []
+        for throughput in [1000, 2000, 3000, 4000, 4500, 4500]:
+            self.sample(tuner, throughput)
+            connections.append(tuner.connections)
+        self.assertEqual(connections, [5, 7, 11, 19, 20, 19])
+
+        # ...and keep falling while falling improves the throughput
+        for throughput in [5000, 6000, 6000]:
+            self.sample(tuner, throughput)
+            connections.append(tuner.connections)
+        self.assertEqual(connections[6:], [17, 13, 14])
+
+        with self.assertRaises(ValueError):
+            utils.TransferTuner(0, 20, 1024)
+
+    def test_batch_ncj_tuner_backs_off_when_throttled(self):
+        tuner = utils.TransferTuner(16, 64, 1024)
+        previous = Mock()
+        client = Mock(response_callback=previous)
+        tuner.watch(client)
+        callback = client.response_callback
+        tuner.watch(client)
+        self.assertIs(client.response_callback, callback)
+
+        client.response_callback(Mock(status=201))
+        self.assertEqual(tuner.connections, 16)
+        client.response_callback(Mock(status=503))
+        self.assertEqual(tuner.connections, 8)
+        self.assertEqual(previous.call_count, 2)
+
+        # Responses to requests already in flight don't halve the connections again
+        self.now[0] += 1
+        client.response_callback(Mock(status=500))
+        self.assertEqual(tuner.connections, 8)
+        self.now[0] += tuner.SAMPLE_PERIOD
+        client.response_callback(Mock(status=500))
+        self.assertEqual(tuner.connections, 4)
+
+    def test_batch_ncj_tuner_sizes_blocks(self):
+        tuner = utils.TransferTuner(2, 8, 1024)
+        self.assertEqual(tuner.get_block_size(10000, 10), 10)
+
+        # Blocks take about BLOCK_DURATION over one connection, in doublings of the default
+        self.sample(tuner, 100)
+        self.assertEqual(tuner.get_block_size(10000, 10), 80)
+        self.assertEqual(tuner.get_block_size(10000, 10, connections=4), 80)
+        self.assertEqual(tuner.get_block_size(500, 10, connections=8), 40)
+        self.assertEqual(tuner.get_block_size(5, 10), 10)
+
+        # ...up to the largest block size
+        self.sample(tuner, 100000)
+        self.assertEqual(tuner.get_block_size(100000, 10), 640)
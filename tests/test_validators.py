@@ -0,0 +1,70 @@
+# --------------------------------------------------------------------------------------------
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License. See License.txt in the project root for license information.
+# --------------------------------------------------------------------------------------------
+
+import shutil
+import tempfile
+import time
+import unittest
+
+from mock import patch, Mock
+from msrestazure.azure_exceptions import CloudError
+from azure.cli.command_modules.batch_extensions import _cache_utils as cache_utils
+from azure.cli.command_modules.batch_extensions import _validators as validators
+
+
+class TestBatchNCJValidators(unittest.TestCase):
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.cache_root = tempfile.mkdtemp()
+        patcher = patch.object(cache_utils, '_CACHE_ROOT', self.cache_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, self.cache_root)
+        return super(TestBatchNCJValidators, self).setUp()
+
+    @staticmethod
+    def _account(name, resource_group):
+        account = Mock(account_endpoint='{}.westus.batch.azure.com'.format(name),
+                       id='/subscriptions/sub/resourceGroups/{}/providers/'
+                          'Microsoft.Batch/batchAccounts/{}'.format(resource_group, name))
+        account.name = name
+        return account
+
+    @patch.object(validators, 'get_mgmt_service_client')
+    def test_batch_ncj_validate_client_parameters_account_index(self, mock_client):
+        client = mock_client.return_value
+        client.config.subscription_id = 'sub'
+        client.batch_account.list.return_value = [
+            self._account('first', 'rg1'), self._account('second', 'rg2')]
+        client.batch_account.get_keys.return_value.primary = 'key'
+
+        def validate(name):
+            namespace = Mock(account_name=name, account_key=None,
+                             account_endpoint='https://{}.westus.batch.azure.com'.format(name))
+            validators.validate_client_parameters(namespace)
+            return namespace
+
+        with patch.object(cache_utils.az_config, 'getint', return_value=3600):
+            self.assertEqual(validate('first').account_key, 'key')
+            self.assertEqual(validate('second').account_key, 'key')
+            client.batch_account.get_keys.assert_called_with('rg2', 'second')
+            self.assertEqual(client.batch_account.list.call_count, 1)
+
+            # Accounts missing from the index, or that have moved, cause it to be rebuilt
+            with self.assertRaises(ValueError):
+                validate('third')
+            self.assertEqual(client.batch_account.list.call_count, 2)
+            client.batch_account.get_keys.side_effect = [
+                CloudError(Mock(status_code=404), 'Not found'), Mock(primary='key')]
+            client.batch_account.list.return_value = [self._account('first', 'rg3')]
+            self.assertEqual(validate('first').account_key, 'key')
+            client.batch_account.get_keys.assert_called_with('rg3', 'first')
+            self.assertEqual(client.batch_account.list.call_count, 3)
+
+            client.batch_account.get_keys.side_effect = None
+            with patch.object(validators.time, 'time', return_value=time.time() + 7200):
+                validate('first')
+            self.assertEqual(client.batch_account.list.call_count, 4)